@@ -109,6 +109,18 @@ async function uploadMask(
   return uploadMetadata;
 }
 
+async function uploadMaskRLE(
+  folderId: string,
+  trackId: number,
+  frameId: number,
+  rle: RLEData,
+) {
+  const { data } = await girderRest.post<RLEFrameData>('dive_annotation/mask/rle', rle, {
+    params: { folderId, trackId, frameId },
+  });
+  return data;
+}
+
 async function updateRLEMasks(folderId: string, trackFrameList?: [number, number][]) {
   // First request to initialize upload
   const { data: uploadMetadata } = await girderRest.post('dive_annotation/rle_mask', { folderId, trackFrameList });
@@ -116,10 +128,19 @@ async function updateRLEMasks(folderId: string, trackFrameList?: [number, number
   return uploadMetadata;
 }
 
-async function getRLEMaskData(folderId: string) {
+export interface RLEMaskRange {
+  startFrame?: number;
+  endFrame?: number;
+  trackIds?: number[];
+}
+
+async function getRLEMaskData(folderId: string, range: RLEMaskRange = {}) {
   const response = await girderRest.get<RLETrackFrameData>('dive_annotation/rle_mask', {
     params: {
       folderId,
+      startFrame: range.startFrame,
+      endFrame: range.endFrame,
+      trackIds: range.trackIds ? JSON.stringify(range.trackIds) : undefined,
     },
   });
   return response;
@@ -152,6 +173,7 @@ export {
   getLatestRevision,
   saveDetections,
   uploadMask,
+  uploadMaskRLE,
   updateRLEMasks,
   getRLEMaskData,
   deleteMask,
@@ -9,6 +9,8 @@ export interface MetadataFilterItem {
     value?: boolean | string | string[] | number | number[]
     range?: number[]
     regEx?: boolean;
+    /** Match whole-word prefixes through the search token index instead of any substring */
+    prefix?: boolean;
 }
 
 export interface FilterDisplayConfig {
@@ -111,6 +113,8 @@ export interface MetadataFilterKeysItem {
 export interface DIVEMetadataFilter {
     search?: string;
     searchRegEx?: boolean;
+    /** Match whole-word prefixes of the filename through the search token index */
+    searchPrefix?: boolean;
     metadataFilters?: Record<string, MetadataFilterItem>;
 }
 
@@ -127,6 +131,34 @@ export interface DIVEMetadataResults {
     totalPages: number;
     filtered: number;
     count: number;
+    /** Cursor for the next page when paginating with `after`, null on the last page */
+    next?: string | null;
+}
+
+export interface DIVEMetadataFacetValue {
+    value: string | number | boolean;
+    count: number;
+}
+
+export interface DIVEMetadataFacetBin {
+    min: number;
+    max: number;
+    count: number;
+}
+
+export interface DIVEMetadataFacet {
+    category: 'categorical' | 'boolean' | 'numerical';
+    values?: DIVEMetadataFacetValue[];
+    range?: {
+        min: number,
+        max: number;
+    };
+    histogram?: DIVEMetadataFacetBin[];
+}
+
+export interface DIVEMetadataFacetResults {
+    count: number;
+    facets: Record<string, DIVEMetadataFacet>;
 }
 
 export interface MetadataResultItem {
@@ -150,14 +182,30 @@ function getMetadataFilterValues(folderId: string, keys?: string[]) {
   });
 }
 
-function filterDiveMetadata(folderId: string, filters: DIVEMetadataFilter, offset = 0, limit = 50, sort = 'filename', sortdir = 1) {
+/**
+ * Pass `after` to paginate with cursors instead of offsets: an empty string for the first
+ * page, then the `next` cursor of the previous page.  Cursors only support the filename and
+ * created sorts.
+ */
+function filterDiveMetadata(folderId: string, filters: DIVEMetadataFilter, offset = 0, limit = 50, sort = 'filename', sortdir = 1, after?: string) {
   return girderRest.get<DIVEMetadataResults>(`dive_metadata/${folderId}/filter`, {
     params: {
-      filters: toJsonParam(filters), offset, limit, sort, sortdir,
+      filters: toJsonParam(filters), offset, limit, sort, sortdir, after,
     },
   });
 }
 
+/** Value counts and numeric histograms of the rows matching the filters, computed server side. */
+function getDiveMetadataFacets(folderId: string, filters: DIVEMetadataFilter, keys?: string[], bins = 10, valueLimit = 50) {
+  const params: Record<string, string | number> = {
+    filters: toJsonParam(filters), bins, valueLimit,
+  };
+  if (keys !== undefined) {
+    params.keys = toJsonParam(keys);
+  }
+  return girderRest.get<DIVEMetadataFacetResults>(`dive_metadata/${folderId}/facets`, { params });
+}
+
 /** Metadata fields for the current dataset row under a metadata root (same lookup as DatasetInfo). */
 async function getDiveDatasetMetadataRow(
   metadataRootId: string,
@@ -183,8 +231,15 @@ async function getDiveDatasetMetadataRow(
   return row.metadata;
 }
 
+export interface DIVEMetadataCloneResponse {
+    /** The destination folder the clones are created in */
+    folderId: string;
+    /** The job creating the clones */
+    jobId: string;
+}
+
 function createDiveMetadataClone(folder: string, filters: DIVEMetadataFilter, destFolder: string) {
-  return girderRest.post<string>(`dive_metadata/${folder}/clone_filter`, null, {
+  return girderRest.post<DIVEMetadataCloneResponse>(`dive_metadata/${folder}/clone_filter`, null, {
     params: {
       baseFolder: folder, filters: toJsonParam(filters), destFolder,
     },
@@ -559,6 +614,7 @@ async function importMetadataFile(
 export {
   getMetadataFilterValues,
   filterDiveMetadata,
+  getDiveMetadataFacets,
   getDiveDatasetMetadataRow,
   createDiveMetadataClone,
   createDiveMetadataFolder,
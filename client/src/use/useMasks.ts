@@ -9,6 +9,7 @@ import {
   getRLEMaskData,
   RLETrackFrameData,
   uploadMask,
+  uploadMaskRLE,
   deleteMask,
   RLEFrameData,
 } from 'platform/web-girder/api/annotation.service';
@@ -25,6 +26,8 @@ const rleWorker = RLEWorker();
 
 const ENABLE_TIMING_LOGS = false;
 const MAX_TEXTURE_PRELOAD = 1000; // Max number of textures to preload at once
+// RLE masks are fetched in blocks of this many seconds, covering the preload look-ahead
+const RLE_FETCH_BLOCK_SECONDS = 10;
 const { preloadRLEMasks, clearQueue } = createRLEPreloader(RLEWorker, {
   batchSize: 20,
   enableTimingLogs: ENABLE_TIMING_LOGS,
@@ -159,6 +162,10 @@ export default function useMasks(
   >();
   const inFlightWorker = new Map<string, boolean>();
   const rleMasks: Ref<RLETrackFrameData> = ref({});
+  // Dataset whose RLE masks are fetched, and the frame blocks fetched or in flight
+  let rleFolderId: string | null = null;
+  const rleFetchedBlocks = new Set<number>();
+  const rlePendingBlocks = new Set<number>();
   const toolEnabled: Ref<MaskEditingTools> = ref('brush');
   const brushSize = ref(20); // Brush size for Painting/Editing
   const triggerAction: Ref<MaskTriggerActions> = ref(null);
@@ -225,16 +232,18 @@ export default function useMasks(
     if (bounds) {
       handler.updateRectBounds(frame.value, flick.value, bounds, false, true);
     }
-    await uploadMask(datasetId.value, trackId, frame.value, blob);
     if (!useRLE.value) {
+      await uploadMask(datasetId.value, trackId, frame.value, blob);
       cache.set(frameKey(frame.value, trackId), image);
     } else {
-      // Create RLE data from the image
+      // Create RLE data from the image, the server renders the mask PNG from it
       const rleObject = imageToRLEObject(image);
-      const rleData: RLEFrameData = {
-        rle: rleObject,
-        file_name: `${trackId}_${frame.value}.png`,
-      };
+      const rleData: RLEFrameData = await uploadMaskRLE(
+        datasetId.value,
+        trackId,
+        frame.value,
+        rleObject,
+      );
       rleMasks.value[trackId] = rleMasks.value[trackId] || {};
       rleMasks.value[trackId][frame.value] = rleData;
       const binaryMask = maskToLuminanceAlpha(decode([rleObject]).data, rleData.rle.size[1], rleData.rle.size[0]);
@@ -286,13 +295,73 @@ export default function useMasks(
     handler.save();
   }
 
-  async function getFolderRLEMasks(folderId: string) {
-    rleMasks.value = (await getRLEMaskData(folderId)).data;
-    if (tracksHaveMasksConfigured() && Object.keys(rleMasks.value).length === 0) {
-      setMaskWarning('Mask metadata is enabled, but rlemasks.json is empty or missing data.');
-    } else {
-      clearMaskWarning();
+  function rleBlockFrames() {
+    return Math.max(1, Math.ceil(frameRate.value * RLE_FETCH_BLOCK_SECONDS));
+  }
+
+  function rleFrameFetched(frameId: number) {
+    return rleFolderId === null || rleFetchedBlocks.has(Math.floor(frameId / rleBlockFrames()));
+  }
+
+  /**
+   * Fetch the RLE masks of the frame blocks around currentFrame that are not loaded yet,
+   * resolving true if any masks were added
+   */
+  async function fetchRLEWindow(currentFrame: number): Promise<boolean> {
+    const folderId = rleFolderId;
+    if (folderId === null) {
+      return false;
+    }
+    const blockFrames = rleBlockFrames();
+    const { minFrame } = getFrameWindow(currentFrame);
+    const lastBlock = Math.floor((currentFrame + frameRate.value * RLE_FETCH_BLOCK_SECONDS) / blockFrames);
+    const blocks: number[] = [];
+    for (let block = Math.floor(minFrame / blockFrames); block <= lastBlock; block += 1) {
+      if (!rleFetchedBlocks.has(block) && !rlePendingBlocks.has(block)) {
+        rlePendingBlocks.add(block);
+        blocks.push(block);
+      }
     }
+    const added = await Promise.all(blocks.map(async (block) => {
+      let data: RLETrackFrameData;
+      try {
+        data = (await getRLEMaskData(folderId, {
+          startFrame: block * blockFrames,
+          endFrame: (block + 1) * blockFrames - 1,
+        })).data;
+      } catch (err) {
+        if (folderId === rleFolderId) {
+          rlePendingBlocks.delete(block); // Fetched again when playback next reaches it
+        }
+        throw err;
+      }
+      // Another dataset may have been loaded while fetching
+      if (folderId !== rleFolderId) {
+        return false;
+      }
+      rlePendingBlocks.delete(block);
+      rleFetchedBlocks.add(block);
+      if (Object.keys(data).length === 0) {
+        return false;
+      }
+      const merged = { ...rleMasks.value };
+      Object.entries(data).forEach(([trackId, frames]) => {
+        merged[trackId] = { ...merged[trackId], ...frames };
+      });
+      rleMasks.value = merged;
+      return true;
+    }));
+    return added.some((value) => value);
+  }
+
+  async function getFolderRLEMasks(folderId: string) {
+    rleFolderId = folderId;
+    rleFetchedBlocks.clear();
+    rlePendingBlocks.clear();
+    rleMasks.value = {};
+    cacheWindow = { minFrame: 0, maxFrame: 0 };
+    await fetchRLEWindow(frame.value);
+    clearMaskWarning();
   }
 
   function initializeMaskData(maskData: { masks: Readonly<MaskItem[]> }) {
@@ -441,6 +510,19 @@ export default function useMasks(
         }
       });
     } else {
+      fetchRLEWindow(currentFrame).then((added) => {
+        if (added) {
+          // Preload the newly fetched masks of the current window
+          cacheWindow = { minFrame: 0, maxFrame: 0 };
+          preloadWindow(frame.value);
+        } else if (loadingFrame.value) {
+          // A frame waiting on the fetch has no mask after all
+          const [frameId, trackId] = loadingFrame.value.split('_').map(Number);
+          if (rleFrameFetched(frameId) && !rleMasks.value[trackId]?.[frameId]) {
+            loadingFrame.value = false;
+          }
+        }
+      }).catch((err) => console.error('Failed to fetch RLE masks:', err));
       const { minFrame, maxFrame } = getFrameWindow(currentFrame);
       calculateMaxCacheSeconds();
       if (cacheWindow.minFrame <= currentFrame && cacheWindow.maxFrame > currentFrame) {
@@ -563,7 +645,7 @@ export default function useMasks(
         loadingFrame.value = key;
         return undefined;
       }
-      if (!mask) {
+      if (!mask && rleFrameFetched(frameId)) {
         setMaskWarning(`Missing RLE mask for track ${trackId}, frame ${frameId}. Check rlemasks.json mapping.`);
       }
     } else {
@@ -620,7 +702,8 @@ export default function useMasks(
 
   const hasMasks = computed(() => {
     if (useRLE.value) {
-      return Object.keys(rleMasks.value).length > 0;
+      // Only the masks near the current frame are fetched, so also count tracks with masks
+      return Object.keys(rleMasks.value).length > 0 || tracksHaveMasksConfigured();
     }
     return masks.value.length > 0;
   });
@@ -654,6 +737,12 @@ export default function useMasks(
       return undefined;
     }
     const hasRLEMask = Boolean(rleMasks.value[trackId]?.[frameId]);
+    if (!hasRLEMask && !rleFrameFetched(frameId)) {
+      // The frame's masks are still being fetched
+      preloadWindow(frame.value);
+      loadingFrame.value = key;
+      return undefined;
+    }
     if (!hasRLEMask) {
       setMaskWarning(`Missing RLE mask for track ${trackId}, frame ${frameId}. Check rlemasks.json mapping.`);
       return undefined;
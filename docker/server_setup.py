@@ -9,6 +9,7 @@ from girder.models.folder import Folder
 from girder.models.setting import Setting
 from girder.models.user import User
 from pymongo.errors import OperationFailure
+from scripts.migrations import run_migrations
 
 cherrypy.config["database"]["uri"] = os.getenv("GIRDER_MONGO_URI")
 
@@ -36,6 +37,11 @@ def migrate():
         print(f'Migration: Update trackId to id: Modified {updated_records.modified_count}')
     except OperationFailure:
         print('Migration: Rename annotationItem to trackItem: skipped')
+
+    # Annotation head revision markers, which track and group listing depend on,
+    # along with index builds and mask RLE import.  Steps already completed are skipped,
+    # and removing duplicate metadata rows is left to an explicit `dive migrate`.
+    run_migrations(on_start=True)
     print('Migrations up to date!')
 
 
@@ -13,8 +13,14 @@ from girder_jobs.models.job import Job
 from dive_utils import constants
 
 from .client_webroot import ClientWebroot
-from .crud_annotation import GroupItem, RevisionLogItem, TrackItem
-from .event import DIVES3Imports, process_fs_import, process_s3_import, send_new_user_email
+from .crud_annotation import GroupItem, MaskRleItem, RevisionLogItem, TrackItem
+from .event import (
+    DIVES3Imports,
+    process_fs_import,
+    process_s3_import,
+    remove_mask_rle,
+    send_new_user_email,
+)
 from .views_annotation import AnnotationResource
 from .views_configuration import ConfigurationResource
 from .views_dataset import DatasetResource
@@ -33,6 +39,7 @@ class GirderPlugin(plugin.GirderPlugin):
         ModelImporter.registerModel('trackItem', TrackItem, plugin='dive_server')
         ModelImporter.registerModel('groupItem', GroupItem, plugin='dive_server')
         ModelImporter.registerModel('revisionLogItem', RevisionLogItem, plugin='dive_server')
+        ModelImporter.registerModel('maskRle', MaskRleItem, plugin='dive_server')
 
         info["apiRoot"].dive_annotation = AnnotationResource("dive_annotation")
         info["apiRoot"].dive_configuration = ConfigurationResource("dive_configuration")
@@ -94,6 +101,11 @@ class GirderPlugin(plugin.GirderPlugin):
             'send_new_user_email',
             send_new_user_email,
         )
+        events.bind(
+            'model.folder.remove',
+            'remove_mask_rle',
+            remove_mask_rle,
+        )
 
         plugin.getPlugin('worker').load(info)
         if not Setting().get('worker.api_url'):
@@ -3,13 +3,15 @@
 from enum import Enum
 import functools
 import os
-from typing import List, Type
+from typing import Any, Dict, List, Optional, Type
 
 from girder.constants import AccessType
 from girder.exceptions import RestException, ValidationException
+from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.models.model_base import AccessControlledModel, Model
+from girder.utility.filesystem_assetstore_adapter import FilesystemAssetstoreAdapter
 import pydantic
 from pydantic.main import BaseModel
 
@@ -78,6 +80,25 @@ def saveImportAttributes(folder, attributes, user):
     Folder().save(folder)
 
 
+def local_file_path(file: GirderModel, adapters: Optional[Dict[Any, Any]] = None) -> Optional[str]:
+    """
+    Get the path of a file on local disk, if it is stored in a filesystem assetstore.
+
+    :param adapters: cache of assetstore adapters by assetstore id, when looking up many files
+    """
+    if adapters is None:
+        adapters = {}
+    assetstoreId = file.get('assetstoreId')
+    if assetstoreId not in adapters:
+        adapters[assetstoreId] = File().getAssetstoreAdapter(file)
+    adapter = adapters[assetstoreId]
+    if isinstance(adapter, FilesystemAssetstoreAdapter):
+        path = adapter.fullPath(file)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
 def verify_dataset(folder: GirderModel):
     """Verify that a given folder is a DIVE dataset"""
     if not asbool(fromMeta(folder, constants.DatasetMarker, False)):
@@ -167,14 +188,13 @@ def get_valid_masks(folder: GirderModel, user: GirderUserModel) -> List[GirderMo
         },
         user=user,
     )
-    output_track_frames = []
-    for mask_track in list(masks_tracks):
-        track_frames = Item().find(
+    # One query for the frames of every track, with only the fields the media listing uses
+    return list(
+        Item().find(
             {
-                'folderId': mask_track['_id'],
+                'folderId': {'$in': [mask_track['_id'] for mask_track in masks_tracks]},
                 f'meta.{constants.MASK_TRACK_FRAME_MARKER}': {'$in': TRUTHY_META_VALUES},
-            }
+            },
+            fields=['name', 'meta'],
         )
-        if track_frames.count() > 0:
-            output_track_frames += list(track_frames)
-    return output_track_frames
+    )
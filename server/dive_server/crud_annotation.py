@@ -1,8 +1,7 @@
 import io
 import json
-from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Tuple
 
-from PIL import Image
 from girder.constants import AccessType
 from girder.exceptions import RestException
 from girder.models.file import File
@@ -10,26 +9,46 @@ from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.models.upload import Upload
 from girder.models.user import User
-import numpy as np
-from pycocotools import mask as mask_utils
 from pydantic import Field
 from pydantic.main import BaseModel
 import pymongo
 from pymongo.cursor import Cursor
 
 from dive_server import crud, crud_dataset
-from dive_utils import TRUTHY_META_VALUES, constants, fromMeta, models, types
-from dive_utils.serializers import viame
+from dive_utils import TRUTHY_META_VALUES, constants, fromMeta, masks, models, types
+from dive_utils.serializers import dive, viame
 
 DATASET = 'dataset'
 REVISION_DELETED = 'rev_deleted'
 REVISION_CREATED = 'rev_created'
+# Maintained marker set only on the live version of each annotation at the head revision
+REVISION_HEAD = 'rev_head'
 REVISION = 'revision'
 IDENTIFIER = 'id'
 
 DEFAULT_ANNOTATION_SORT = [[IDENTIFIER, 1]]
 DEFAULT_REVISION_SORT = [[REVISION, pymongo.DESCENDING]]
 
+# Partial index containing only the live version of each annotation
+HEAD_INDEX = [(DATASET, 1), (IDENTIFIER, 1)]
+# Covers the rev_created/rev_deleted range filter used by historical revision reads
+REVISION_INDEX = [(DATASET, 1), (REVISION_CREATED, 1), (REVISION_DELETED, 1)]
+ANNOTATION_INDICES = [
+    # Index for finding live tracks in a dataset
+    [HEAD_INDEX, {'partialFilterExpression': {REVISION_HEAD: True}}],
+    # Index for ensuring uniqueness and dataset consistency
+    [[(DATASET, 1), (IDENTIFIER, 1), (REVISION_CREATED, 1)], {'unique': True}],
+    # Index for listing a dataset at a previous revision
+    [REVISION_INDEX, {}],
+]
+# Number of annotation records written per bulk_write batch
+ANNOTATION_WRITE_BATCH_SIZE = 1000
+MASK_TRACK = 'track'
+MASK_FRAME = 'frame'
+MASK_RLE_INDICES = [
+    [[(DATASET, 1), (MASK_TRACK, 1), (MASK_FRAME, 1)], {'unique': True}],
+]
+
 
 class BaseItem(crud.PydanticModel):
     def list(
@@ -40,23 +59,65 @@ class BaseItem(crud.PydanticModel):
         sort=DEFAULT_ANNOTATION_SORT,
         revision: Optional[int] = None,
     ) -> Cursor:
-        head: int = RevisionLogItem().latest(dsFolder) if revision is None else revision
+        query, hint = self.list_query(dsFolder, revision)
+        return self.find(
+            offset=offset, limit=limit, sort=sort, query=query, fields=self.PROJECT_FIELDS
+        ).hint(hint)
+
+    def list_query(self, dsFolder: types.GirderModel, revision: Optional[int] = None):
+        """The query and index hint selecting a dataset's annotations at a revision"""
+        if revision is None:
+            # Head reads use the maintained marker instead of scanning historical versions
+            return {DATASET: dsFolder['_id'], REVISION_HEAD: True}, HEAD_INDEX
         query = {
             DATASET: dsFolder['_id'],
-            REVISION_CREATED: {'$lte': head},
-            '$or': [{REVISION_DELETED: {'$gt': head}}, {REVISION_DELETED: {'$exists': False}}],
+            REVISION_CREATED: {'$lte': revision},
+            '$or': [
+                {REVISION_DELETED: {'$gt': revision}},
+                {REVISION_DELETED: {'$exists': False}},
+            ],
         }
-        return self.find(
-            offset=offset, limit=limit, sort=sort, query=query, fields=self.PROJECT_FIELDS
+        return query, REVISION_INDEX
+
+    def merge_clone(self, query: dict, hint: list, dataset_map: Dict[Any, Any], revision: int):
+        """
+        Copy the records matching query into the clones named by dataset_map.
+
+        The copy runs as an aggregation that $merges back into this collection, so
+        records never round-trip through the server.  dataset_map maps source dataset
+        ids to clone dataset ids.  Returns the number of records written per clone.
+        """
+        sources = list(dataset_map)
+        clones = [dataset_map[source] for source in sources]
+        self.collection.aggregate(
+            [
+                {'$match': query},
+                {'$project': {**self.PROJECT_FIELDS, DATASET: 1}},
+                {
+                    '$set': {
+                        DATASET: {
+                            '$arrayElemAt': [clones, {'$indexOfArray': [sources, f'${DATASET}']}]
+                        },
+                        REVISION_CREATED: revision,
+                        REVISION_HEAD: True,
+                    }
+                },
+                # Without an _id every record is inserted as a new document
+                {'$merge': {'into': self.NAME, 'whenMatched': 'fail', 'whenNotMatched': 'insert'}},
+            ],
+            # Unlike find, aggregate sends the hint as given, and the server needs a document
+            hint=dict(hint),
         )
+        counts = self.collection.aggregate(
+            [
+                {'$match': {DATASET: {'$in': clones}, REVISION_CREATED: revision}},
+                {'$group': {'_id': f'${DATASET}', 'count': {'$sum': 1}}},
+            ]
+        )
+        return {count['_id']: count['count'] for count in counts}
 
     def initialize(self):
-        self._indices = [
-            # Index for finding tracks in a dataset
-            [[(DATASET, 1), (IDENTIFIER, 1)], {}],
-            # Index for ensuring uniqueness and dataset consistency
-            [[(DATASET, 1), (IDENTIFIER, 1), (REVISION_CREATED, 1)], {'unique': True}],
-        ]
+        self._indices = list(ANNOTATION_INDICES)
         super().initialize(self.NAME, self.MODEL)
 
 
@@ -115,6 +176,37 @@ class RevisionLogItem(crud.PydanticModel):
         return cursor, total
 
 
+class MaskRleItem(crud.PydanticModel):
+    """The COCO RLE of each mask frame, stored per dataset, track and frame"""
+
+    PROJECT_FIELDS = {'_id': 0, MASK_TRACK: 1, MASK_FRAME: 1, 'rle': 1, 'file_name': 1}
+    NAME = 'maskRle'
+    MODEL = models.MaskRleItemSchema
+
+    def initialize(self):
+        self._indices = list(MASK_RLE_INDICES)
+        super().initialize(self.NAME, self.MODEL)
+
+    def upsert(self, datasetId, trackId: int, frameId: int, entry: dict) -> pymongo.UpdateOne:
+        """A write replacing the RLE of one frame, from a legacy RLE_MASKS.json entry"""
+        key = {DATASET: datasetId, MASK_TRACK: int(trackId), MASK_FRAME: int(frameId)}
+        doc = self.validate({**key, 'rle': entry['rle'], 'file_name': entry.get('file_name')})
+        return pymongo.ReplaceOne(key, doc, upsert=True)
+
+    def legacy_json(self, query: dict) -> Dict[str, Dict[str, dict]]:
+        """Assemble matching frames in the nested {track: {frame: entry}} RLE_MASKS.json form"""
+        result: Dict[str, Dict[str, dict]] = {}
+        cursor = self.find(
+            query, fields=self.PROJECT_FIELDS, sort=[(MASK_TRACK, 1), (MASK_FRAME, 1)]
+        )
+        for doc in cursor:
+            entry = {'rle': doc['rle']}
+            if doc.get('file_name') is not None:
+                entry['file_name'] = doc['file_name']
+            result.setdefault(str(doc[MASK_TRACK]), {})[str(doc[MASK_FRAME])] = entry
+        return result
+
+
 def rollback(dsFolder: types.GirderModel, revision: int):
     """Reset to previous revision."""
     # TODO implement immutabble forward-rollback (like git revert)
@@ -123,11 +215,12 @@ def rollback(dsFolder: types.GirderModel, revision: int):
     dsId = dsFolder['_id']
     RevisionLogItem().removeWithQuery({DATASET: dsId, REVISION: {'$gt': revision}})
     listQuery = {DATASET: dsId, REVISION_CREATED: {'$gt': revision}}
-    updateQuery = {'$unset': {REVISION_DELETED: ""}}
+    restoreQuery = {DATASET: dsId, REVISION_DELETED: {'$gt': revision}}
+    updateQuery = {'$unset': {REVISION_DELETED: ""}, '$set': {REVISION_HEAD: True}}
     TrackItem().removeWithQuery(listQuery)
-    TrackItem().update(listQuery, updateQuery)
+    TrackItem().update(restoreQuery, updateQuery)
     GroupItem().removeWithQuery(listQuery)
-    GroupItem().update(listQuery, updateQuery)
+    GroupItem().update(restoreQuery, updateQuery)
 
 
 def get_annotation_csv_generator(
@@ -159,6 +252,7 @@ def get_annotation_csv_generator(
             fps=fps,
             typeFilter=typeFilter,
             revision=revision,
+            trusted=True,
         ):
             yield data
 
@@ -166,6 +260,20 @@ def get_annotation_csv_generator(
     return filename, downloadGenerator
 
 
+def get_annotation_json_generator(
+    folder: types.GirderModel, revision=None
+) -> Tuple[str, Callable[[], Generator[str, None, None]]]:
+    """Get the DIVE json annotation generator for a folder"""
+
+    def downloadGenerator():
+        tracks = TrackItem().list(folder, revision=revision)
+        groups = GroupItem().list(folder, revision=revision)
+        yield from dive.export_annotations_json(tracks, groups, trusted=True)
+
+    filename = folder["name"] + ".dive.json"
+    return filename, downloadGenerator
+
+
 class TrackUpdateArgs(BaseModel):
     delete: List[int] = Field(default_factory=list)
     upsert: List[models.Track] = Field(default_factory=list)
@@ -206,7 +314,10 @@ def save_annotations(
     new_revision = RevisionLogItem().latest(dsFolder)
     if not preventRevision:
         new_revision += 1
-    delete_annotation_update = {'$set': {REVISION_DELETED: new_revision}}
+    delete_annotation_update = {
+        '$set': {REVISION_DELETED: new_revision},
+        '$unset': {REVISION_HEAD: ""},
+    }
 
     if upsert_tracks is None:
         upsert_tracks = []
@@ -222,29 +333,48 @@ def save_annotations(
         upsert_list: Iterable[dict],
         delete_list: Iterable[int],
     ):
-        expire_operations = []  # Mark existing records as deleted
-        expire_result = {}
-        insert_operations = []  # Insert new records
-        insert_result = {}
+        expire_operations: List[Any] = []  # Mark existing records as deleted
+        insert_operations: List[Any] = []  # Insert new records
+        additions = 0
+        deletions = 0
+
+        def flush():
+            nonlocal additions, deletions
+            # Expire before insert so new records are never matched by the expire filters
+            # Ordered=false allows fast parallel writes
+            if len(expire_operations):
+                deletions += collection.collection.bulk_write(
+                    expire_operations, ordered=False
+                ).bulk_api_result.get('nModified', 0)
+                expire_operations.clear()
+            if len(insert_operations):
+                additions += collection.collection.bulk_write(
+                    insert_operations, ordered=False
+                ).bulk_api_result.get('nInserted', 0)
+                insert_operations.clear()
 
         if overwrite:
-            query = {DATASET: datasetId, REVISION_DELETED: {'$exists': False}}
-            expire_result = collection.collection.bulk_write(
+            query = {DATASET: datasetId, REVISION_HEAD: True}
+            deletions += collection.collection.bulk_write(
                 [pymongo.UpdateMany(query, delete_annotation_update)]
-            ).bulk_api_result
+            ).bulk_api_result.get('nModified', 0)
 
         for id in delete_list:
-            filter = {IDENTIFIER: id, DATASET: datasetId, REVISION_DELETED: {'$exists': False}}
+            filter = {IDENTIFIER: id, DATASET: datasetId, REVISION_HEAD: True}
             # UpdateMany for safety, UpdateOne would also work
             expire_operations.append(pymongo.UpdateMany(filter, delete_annotation_update))
 
+        # upsert_list may be a generator, such as a streaming import, so
+        # write in batches rather than holding every record in memory
         for newdict in upsert_list:
-            newdict.update({DATASET: datasetId, REVISION_CREATED: new_revision})
+            newdict.update(
+                {DATASET: datasetId, REVISION_CREATED: new_revision, REVISION_HEAD: True}
+            )
             newdict.pop(REVISION_DELETED, None)
             filter = {
                 IDENTIFIER: newdict[IDENTIFIER],
                 DATASET: datasetId,
-                REVISION_DELETED: {'$exists': False},
+                REVISION_HEAD: True,
             }
             if not overwrite:
                 # UpdateMany for safety, UpdateOne would also work
@@ -263,26 +393,27 @@ def save_annotations(
                 )
             else:
                 insert_operations.append(pymongo.InsertOne(newdict))
+            if len(insert_operations) >= ANNOTATION_WRITE_BATCH_SIZE:
+                flush()
 
-        # Ordered=false allows fast parallel writes
-        if len(expire_operations):
-            expire_result = collection.collection.bulk_write(
-                expire_operations, ordered=False
-            ).bulk_api_result
-        if len(insert_operations):
-            insert_result = collection.collection.bulk_write(
-                insert_operations, ordered=False
-            ).bulk_api_result
-
-        additions = insert_result.get('nInserted', 0)
-        deletions = expire_result.get('nModified', 0)
+        flush()
         return additions, deletions
 
-    track_additions, track_deletions = update_collection(TrackItem(), upsert_tracks, delete_tracks)
+    try:
+        track_additions, track_deletions = update_collection(
+            TrackItem(), upsert_tracks, delete_tracks
+        )
+        group_additions, group_deletions = update_collection(
+            GroupItem(), upsert_groups, delete_groups
+        )
+    except Exception:
+        if not preventRevision:
+            # Undo any batches already written for the new revision
+            rollback(dsFolder, new_revision - 1)
+        raise
     delete_mask_list = [[i, -1] for i in delete_tracks]
     if len(delete_mask_list) > 0:
         delete_masks(user, dsFolder, delete_mask_list)
-    group_additions, group_deletions = update_collection(GroupItem(), upsert_groups, delete_groups)
     additions = track_additions + group_additions
     deletions = track_deletions + group_deletions
 
@@ -308,15 +439,73 @@ def clone_annotations(
     user: types.GirderUserModel,
     revision: Optional[int] = None,
 ):
-    track_iter = TrackItem().list(source, revision=revision)
-    group_iter = GroupItem().list(source, revision=revision)
-    save_annotations(
-        dest,
-        user,
-        upsert_tracks=track_iter,
-        upsert_groups=group_iter,
-        description="initialize clone",
-    )
+    if TrackItem().findOne({DATASET: dest['_id']}) or GroupItem().findOne({DATASET: dest['_id']}):
+        track_iter = TrackItem().list(source, revision=revision)
+        group_iter = GroupItem().list(source, revision=revision)
+        save_annotations(
+            dest,
+            user,
+            upsert_tracks=track_iter,
+            upsert_groups=group_iter,
+            description="initialize clone",
+        )
+        return
+    # An empty destination needs none of save_annotations' expire writes
+    new_revision = RevisionLogItem().latest(dest) + 1
+    additions = 0
+    for model in [TrackItem(), GroupItem()]:
+        query, hint = model.list_query(source, revision)
+        additions += sum(
+            model.merge_clone(query, hint, {source['_id']: dest['_id']}, new_revision).values()
+        )
+    if additions:
+        RevisionLogItem().create(
+            models.RevisionLog(
+                dataset=dest['_id'],
+                author_name=user['login'],
+                author_id=user['_id'],
+                revision=new_revision,
+                additions=additions,
+                description="initialize clone",
+            )
+        )
+
+
+def clone_head_annotations(
+    dataset_map: Dict[Any, Any],
+    user: types.GirderUserModel,
+) -> Dict[Any, int]:
+    """
+    Clone the head annotations of many datasets into new, empty clones.
+
+    dataset_map maps source dataset ids to clone dataset ids.  Records are copied
+    with one aggregation per collection instead of a save_annotations call per
+    dataset.  Returns the number of records per clone.
+    """
+    # The first revision of an empty dataset, as save_annotations would assign
+    new_revision = 1
+    additions: Dict[Any, int] = {}
+    for model in [TrackItem(), GroupItem()]:
+        query = {DATASET: {'$in': list(dataset_map)}, REVISION_HEAD: True}
+        for cloneId, count in model.merge_clone(
+            query, HEAD_INDEX, dataset_map, new_revision
+        ).items():
+            additions[cloneId] = additions.get(cloneId, 0) + count
+
+    log_entries = [
+        models.RevisionLog(
+            dataset=cloneId,
+            author_name=user['login'],
+            author_id=user['_id'],
+            revision=new_revision,
+            additions=count,
+            description="initialize clone",
+        ).dict()
+        for cloneId, count in additions.items()
+    ]
+    if log_entries:
+        RevisionLogItem().collection.insert_many(log_entries, ordered=False)
+    return additions
 
 
 def clone_masks(
@@ -336,28 +525,22 @@ def clone_masks(
                 constants.MASK_MARKER: True,
             },
         )
-    # Copy the RLE_MASKS.json file if it exists
-    rle_item = Item().findOne(
-        {
-            'folderId': source_mask_folder['_id'],
-            f'meta.{constants.MASK_RLE_FILE_MARKER}': {'$in': TRUTHY_META_VALUES},
-        }
-    )
-    if rle_item is not None:
-        new_rle_item = Item().createItem(
-            rle_item['name'],
-            creator=user,
-            folder=dest_mask_folder,
-            reuseExisting=True,
-        )
-        Item().setMetadata(
-            new_rle_item,
+    import_legacy_rle_masks(source_mask_folder)
+    MaskRleItem().collection.aggregate(
+        [
+            {'$match': {DATASET: source['_id']}},
+            {'$project': MaskRleItem.PROJECT_FIELDS},
+            {'$set': {DATASET: dest['_id']}},
             {
-                constants.MASK_RLE_FILE_MARKER: True,
+                '$merge': {
+                    'into': MaskRleItem.NAME,
+                    'on': [DATASET, MASK_TRACK, MASK_FRAME],
+                    'whenMatched': 'replace',
+                    'whenNotMatched': 'insert',
+                }
             },
-        )
-        for file in Item().childFiles(rle_item):
-            File().copyFile(file, user, new_rle_item)
+        ]
+    )
 
     # Copy all child folders and items from source to destination mask folder
     for track_folder in Folder().childFolders(source_mask_folder, parentType='folder', user=user):
@@ -399,10 +582,10 @@ def get_annotations(dataset: types.GirderModel, revision: Optional[int] = None):
         'version': constants.AnnotationsCurrentVersion,
     }
     for t in tracks:
-        serialized = models.Track(**t).dict(exclude_none=True)
+        serialized = models.dict_trusted(models.Track, t)
         annotations['tracks'][serialized['id']] = serialized
     for g in groups:
-        serialized = models.Group(**g).dict(exclude_none=True)
+        serialized = models.dict_trusted(models.Group, g)
         annotations['groups'][serialized['id']] = serialized
     return annotations
 
@@ -418,7 +601,7 @@ def add_annotations(
     }
     max_track_id = -1
     for t in tracks:
-        serialized = models.Track(**t).dict(exclude_none=True)
+        serialized = models.dict_trusted(models.Track, t)
         annotations['tracks'][serialized['id']] = serialized
         max_track_id = max(max_track_id, serialized['id'])
     # Now add in the new tracks while renaming them
@@ -457,8 +640,13 @@ def get_labels(user: types.GirderUserModel, published=False, shared=False):
                 # Create a new field 'label' for each annotation
                 'as': 'label',
                 'pipeline': [
-                    {'$match': {'$expr': {'$eq': ['$dataset', '$$dataset_id']}}},
-                    {'$match': {'$expr': {'$eq': [{'$type': "$rev_deleted"}, 'missing']}}},
+                    # Restricting to the head marker lets the lookup use the partial index
+                    {
+                        '$match': {
+                            '$expr': {'$eq': ['$dataset', '$$dataset_id']},
+                            REVISION_HEAD: True,
+                        }
+                    },
                     # Select the confidencePairs, which is the only field needed
                     {'$project': {'confidencePairs': 1}},
                     # Use the first confidence pair in the array, which assumes they are
@@ -549,6 +737,101 @@ def get_mask_item(user: User, folder: Folder, trackId: int, frameId: int, remove
     return item
 
 
+def set_mask_rle(user: User, folder: Folder, trackId: int, frameId: int, rle: dict) -> dict:
+    """
+    Store a client-computed COCO RLE as the mask of one frame.
+
+    The mask PNG is rendered from the RLE and attached to the mask item, so item,
+    folder and zip downloads and worker tasks see the same mask as the RLE.
+
+    :return: The stored frame in the RLE_MASKS.json entry form.
+    """
+    # Video datasets record their frame size, image sequences may mix sizes
+    ffprobe_info = fromMeta(folder, 'ffprobe_info') or {}
+    frame_size = None
+    if ffprobe_info.get('height') and ffprobe_info.get('width'):
+        frame_size = [int(ffprobe_info['height']), int(ffprobe_info['width'])]
+    try:
+        rle = masks.validate_mask_rle(rle, frame_size)
+    except ValueError as e:
+        raise RestException(f'Invalid mask RLE: {e}', code=400)
+    png = masks.render_mask_png(rle)
+    mask_item = get_mask_item(user, folder, trackId, frameId)
+    Upload().uploadFromFile(
+        io.BytesIO(png),
+        len(png),
+        mask_item['name'],
+        parentType='item',
+        parent=mask_item,
+        user=user,
+        mimeType='image/png',
+    )
+    entry = {'rle': rle, 'file_name': mask_item['name']}
+    MaskRleItem().collection.bulk_write(
+        [MaskRleItem().upsert(folder['_id'], trackId, frameId, entry)]
+    )
+    return entry
+
+
+def find_mask_track_frames(
+    mask_folder: Folder, track_frame_pairs: List[Tuple[int, int]]
+) -> Tuple[Dict[int, Folder], Dict[Tuple[int, int], dict]]:
+    """
+    Look up the track folders and frame items for track/frame pairs in bulk.
+
+    Uses one query for the track folders and one for the frame items, rather than a
+    pair of lookups per requested frame.
+
+    :return: ({trackId: track folder}, {(trackId, frameId): frame item})
+    """
+    track_names = {str(track_id) for track_id, _ in track_frame_pairs}
+    folders_by_name = {
+        track_folder['name']: track_folder
+        for track_folder in Folder().find(
+            {'parentId': mask_folder['_id'], 'name': {'$in': list(track_names)}}
+        )
+    }
+    track_folders = {
+        track_id: folders_by_name[str(track_id)]
+        for track_id, _ in track_frame_pairs
+        if str(track_id) in folders_by_name
+    }
+    frame_pairs = [
+        (track_id, frame_id)
+        for track_id, frame_id in track_frame_pairs
+        if track_id in track_folders and frame_id != -1
+    ]
+    if not frame_pairs:
+        return track_folders, {}
+    # The (folderId, name) index serves the cross product; exact pairs are matched below
+    items_by_key = {
+        (item['folderId'], item['name']): item
+        for item in Item().find(
+            {
+                'folderId': {'$in': list({track_folders[t]['_id'] for t, _ in frame_pairs})},
+                'name': {'$in': list({f'{frame_id}.png' for _, frame_id in frame_pairs})},
+            }
+        )
+    }
+    items = {}
+    for track_id, frame_id in frame_pairs:
+        item = items_by_key.get((track_folders[track_id]['_id'], f'{frame_id}.png'))
+        if item is not None:
+            items[(track_id, frame_id)] = item
+    return track_folders, items
+
+
+def first_item_files(items: Iterable[dict]) -> Dict[Any, dict]:
+    """Map item ids to their first file with a single File query."""
+    item_ids = [item['_id'] for item in items]
+    files: Dict[Any, dict] = {}
+    if not item_ids:
+        return files
+    for file in File().find({'itemId': {'$in': item_ids}}):
+        files.setdefault(file['itemId'], file)
+    return files
+
+
 def get_mask_items(
     user: User,
     folder: dict,
@@ -562,214 +845,171 @@ def get_mask_items(
     """
     result: Dict[int, Dict[int, dict]] = {}
 
-    # Find or identify mask folder
-    mask_folder = Folder().findOne(
-        {
-            'parentId': folder['_id'],
-            f'meta.{constants.MASK_MARKER}': {'$in': TRUTHY_META_VALUES},
-        }
-    )
-
+    mask_folder = get_mask_folder(folder)
     if not mask_folder:
         return result  # No mask folder, nothing to return
 
+    keyed_items: List[Tuple[int, int, dict]] = []
     if track_frame_pairs is None:
         # Find all items in child folders of mask_folder that have MASK_TRACK_FRAME_MARKER
         child_folder_ids = [
             f['_id'] for f in Folder().childFolders(mask_folder, parentType='folder', user=user)
         ]
-        print(f'CHILD FOLDER IDS: {child_folder_ids}')
-        all_items = Item().find({'folderId': {'$in': child_folder_ids}})
-        print(f'ALL ITEMS: {all_items.count()}')
+        all_items = Item().find(
+            {
+                'folderId': {'$in': child_folder_ids},
+                f'meta.{constants.MASK_TRACK_FRAME_MARKER}': {'$exists': True},
+            }
+        )
         for item in all_items:
-            meta = item.get('meta', {})
-            if constants.MASK_TRACK_FRAME_MARKER in meta:
-                track_id = meta.get(constants.MASK_FRAME_PARENT_TRACK_MARKER)
-                frame_id = meta.get(constants.MASK_FRAME_VALUE)
-                if track_id is not None:
-                    files = list(Item().childFiles(item))
-                    if len(files) == 0:
-                        continue
-                    if result.get(track_id) is None:
-                        result[track_id] = {}
-                    if result[track_id].get(frame_id) is None:
-                        result[track_id][frame_id] = files[0]
+            meta = item['meta']
+            track_id = meta.get(constants.MASK_FRAME_PARENT_TRACK_MARKER)
+            if track_id is not None:
+                keyed_items.append((track_id, meta.get(constants.MASK_FRAME_VALUE), item))
     else:
         # Only find matching items based on provided pairs
-        for track_id, frame_id in track_frame_pairs:
-            track_folder = Folder().findOne({'parentId': mask_folder['_id'], 'name': str(track_id)})
-
-            if not track_folder:
-                continue  # Track folder doesn't exist
-
-            item = Item().findOne(
-                {
-                    'folderId': track_folder['_id'],
-                    'name': f'{frame_id}.png',
-                }
-            )
-
-            if not item:
-                continue  # Item doesn't exist
-
-            files = list(Item().childFiles(item))
-            if len(files) == 0:
-                continue
-            if result.get(track_id) is None:
-                result[track_id] = {}
-            if result[track_id].get(frame_id) is None:
-                result[track_id][frame_id] = files[0]
+        _, items = find_mask_track_frames(mask_folder, track_frame_pairs)
+        keyed_items = [(track_id, frame_id, item) for (track_id, frame_id), item in items.items()]
+
+    files = first_item_files(item for _, _, item in keyed_items)
+    for track_id, frame_id, item in keyed_items:
+        file = files.get(item['_id'])
+        if file is not None:
+            result.setdefault(track_id, {}).setdefault(frame_id, file)
     return result
 
 
-def get_mask_json(folder: Folder) -> Dict:
+def import_legacy_rle_masks(mask_folder: Folder):
     """
-    Retrieves the contents of the RLE_MASKS.json file associated with a given folder.
+    Move an RLE_MASKS.json file into the maskRle collection and remove it.
 
-    :param folderId: The ID (or folder dict with `_id`) of the base folder containing the mask folder.
-    :return: A dictionary representing the RLE mask JSON data, or an empty dict if not found.
+    Older datasets and worker tasks still upload the monolithic file, so it is
+    merged into the stored frames whenever masks are read or written.
     """
-    folderId = folder['_id']
-
-    # Find the mask folder under the given folder
-    mask_folder = Folder().findOne(
-        {
-            'parentId': folderId,
-            f'meta.{constants.MASK_MARKER}': {'$in': TRUTHY_META_VALUES},
-        }
-    )
-
-    if not mask_folder:
-        return {}
-
-    # Find the RLE_MASKS.json item in the mask folder
     rle_item = Item().findOne(
         {
             'folderId': mask_folder['_id'],
             f'meta.{constants.MASK_RLE_FILE_MARKER}': {'$in': TRUTHY_META_VALUES},
         }
     )
+    if rle_item is None:
+        return
+    model = MaskRleItem()
+    for file_obj in Item().childFiles(rle_item):
+        file_generator = File().download(file_obj, headers=False)()
+        try:
+            json_data = json.loads(b"".join(list(file_generator)).decode())
+        except json.JSONDecodeError:
+            continue
+        writes: List[Any] = []
+        for track_id, frames in json_data.items():
+            for frame_id, entry in frames.items():
+                try:
+                    writes.append(model.upsert(mask_folder['parentId'], track_id, frame_id, entry))
+                except (KeyError, TypeError, ValueError):
+                    continue  # Placeholder entries without an encoded mask
+                if len(writes) >= ANNOTATION_WRITE_BATCH_SIZE:
+                    model.collection.bulk_write(writes, ordered=False)
+                    writes.clear()
+        if writes:
+            model.collection.bulk_write(writes, ordered=False)
+    Item().remove(rle_item)
+
+
+def get_mask_json(
+    folder: Folder,
+    startFrame: Optional[int] = None,
+    endFrame: Optional[int] = None,
+    trackIds: Optional[List[int]] = None,
+) -> Dict:
+    """
+    Assemble RLE mask data for a dataset in the legacy RLE_MASKS.json form.
 
-    if not rle_item:
-        return {}
-
-    # Get the file associated with the RLE item
-    file_obj = next(Item().childFiles(rle_item), None)
-    if not file_obj:
-        return {}
-
-    # Download and parse the JSON file
-    file_generator = File().download(file_obj, headers=False)()
-    file_string = b"".join(list(file_generator)).decode()
-
-    try:
-        return json.loads(file_string)
-    except json.JSONDecodeError:
+    :param folder: The dataset folder containing the mask folder.
+    :param startFrame: Optional first frame to include.
+    :param endFrame: Optional last frame to include.
+    :param trackIds: Optional list of tracks to include.
+    :return: A dictionary of {trackId: {frameId: {'rle', 'file_name'}}}, or an empty dict.
+    """
+    mask_folder = get_mask_folder(folder)
+    if not mask_folder:
         return {}
+    import_legacy_rle_masks(mask_folder)
+    query: Dict[str, Any] = {DATASET: folder['_id']}
+    if trackIds is not None:
+        try:
+            query[MASK_TRACK] = {'$in': [int(trackId) for trackId in trackIds]}
+        except (TypeError, ValueError):
+            raise RestException('trackIds must be a list of integers.', code=400)
+    frame_range = {}
+    if startFrame is not None:
+        frame_range['$gte'] = startFrame
+    if endFrame is not None:
+        frame_range['$lte'] = endFrame
+    if frame_range:
+        query[MASK_FRAME] = frame_range
+    return MaskRleItem().legacy_json(query)
 
 
 def update_RLE_masks(
     user: User, folder: dict, track_frame_pairs: Optional[List[Tuple[int, int]]] = None
-) -> str:
+) -> Dict:
     """
-    Updates the JSON file (RLE_MASKS.json) in the mask folder with the encoded RLE data.
+    Encodes mask PNGs as RLE and stores each frame in the maskRle collection.
 
     If track_frame_pairs is provided (list of [trackId, frameId] pairs), it updates only the given items.
     If None, it loads all items in the mask folder that have MASK_TRACK_FRAME_MARKER metadata.
 
-    Returns a JSON string representation of the updated data.
+    Returns the updated frames in the nested RLE_MASKS.json form.
     """
-    # Locate the mask folder under the provided folder
-    mask_folder = Folder().findOne(
-        {
-            'parentId': folder['_id'],
-            f'meta.{constants.MASK_MARKER}': {'$in': TRUTHY_META_VALUES},
-        }
-    )
-
+    mask_folder = get_mask_folder(folder)
     if mask_folder is None:
         # No mask folder exists; nothing to update.
-        return json.dumps({})
-
-    # Retrieve the RLE JSON item (if exists) from the mask folder
-    rle_item = Item().findOne(
-        {
-            'folderId': mask_folder['_id'],
-            f'meta.{constants.MASK_RLE_FILE_MARKER}': {'$in': TRUTHY_META_VALUES},
-        }
-    )
-
-    # Load the current JSON data from the RLE file if available.
-    json_data = {}
-    if rle_item is not None:
-        file_obj = next(Item().childFiles(rle_item), None)
-        if file_obj is not None:
-            file_generator = File().download(file_obj, headers=False)()
-            file_string = b"".join(list(file_generator)).decode()
-            json_data = json.loads(file_string)
-            # Remove the file so that the new version can be uploaded
-            File().remove(file_obj)
+        return {}
+    import_legacy_rle_masks(mask_folder)
 
     # Get the image files associated with the track/frame pairs (or all if None)
     # Here get_mask_items returns a dict in the form: {track_id: {frame_id: file_dict, ...}, ...}
     files_dict: Dict[int, Dict[int, dict]] = get_mask_items(user, folder, track_frame_pairs)
 
-    # Process each file
-    for track_id, frame_items in files_dict.items():
-        # Ensure that json_data has the key for this track
-        if str(track_id) not in json_data:
-            json_data[str(track_id)] = {}
-        for frame_id, image_file in frame_items.items():
-            # Download the image file
-            file_obj = image_file  # image_file is a file document from Item.childFiles()
-            file_generator = File().download(file_obj, headers=False)()
-            file_bytes = b"".join(list(file_generator))
-            # Load image using PIL and convert to a binary (black/white) image
-            image = Image.open(io.BytesIO(file_bytes))
-            np_img = np.array(image.convert('1'))
-            # COCO RLE expects Fortran order and uint8 data
-            rle = mask_utils.encode(np.asfortranarray(np_img.astype(np.uint8)))
-            # The counts value needs to be JSON serializable (i.e. a string)
-            rle['counts'] = rle['counts'].decode('utf-8')
-
-            # Update the JSON structure with the new RLE and original image file name.
-            # Keys in the JSON are stored as strings.
-            json_data[str(track_id)][str(frame_id)] = {
-                'rle': rle,
-                'file_name': image_file.get('name'),
-            }
-
-    # If no RLE item exists, create one.
-    if rle_item is None:
-        rle_item = Item().createItem(
-            'RLE_MASKS.json',
-            creator=user,
-            folder=mask_folder,
-            reuseExisting=True,
-        )
-        Item().setMetadata(
-            rle_item,
-            {
-                constants.MASK_RLE_FILE_MARKER: True,
-            },
-        )
+    keyed_files = [
+        (track_id, frame_id, image_file)
+        for track_id, frame_items in files_dict.items()
+        for frame_id, image_file in frame_items.items()
+    ]
+    rles = masks.encode_mask_pngs(mask_file_sources([file for _, _, file in keyed_files]))
+
+    model = MaskRleItem()
+    json_data: Dict[str, Dict[str, dict]] = {}
+    writes: List[Any] = []
+    for (track_id, frame_id, image_file), rle in zip(keyed_files, rles):
+        entry = {'rle': rle, 'file_name': image_file.get('name')}
+        json_data.setdefault(str(track_id), {})[str(frame_id)] = entry
+        writes.append(model.upsert(folder['_id'], track_id, frame_id, entry))
+        if len(writes) >= ANNOTATION_WRITE_BATCH_SIZE:
+            model.collection.bulk_write(writes, ordered=False)
+            writes.clear()
+    if writes:
+        model.collection.bulk_write(writes, ordered=False)
+    return json_data
 
-    # Convert updated JSON data to bytes
-    json_bytes = json.dumps(json_data).encode()
-    byteIO = io.BytesIO(json_bytes)
 
-    # Upload updated JSON file, replacing the previous version.
-    Upload().uploadFromFile(
-        byteIO,
-        len(json_bytes),
-        rle_item['name'],
-        parentType="item",
-        parent=rle_item,
-        user=user,
-        mimeType="application/json",
-    )
+def mask_file_sources(files: List[dict]) -> List[masks.MaskSource]:
+    """
+    Locate mask image files for encoding.
 
-    return json_data
+    Files in a filesystem assetstore are returned as paths so encoding workers read
+    them directly.  Other files are downloaded.
+    """
+    adapters: Dict[Any, Any] = {}
+    sources: List[masks.MaskSource] = []
+    for file in files:
+        path = crud.local_file_path(file, adapters)
+        if path is not None:
+            sources.append(path)
+        else:
+            sources.append(b''.join(File().download(file, headers=False)()))
+    return sources
 
 
 def delete_masks(
@@ -778,7 +1018,7 @@ def delete_masks(
     track_frame_pairs: Optional[List[Tuple[int, int]]] = None,  # -1 frame means entire track
 ) -> Dict:
     """
-    Deletes specified mask items or track folders, and updates RLE_MASKS.json.
+    Deletes specified mask items or track folders, along with their stored RLE.
 
     Returns a summary:
         {
@@ -795,82 +1035,40 @@ def delete_masks(
         "missingFrames": [],
     }
 
-    # Locate the mask folder
-    mask_folder = Folder().findOne(
-        {
-            'parentId': folder['_id'],
-            f'meta.{constants.MASK_MARKER}': {'$in': TRUTHY_META_VALUES},
-        }
-    )
+    mask_folder = get_mask_folder(folder)
     if not mask_folder:
         return  # mask folder doesn't exist so this can be skipped
 
     if not track_frame_pairs:
         raise RestException("No track/frame pairs provided for deletion.", code=400)
 
-    rle_json = get_mask_json(folder)
+    import_legacy_rle_masks(mask_folder)
+    rle_deletes: List[Any] = []
 
+    track_folders, items = find_mask_track_frames(mask_folder, track_frame_pairs)
     for track_id, frame_id in track_frame_pairs:
-        track_str = str(track_id)
-        track_folder = Folder().findOne({'parentId': mask_folder['_id'], 'name': track_str})
-
-        if not track_folder:
+        track_folder = track_folders.get(track_id)
+        if not track_folder or track_id in result["deletedTracks"]:
             result["missingTracks"].append(track_id)
             continue
 
+        rle_key = {DATASET: folder['_id'], MASK_TRACK: int(track_id)}
         if frame_id == -1:
             # Delete the entire track
             Folder().remove(track_folder)
             result["deletedTracks"].append(track_id)
-            if track_str in rle_json:
-                del rle_json[track_str]
+            rle_deletes.append(pymongo.DeleteMany(rle_key))
         else:
-            item = Item().findOne({'folderId': track_folder['_id'], 'name': f'{frame_id}.png'})
+            item = items.get((track_id, frame_id))
 
             if item:
                 Item().remove(item)
                 result["deletedFrames"].append((track_id, frame_id))
             else:
                 result["missingFrames"].append((track_id, frame_id))
+            rle_deletes.append(pymongo.DeleteOne({**rle_key, MASK_FRAME: int(frame_id)}))
 
-            # Remove from RLE JSON
-            if track_str in rle_json and str(frame_id) in rle_json[track_str]:
-                del rle_json[track_str][str(frame_id)]
-                if not rle_json[track_str]:
-                    del rle_json[track_str]
-
-    # Update RLE_MASKS.json
-    rle_item = Item().findOne(
-        {
-            'folderId': mask_folder['_id'],
-            f'meta.{constants.MASK_RLE_FILE_MARKER}': {'$in': TRUTHY_META_VALUES},
-        }
-    )
-
-    if rle_item:
-        old_file = next(Item().childFiles(rle_item), None)
-        if old_file:
-            File().remove(old_file)
-    else:
-        rle_item = Item().createItem(
-            'RLE_MASKS.json',
-            creator=user,
-            folder=mask_folder,
-            reuseExisting=True,
-        )
-        Item().setMetadata(rle_item, {constants.MASK_RLE_FILE_MARKER: True})
-
-    json_bytes = json.dumps(rle_json).encode()
-    byteIO = io.BytesIO(json_bytes)
-
-    Upload().uploadFromFile(
-        byteIO,
-        len(json_bytes),
-        rle_item['name'],
-        parentType="item",
-        parent=rle_item,
-        user=user,
-        mimeType="application/json",
-    )
+    if rle_deletes:
+        MaskRleItem().collection.bulk_write(rle_deletes, ordered=False)
 
     return result
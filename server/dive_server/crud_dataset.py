@@ -1,20 +1,29 @@
+import datetime
 import json
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
+from bson.objectid import ObjectId
 import cherrypy
 from girder.constants import AccessType
-from girder.exceptions import RestException
+from girder.exceptions import RestException, ValidationException
 from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.models.user import User
 from girder.utility import ziputil
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
 from pydantic.main import BaseModel
 
 from dive_server import crud, crud_annotation
 from dive_utils import TRUTHY_META_VALUES, asbool, constants, fromMeta, models, types
 
+# Number of datasets cloned per batch by createSoftClones
+SOFT_CLONE_BATCH_SIZE = 100
+
 
 def get_url(dataset: types.GirderModel, item: types.GirderModel) -> str:
     return f"/api/v1/dive_dataset/{str(dataset['_id'])}/media/{str(item['_id'])}/download"
@@ -56,6 +65,203 @@ def createSoftClone(
     return cloned_folder
 
 
+def _unique_folder_name(name: str, taken: set) -> str:
+    """Pick a free name the way Folder().validate(allowRename=True) would"""
+    unique = name
+    n = 0
+    while unique in taken:
+        n += 1
+        unique = f'{name} ({n})'
+    taken.add(unique)
+    return unique
+
+
+def _new_folder_document(
+    owner: types.GirderUserModel, parent_folder: types.GirderModel, name: str, description=''
+) -> dict:
+    """Build the document Folder().createFolder would save, for inserting in bulk"""
+    now = datetime.datetime.utcnow()
+    folder = {
+        'name': name,
+        'lowerName': name.lower(),
+        'description': description,
+        'parentCollection': 'folder',
+        'baseParentId': parent_folder['baseParentId'],
+        'baseParentType': parent_folder['baseParentType'],
+        'parentId': parent_folder['_id'],
+        'creatorId': owner['_id'],
+        'created': now,
+        'updated': now,
+        'size': 0,
+        'meta': {},
+    }
+    Folder().copyAccessPolicies(src=parent_folder, dest=folder, save=False)
+    Folder().setUserAccess(folder, user=owner, level=AccessType.ADMIN, save=False)
+    return folder
+
+
+def createSoftClones(
+    owner: types.GirderUserModel,
+    source_ids: List[str],
+    parent_folder: types.GirderModel,
+    progress: Optional[Callable[[int], bool]] = None,
+) -> Dict[str, int]:
+    """
+    Create no-copy clones of many datasets in parent_folder for owner.
+
+    Folders and annotations are written in batches instead of a createSoftClone
+    call per dataset.  Each clone records its source and stays pending until its
+    annotations and masks are copied, so running again with the same sources
+    skips finished clones and redoes the ones an interruption left partial.
+    progress is called with the number of sources handled after each batch,
+    and returning False from it stops the clone.  Sources that are not valid datasets,
+    or whose media source is gone, are counted as invalid and left out.
+    """
+    counts = {'cloned': 0, 'skipped': 0, 'missing': 0, 'invalid': 0}
+    parentId = parent_folder['_id']
+    taken = {doc['name'] for doc in Folder().find({'parentId': parentId}, fields=['name'])}
+    taken.update(doc['name'] for doc in Item().find({'folderId': parentId}, fields=['name']))
+    for start in range(0, len(source_ids), SOFT_CLONE_BATCH_SIZE):
+        batch = [
+            ObjectId(sourceId) for sourceId in source_ids[start : start + SOFT_CLONE_BATCH_SIZE]
+        ]
+        existing = {
+            doc[constants.SoftCloneSourceMarker]: doc
+            for doc in Folder().find(
+                {'parentId': parentId, constants.SoftCloneSourceMarker: {'$in': batch}}
+            )
+        }
+        sources = [
+            doc
+            for doc in Folder().find({'_id': {'$in': batch}})
+            if Folder().hasAccess(doc, user=owner, level=AccessType.READ)
+        ]
+        counts['missing'] += len(batch) - len(sources)
+        pending: List[Tuple[types.GirderModel, types.GirderModel]] = []
+        created: List[dict] = []
+        for source in sources:
+            clone = existing.get(source['_id'])
+            if clone is not None and not clone.get(constants.SoftClonePendingMarker):
+                counts['skipped'] += 1
+                continue
+            if clone is not None:
+                # Left partial by an interrupted run, so start its contents over
+                crud_annotation.rollback(clone, 0)
+                mask_folder = crud_annotation.get_mask_folder(clone)
+                if mask_folder is not None:
+                    Folder().remove(mask_folder)
+            else:
+                try:
+                    media_source_folder = crud.getCloneRoot(owner, source)
+                    clone = Folder().validate(
+                        _new_folder_document(
+                            owner,
+                            parent_folder,
+                            _unique_folder_name(source['name'].strip(), taken),
+                            description=f'Clone of {source["name"]}.',
+                        ),
+                        allowRename=True,
+                    )
+                except (RestException, ValidationException, ValueError):
+                    counts['invalid'] += 1
+                    continue
+                clone['meta'] = {**source['meta'], constants.PublishedMarker: False}
+                # ensure confidence filter metadata exists
+                clone['meta'].setdefault(constants.ConfidenceFiltersMarker, {'default': 0.1})
+                clone[constants.ForeignMediaIdMarker] = str(media_source_folder['_id'])
+                clone[constants.SoftCloneSourceMarker] = source['_id']
+                clone[constants.SoftClonePendingMarker] = True
+                created.append(clone)
+            pending.append((source, clone))
+
+        if created:
+            Folder().collection.insert_many(created)
+            Folder().collection.insert_many(
+                [
+                    Folder().validate(
+                        _new_folder_document(owner, clone, constants.AuxiliaryFolderName)
+                    )
+                    for clone in created
+                ]
+            )
+        if pending:
+            crud_annotation.clone_head_annotations(
+                {source['_id']: clone['_id'] for source, clone in pending}, owner
+            )
+            with_masks = {
+                doc['parentId']
+                for doc in Folder().find(
+                    {
+                        'parentId': {'$in': [source['_id'] for source, _ in pending]},
+                        f'meta.{constants.MASK_MARKER}': {'$in': TRUTHY_META_VALUES},
+                    },
+                    fields=['parentId'],
+                )
+            }
+            for source, clone in pending:
+                if source['_id'] in with_masks:
+                    crud_annotation.clone_masks(source, clone, owner)
+            Folder().update(
+                {'_id': {'$in': [clone['_id'] for _, clone in pending]}},
+                {'$unset': {constants.SoftClonePendingMarker: ''}},
+            )
+            counts['cloned'] += len(pending)
+        if progress is not None and not progress(start + len(batch)):
+            break
+    return counts
+
+
+def softCloneJob(job):
+    """
+    Run a soft clone job on a thread, as local jobs are scheduled within the request.
+
+    Rescheduling the job resumes it, see createSoftClones.
+    """
+    proc = threading.Thread(target=soft_clone_task, args=(job,), daemon=True)
+    proc.start()
+    return job, proc
+
+
+def soft_clone_task(job: types.GirderModel):
+    params = job['kwargs']['params']
+    owner = User().load(params['userId'], force=True)
+    parent_folder = Folder().load(params['destFolderId'], force=True)
+    source_ids = params['datasetIds']
+    job = Job().updateJob(
+        job,
+        log=f'Cloning {len(source_ids)} datasets into {parent_folder["name"]}\n',
+        status=JobStatus.RUNNING,
+        progressTotal=len(source_ids),
+        progressCurrent=0,
+    )
+
+    def progress(handled: int) -> bool:
+        nonlocal job
+        job = Job().load(job['_id'], force=True)
+        if job['status'] == JobStatus.CANCELED:
+            return False
+        job = Job().updateJob(job, progressCurrent=handled)
+        return True
+
+    try:
+        counts = createSoftClones(owner, source_ids, parent_folder, progress)
+    except Exception:
+        Job().updateJob(
+            job, log=f'Error cloning datasets:\n{traceback.format_exc()}', status=JobStatus.ERROR
+        )
+        return
+    if job['status'] != JobStatus.CANCELED:
+        Job().updateJob(
+            job,
+            log=(
+                f'Cloned {counts["cloned"]} datasets, skipped {counts["skipped"]} already cloned,'
+                f' {counts["invalid"]} invalid and {counts["missing"]} missing or inaccessible\n'
+            ),
+            status=JobStatus.SUCCESS,
+            notify=True,
+        )
+
+
 def list_datasets(
     user: types.GirderUserModel,
     published: bool,
@@ -347,7 +553,14 @@ def get_media(
                 )
             )
 
-    masks = crud.get_valid_masks(dsFolder, user)
+    masks = []
+    # Masks stored as RLE are fetched a frame window at a time from dive_annotation/rle_mask,
+    # so their items are only listed for datasets that have none stored yet
+    stored_rle = crud_annotation.MaskRleItem().findOne(
+        {crud_annotation.DATASET: dsFolder['_id']}, fields=['_id']
+    )
+    if stored_rle is None:
+        masks = crud.get_valid_masks(dsFolder, user)
     print(f'FolderId: {dsFolder["_id"]}')
     if len(masks) > 0:
         # Find a video tagged with an h264 codec left by the transcoder
@@ -886,11 +1099,7 @@ def export_datasets_zipstream(
                     indent=2,
                 )
 
-            def makeDiveJson():
-                """Include DIVE JSON output annotation file"""
-                annotations = crud_annotation.get_annotations(dsFolder)
-                print(annotations)
-                yield json.dumps(annotations)
+            _, makeDiveJson = crud_annotation.get_annotation_json_generator(dsFolder)
 
             for data in z.addFile(makeMetajson, Path(f'{zip_path}meta.json')):
                 yield data
@@ -1,5 +1,8 @@
+from concurrent.futures import Future, ProcessPoolExecutor
 import json
-from typing import Dict, List, Optional, TypedDict
+import multiprocessing
+import os
+from typing import Any, Callable, Dict, Iterator, List, Optional, TextIO, TypedDict
 
 from girder.exceptions import RestException
 from girder.models.file import File
@@ -13,11 +16,16 @@ import pymongo
 
 from dive_server import crud, crud_annotation
 from dive_tasks import tasks
-from dive_utils import constants, fromMeta, models, types
+from dive_utils import constants, fromMeta, models, text_stream, types
 from dive_utils.serializers import dive, kpf, kwcoco, viame
 
 from . import crud_dataset
 
+# Worker processes used to parse multiple annotation files in one import
+ANNOTATION_PARSE_PROCESSES = min(4, os.cpu_count() or 1)
+# Combined file size below which worker startup outweighs parallel parsing
+ANNOTATION_PARSE_POOL_MIN_BYTES = 16 * 1024 * 1024
+
 
 class RunTrainingArgs(BaseModel):
     folderIds: List[str]
@@ -85,34 +93,36 @@ GetDataReturnType = TypedDict(
         'meta': Optional[dict],
         'attributes': Optional[dict],
         'type': crud.FileType,
+        # Tracks to be consumed once, in place of annotations, for track-sorted imports
+        'trackStream': Optional[Iterator[dict]],
     },
 )
 
 
-def _get_data_by_type(
-    file: types.GirderModel,
+def _parse_data_by_type(
+    exts: List[str],
+    open_stream: Callable[[], TextIO],
     image_map: Optional[Dict[str, int]] = None,
+    stream_tracks=False,
 ) -> Optional[GetDataReturnType]:
     """
-    Given an arbitrary Girder file model, figure out what kind of file it is and
-    parse it appropriately.
-
-    Any given file type can result in updates to annotations, metadata, and/or attributes
+    Figure out what kind of file a text stream holds and parse it appropriately.
 
-    :param file: Girder file model
+    :param exts: file extensions of the source file
+    :param open_stream: returns a new text stream over the file contents
     :param image_map: Mapping of image names to frame numbers
+    :param stream_tracks: return track-sorted CSV and COCO tracks as a lazy trackStream
+        rather than assembling every track in memory.  attributes are filled in
+        as the stream is consumed.
     """
-    if file is None:
-        return None
-    file_generator = File().download(file, headers=False)()
-    file_string = b"".join(list(file_generator)).decode()
+    file_stream = open_stream()
     data_dict = None
 
     # Discover the type of the mystery file
-    if file['exts'][-1] == 'csv':
+    if exts[-1] == 'csv':
         as_type = crud.FileType.VIAME_CSV
-    elif file['exts'][-1] == 'json':
-        data_dict = json.loads(file_string)
+    elif exts[-1] == 'json':
+        data_dict = json.load(file_stream)
         if type(data_dict) is list:
             raise RestException('No array-type json objects are supported')
         if kwcoco.is_coco_json(data_dict):
@@ -122,36 +132,135 @@ def _get_data_by_type(
             as_type = crud.FileType.DIVE_CONF
         else:
             as_type = crud.FileType.DIVE_JSON
-    elif file['exts'][-1] in ['yml', 'yaml']:
+    elif exts[-1] in ['yml', 'yaml']:
         as_type = crud.FileType.MEVA_KPF
     else:
         raise RestException('Got file of unknown and unusable type')
 
     # Parse the file as the now known type
     if as_type == crud.FileType.VIAME_CSV:
-        converted, attributes = viame.load_csv_as_tracks_and_attributes(
-            file_string.splitlines(), image_map
-        )
-        return {'annotations': converted, 'meta': None, 'attributes': attributes, 'type': as_type}
+        if stream_tracks and viame.is_track_sorted_csv(file_stream):
+            attributes = {}
+            return {
+                'annotations': None,
+                'meta': None,
+                'attributes': attributes,
+                'type': as_type,
+                'trackStream': viame.stream_csv_tracks(open_stream(), image_map, attributes),
+            }
+        if stream_tracks:
+            # The sortedness check consumed the stream, fall back to in-memory assembly
+            file_stream = open_stream()
+        converted, attributes = viame.load_csv_as_tracks_and_attributes(file_stream, image_map)
+        return {
+            'annotations': converted,
+            'meta': None,
+            'attributes': attributes,
+            'type': as_type,
+            'trackStream': None,
+        }
     if as_type == crud.FileType.MEVA_KPF:
-        converted, attributes = kpf.convert(kpf.load(file_string))
-        return {'annotations': converted, 'meta': None, 'attributes': attributes, 'type': as_type}
+        converted, attributes = kpf.convert(kpf.load(file_stream))
+        return {
+            'annotations': converted,
+            'meta': None,
+            'attributes': attributes,
+            'type': as_type,
+            'trackStream': None,
+        }
 
     # All filetypes below are JSON, so if as_type was specified, it needs to be loaded.
     if data_dict is None:
-        data_dict = json.loads(file_string)
+        data_dict = json.load(file_stream)
     if as_type == crud.FileType.COCO_JSON:
+        if stream_tracks and kwcoco.is_track_sorted_coco(data_dict):
+            attributes = {}
+            return {
+                'annotations': None,
+                'meta': None,
+                'attributes': attributes,
+                'type': as_type,
+                'trackStream': kwcoco.stream_coco_tracks(data_dict, attributes),
+            }
         converted, attributes = kwcoco.load_coco_as_tracks_and_attributes(data_dict)
-        return {'annotations': converted, 'meta': None, 'attributes': attributes, 'type': as_type}
+        return {
+            'annotations': converted,
+            'meta': None,
+            'attributes': attributes,
+            'type': as_type,
+            'trackStream': None,
+        }
     if as_type == crud.FileType.DIVE_CONF:
-        return {'annotations': None, 'meta': data_dict, 'attributes': None, 'type': as_type}
+        return {
+            'annotations': None,
+            'meta': data_dict,
+            'attributes': None,
+            'type': as_type,
+            'trackStream': None,
+        }
     if as_type == crud.FileType.DIVE_JSON:
         migrated = dive.migrate(data_dict)
         annotations, attributes = viame.load_json_as_track_and_attributes(data_dict)
-        return {'annotations': migrated, 'meta': None, 'attributes': attributes, 'type': as_type}
+        return {
+            'annotations': migrated,
+            'meta': None,
+            'attributes': attributes,
+            'type': as_type,
+            'trackStream': None,
+        }
     return None
 
 
+def _get_data_by_type(
+    file: types.GirderModel,
+    image_map: Optional[Dict[str, int]] = None,
+    stream_tracks=False,
+) -> Optional[GetDataReturnType]:
+    """
+    Given an arbitrary Girder file model, figure out what kind of file it is and
+    parse it appropriately.
+
+    Any given file type can result in updates to annotations, metadata, and/or attributes
+
+    :param file: Girder file model
+    :param image_map: Mapping of image names to frame numbers
+    :param stream_tracks: see _parse_data_by_type
+    """
+    if file is None:
+        return None
+    return _parse_data_by_type(
+        file['exts'],
+        # Decode the download incrementally rather than joining the whole file in memory
+        lambda: text_stream(File().download(file, headers=False)()),
+        image_map,
+        stream_tracks,
+    )
+
+
+def _parse_file_source(
+    exts: List[str],
+    path: str,
+    image_map: Optional[Dict[str, int]] = None,
+    stream_tracks=False,
+) -> Optional[GetDataReturnType]:
+    """
+    Parse a file from its path on local disk.
+    Runs in a worker process, so must not use the database.
+
+    :param stream_tracks: return None for a track-sorted CSV file, which is better
+        streamed into the database by the calling process than parsed in full here.
+    """
+    with open(path, encoding='utf-8') as fp:
+        if stream_tracks and exts[-1] == 'csv' and viame.is_track_sorted_csv(fp):
+            return None
+
+        def reopen() -> TextIO:
+            fp.seek(0)
+            return fp
+
+        return _parse_data_by_type(exts, reopen, image_map)
+
+
 def process_items(
     folder: types.GirderModel, user: types.GirderUserModel, additive=False, additivePrepend=''
 ):
@@ -175,46 +284,131 @@ def process_items(
         folder,
         user,
     )
-    for item in unprocessed_items:
-        file: Optional[types.GirderModel] = next(Item().childFiles(item), None)
-        if file is None:
-            raise RestException('Item had no associated files')
+    items = list(unprocessed_items)
+    if not items:
+        return
+    # The image map is a full folder scan and sort, so it is shared by every item
+    image_map = None
+    if fromMeta(folder, constants.TypeMarker) == 'image-sequence':
+        image_map = crud.valid_image_names_dict(crud.valid_images(folder, user))
+
+    # Parse multiple large files on local disk in parallel.  Workers read the files
+    # themselves, and hand track-sorted files back to be streamed in this process.
+    files = [next(Item().childFiles(item), None) for item in items]
+    adapters: Dict[Any, Any] = {}
+    paths: Dict[int, str] = {}
+    if len(items) > 1:
+        for index, file in enumerate(files):
+            path = None if file is None else crud.local_file_path(file, adapters)
+            if path is not None:
+                paths[index] = path
+    pool = None
+    futures: Dict[int, Future] = {}
+    if (
+        len(paths) > 1
+        and sum(files[index]['size'] for index in paths) >= ANNOTATION_PARSE_POOL_MIN_BYTES
+    ):
+        pool = ProcessPoolExecutor(
+            max_workers=min(len(paths), ANNOTATION_PARSE_PROCESSES),
+            # Forking a threaded server holding database connections is unsafe
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    pending = iter(paths)
+
+    def submit_ahead():
+        # Only as many parsed files as there are workers are held in memory at once
+        while pool is not None and len(futures) < ANNOTATION_PARSE_PROCESSES:
+            index = next(pending, None)
+            if index is None:
+                return
+            futures[index] = pool.submit(
+                _parse_file_source, files[index]['exts'], paths[index], image_map, not additive
+            )
 
-        try:
-            image_map = None
-            if fromMeta(folder, constants.TypeMarker) == 'image-sequence':
-                image_map = crud.valid_image_names_dict(crud.valid_images(folder, user))
-            results = _get_data_by_type(file, image_map=image_map)
-        except Exception as e:
-            Item().remove(item)
-            raise RestException(f'{file["name"]} was not a supported file type: {e}') from e
+    try:
+        # Apply results in creation order
+        for index, item in enumerate(items):
+            submit_ahead()
+            _process_item(
+                folder,
+                user,
+                auxiliary,
+                item,
+                files[index],
+                image_map,
+                futures.pop(index, None),
+                additive,
+                additivePrepend,
+            )
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _process_item(
+    folder: types.GirderModel,
+    user: types.GirderUserModel,
+    auxiliary: types.GirderModel,
+    item: types.GirderModel,
+    file: Optional[types.GirderModel],
+    image_map: Optional[Dict[str, int]],
+    parsed: Optional[Future],
+    additive: bool,
+    additivePrepend: str,
+):
+    """Save the parsed contents of a single item and move it to the auxiliary folder"""
+    if file is None:
+        raise RestException('Item had no associated files')
 
+    try:
+        results = None if parsed is None else parsed.result()
         if results is None:
-            Item().remove(item)
-            raise RestException(f'Unknown file type for {file["name"]}')
-
-        item['meta'][constants.ProcessedMarker] = True
-        Item().move(item, auxiliary)
-        if results['annotations']:
-            updated_tracks = results['annotations']['tracks'].values()
-            if additive:  # get annotations and add them to the end
-                tracks = crud_annotation.add_annotations(
-                    folder, results['annotations']['tracks'], additivePrepend
-                )
-                updated_tracks = tracks.values()
-            print(f'Saving Annotations: {user}')
+            # Additive imports need every track in memory to renumber them
+            results = _get_data_by_type(file, image_map=image_map, stream_tracks=not additive)
+    except Exception as e:
+        Item().remove(item)
+        raise RestException(f'{file["name"]} was not a supported file type: {e}') from e
+
+    if results is None:
+        Item().remove(item)
+        raise RestException(f'Unknown file type for {file["name"]}')
+
+    item['meta'][constants.ProcessedMarker] = True
+    Item().move(item, auxiliary)
+    if results['trackStream'] is not None:
+        print(f'Saving Annotations: {user}')
+        try:
+            # Completed tracks are written in batches as the file is parsed
             crud_annotation.save_annotations(
                 folder,
                 user,
-                upsert_tracks=updated_tracks,
-                upsert_groups=results['annotations']['groups'].values(),
+                upsert_tracks=results['trackStream'],
                 overwrite=True,
                 description=f'Import {results["type"].name} from {file["name"]}',
             )
-        if results['attributes']:
-            crud.saveImportAttributes(folder, results['attributes'], user)
-        if results['meta']:
-            crud_dataset.update_metadata(folder, results['meta'], False)
+        except Exception as e:
+            Item().remove(item)
+            raise RestException(f'{file["name"]} could not be imported: {e}') from e
+    if results['annotations']:
+        updated_tracks = results['annotations']['tracks'].values()
+        if additive:  # get annotations and add them to the end
+            tracks = crud_annotation.add_annotations(
+                folder, results['annotations']['tracks'], additivePrepend
+            )
+            updated_tracks = tracks.values()
+        print(f'Saving Annotations: {user}')
+        crud_annotation.save_annotations(
+            folder,
+            user,
+            upsert_tracks=updated_tracks,
+            upsert_groups=results['annotations']['groups'].values(),
+            overwrite=True,
+            description=f'Import {results["type"].name} from {file["name"]}',
+        )
+    if results['attributes']:
+        crud.saveImportAttributes(folder, results['attributes'], user)
+    if results['meta']:
+        crud_dataset.update_metadata(folder, results['meta'], False)
 
 
 def postprocess(
@@ -16,9 +16,12 @@ from girder.utility.mail_utils import renderTemplate, sendMail
 from girder_jobs.models.job import Job
 from girder_worker.girder_plugin.utils import getWorkerApiUrl
 
+from dive_server.crud_annotation import DATASET, MASK_TRACK, MaskRleItem
 from dive_tasks.dive_batch_postprocess import DIVEBatchPostprocessTaskParams
-from dive_utils import asbool, fromMeta, prevent_assetstore_transcoding
+from dive_utils import TRUTHY_META_VALUES, asbool, fromMeta, prevent_assetstore_transcoding
 from dive_utils.constants import (
+    MASK_MARKER,
+    MASK_TRACK_MARKER,
     AssetstoreSourceMarker,
     AssetstoreSourcePathMarker,
     DatasetMarker,
@@ -42,6 +45,22 @@ def send_new_user_email(event):
         logger.exception("Failed to send new user email")
 
 
+def remove_mask_rle(event):
+    """Remove the stored RLE of masks when their mask or track folder is deleted"""
+    folder = event.info
+    meta = folder.get('meta', {})
+    if meta.get(MASK_MARKER) in TRUTHY_META_VALUES:
+        MaskRleItem().removeWithQuery({DATASET: folder['parentId']})
+    elif meta.get(MASK_TRACK_MARKER) in TRUTHY_META_VALUES:
+        mask_folder = Folder().load(folder['parentId'], force=True)
+        try:
+            trackId = int(folder['name'])
+        except ValueError:
+            return
+        if mask_folder is not None:
+            MaskRleItem().removeWithQuery({DATASET: mask_folder['parentId'], MASK_TRACK: trackId})
+
+
 def process_assetstore_import(event, meta: dict):
     """
     Function for appending the appropriate metadata to no-copy import data
@@ -5,7 +5,7 @@ from typing import List, Optional
 import cherrypy
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
-from girder.api.rest import Resource, setRawResponse
+from girder.api.rest import Resource
 from girder.constants import AccessType, TokenScope
 from girder.exceptions import GirderException, RestException
 from girder.models.file import File
@@ -51,6 +51,7 @@ class AnnotationResource(Resource):
         self.route("POST", ("rollback",), self.rollback)
         self.route("POST", ("process_json",), self.process_json)
         self.route("POST", ('mask',), self.update_mask)
+        self.route("POST", ('mask', 'rle'), self.update_mask_rle)
         self.route("DELETE", ('mask',), self.delete_mask)
         self.route("POST", ('rle_mask',), self.update_rle_mask)
         self.route("GET", ('rle_mask',), self.get_rle_mask)
@@ -118,6 +119,25 @@ class AnnotationResource(Resource):
             crud_annotation.update_RLE_masks(user, folder, [[trackId, frameId]])
             return finalized_upload
 
+    @access.user
+    @autoDescribeRoute(
+        Description("Update a mask annotation from its COCO RLE")
+        .notes("The mask PNG is rendered from the RLE on the server and stored with the item.")
+        .modelParam("folderId", **DatasetModelParam, level=AccessType.WRITE)
+        .param("trackId", "Track ID to update", paramType="query", dataType="integer")
+        .param("frameId", "Frame ID to update", paramType="query", dataType="integer")
+        .jsonParam(
+            "rle",
+            "COCO RLE of the mask, as {size: [height, width], counts: string}",
+            paramType="body",
+            requireObject=True,
+        )
+    )
+    def update_mask_rle(self, folder, trackId, frameId, rle):
+        crud.verify_dataset(folder)
+        user = self.getCurrentUser()
+        return crud_annotation.set_mask_rle(user, folder, trackId, frameId, rle)
+
     @access.user
     @autoDescribeRoute(
         Description("Delete mask annotations")
@@ -154,13 +174,34 @@ class AnnotationResource(Resource):
 
     @access.user
     @autoDescribeRoute(
-        Description("Get RLE mask annotations").modelParam(
-            "folderId", **DatasetModelParam, level=AccessType.READ
+        Description("Get RLE mask annotations, nested by track and frame as in RLE_MASKS.json")
+        .modelParam("folderId", **DatasetModelParam, level=AccessType.READ)
+        .param(
+            "startFrame",
+            "First frame to include.  Default is the start of the dataset.",
+            paramType="query",
+            dataType="integer",
+            required=False,
+        )
+        .param(
+            "endFrame",
+            "Last frame to include.  Default is the end of the dataset.",
+            paramType="query",
+            dataType="integer",
+            required=False,
+        )
+        .jsonParam(
+            "trackIds",
+            "List of track ids to include.  Default is every track.",
+            paramType="query",
+            required=False,
+            default=None,
+            requireArray=True,
         )
     )
-    def get_rle_mask(self, folder):
+    def get_rle_mask(self, folder, startFrame, endFrame, trackIds):
         crud.verify_dataset(folder)
-        return crud_annotation.get_mask_json(folder)
+        return crud_annotation.get_mask_json(folder, startFrame, endFrame, trackIds)
 
     @access.user
     @autoDescribeRoute(
@@ -265,10 +306,11 @@ class AnnotationResource(Resource):
             setContentDisposition(filename, mime='text/csv')
             return gen
         elif format == 'dive_json':
-            setContentDisposition(f'{folder["name"]}.dive.json', mime='application/json')
-            setRawResponse()
-            annotations = crud_annotation.get_annotations(folder, revision=revisionId)
-            return json.dumps(annotations).encode('utf-8')
+            filename, gen = crud_annotation.get_annotation_json_generator(
+                folder, revision=revisionId
+            )
+            setContentDisposition(filename, mime='application/json')
+            return gen
         elif format == 'masks':
             mask_folder = crud_annotation.get_mask_folder(folder)
             if mask_folder is None:
@@ -276,6 +318,8 @@ class AnnotationResource(Resource):
             else:
                 user = self.getCurrentUser()
                 mask_folder_id = str(mask_folder['_id'])
+                # RLE masks are stored by frame, the zip keeps the RLE_MASKS.json layout
+                crud_annotation.import_legacy_rle_masks(mask_folder)
 
                 def stream():
                     zip = ziputil.ZipGenerator()
@@ -288,6 +332,14 @@ class AnnotationResource(Resource):
                         except Exception as e:
                             # Optional: yield a log file or silently skip
                             raise RestException(f'Error adding file {path}: {e}')
+                    rle_masks = crud_annotation.MaskRleItem().legacy_json(
+                        {crud_annotation.DATASET: folder['_id']}
+                    )
+                    if rle_masks:
+                        yield from zip.addFile(
+                            lambda: [json.dumps(rle_masks).encode()],
+                            f'{doc["name"]}/RLE_MASKS.json',
+                        )
                     yield zip.footer()
 
                 setContentDisposition('masks.zip', mime='application/zip')
@@ -1,15 +1,21 @@
+import base64
 import csv
 from datetime import datetime
 import io
 import json
 import math
 import re
+import threading
+import traceback
+from typing import Callable
 
+from bson import json_util
+from bson.objectid import ObjectId
 import cherrypy
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.rest import Resource, getApiUrl, setRawResponse, setResponseHeader
-from girder.constants import AccessType
+from girder.constants import AccessType, SortDir
 from girder.exceptions import RestException
 from girder.models.file import File
 from girder.models.collection import Collection
@@ -18,13 +24,15 @@ from girder.models.item import Item
 from girder.models.setting import Setting
 from girder.models.token import Token
 from girder.models.upload import Upload
+from girder.models.user import User
 from girder.utility import path as path_util
+from girder_jobs.constants import JobStatus
 from girder_jobs.models.job import Job
 from girder_worker.girder_plugin.utils import getWorkerApiUrl
 from pandas import pandas as pd
 import pymongo
 
-from dive_utils import FALSY_META_VALUES, TRUTHY_META_VALUES, setContentDisposition
+from dive_utils import FALSY_META_VALUES, TRUTHY_META_VALUES, setContentDisposition, text_stream
 from dive_utils.constants import (
     DIVEMetadataClonedFilter,
     DIVEMetadataClonedFilterBase,
@@ -35,7 +43,17 @@ from dive_utils.constants import (
     jsonRegex,
     ndjsonRegex,
 )
-from dive_utils.metadata.models import DIVE_Metadata, DIVE_MetadataKeys
+from dive_utils.metadata.models import (
+    DIVE_Metadata,
+    DIVE_MetadataCounts,
+    DIVE_MetadataKeys,
+    custom_metadata_keys,
+    is_blank_metadata_value as _is_blank_metadata_value_for_stats,
+    metadata_search_tokens,
+    search_metadata_keys,
+    search_query_tokens,
+    stored_metadata_value,
+)
 from dive_utils.metadata.numeric import (
     categorical_values_for_schema,
     coerce_export_empty_strings,
@@ -63,10 +81,23 @@ _PROCESS_METADATA_FFPROBE_DEFAULT = {
 _EXPORT_INJECTED_FIELD_LOWERS = frozenset({'divedataset', 'filename', 'dive_url'})
 
 
-def _metadata_fieldnames_for_export(metadata_items):
-    """Sorted metadata keys excluding fields we emit as fixed leading columns."""
-    keys = {key for item in metadata_items for key in item.get('metadata', {}).keys()}
-    return sorted(k for k in keys if k.lower() not in _EXPORT_INJECTED_FIELD_LOWERS)
+# Rows buffered per chunk of a streamed metadata export
+METADATA_EXPORT_CHUNK_ROWS = 500
+
+
+def _metadata_fieldnames_for_export(metadata_keys):
+    """Sorted schema keys excluding fields we emit as fixed leading columns."""
+    return sorted(k for k in metadata_keys if k.lower() not in _EXPORT_INJECTED_FIELD_LOWERS)
+
+
+def _metadata_row_keys_pipeline(query: dict) -> list:
+    """Aggregation listing the distinct metadata keys of the rows matching query."""
+    return [
+        {'$match': query},
+        {'$project': {'keys': {'$objectToArray': {'$ifNull': ['$metadata', {}]}}}},
+        {'$unwind': '$keys'},
+        {'$group': {'_id': '$keys.k'}},
+    ]
 
 
 def _strip_injected_metadata_keys_copy(meta: dict):
@@ -78,6 +109,44 @@ def _strip_injected_metadata_keys_copy(meta: dict):
     return out
 
 
+def _metadata_export_row(item: dict, viewer_url: str) -> dict:
+    """
+    Export record of a DIVE_Metadata row: its metadata followed by the injected
+    DIVEDataset, Filename and DIVE_URL columns, with empty strings for missing values.
+    """
+    export_item = _strip_injected_metadata_keys_copy(item.get('metadata', {}))
+    export_item['DIVEDataset'] = str(item['DIVEDataset'])
+    export_item['Filename'] = item.get('filename', '')
+    # base_url/#/viewer/{dataset_id}?diveMetadataRootId={metadata_root_id}
+    export_item['DIVE_URL'] = f"{viewer_url}{item['DIVEDataset']}?diveMetadataRootId={item['root']}"
+    sanitize_value_tree_for_girder_json(export_item, minmax_keys_to_zero=False)
+    coerce_export_empty_strings(export_item)
+    return export_item
+
+
+def _stream_metadata_csv(items, meta_headers, viewer_url):
+    """Yield CSV text for rows as the cursor advances, METADATA_EXPORT_CHUNK_ROWS at a time."""
+    output = io.StringIO(newline='')
+    headers = ['DIVEDataset', 'Filename', 'DIVE_URL', *meta_headers]
+    writer = csv.DictWriter(output, fieldnames=headers, extrasaction='ignore', restval='')
+    writer.writeheader()
+    for index, item in enumerate(items, 1):
+        writer.writerow(_metadata_export_row(item, viewer_url))
+        if index % METADATA_EXPORT_CHUNK_ROWS == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+
+def _stream_metadata_json(items, viewer_url):
+    """Yield a JSON array of export records as the cursor advances."""
+    yield '['
+    for index, item in enumerate(items):
+        yield (', ' if index else '') + json.dumps(_metadata_export_row(item, viewer_url))
+    yield ']'
+
+
 def python_to_javascript_type(py_type):
     type_mapping = {
         int: "number",
@@ -93,35 +162,6 @@ def python_to_javascript_type(py_type):
     return type_mapping.get(py_type, "unknown")
 
 
-def _is_blank_metadata_value_for_stats(raw) -> bool:
-    """
-    True when a stored value should not contribute to count / set / range aggregates.
-
-    Skips nulls, NaN/inf placeholders, whitespace-only strings, empty containers, and
-    string-only lists/tuples where every string is empty or whitespace.
-    """
-    if raw is None:
-        return True
-    if is_nonfinite_numeric_placeholder(raw):
-        return True
-    if isinstance(raw, str):
-        return raw.strip() == ''
-    if isinstance(raw, (list, tuple)):
-        if len(raw) == 0:
-            return True
-        if any(not isinstance(el, str) for el in raw):
-            return False
-        return not any(
-            isinstance(el, str)
-            and el.strip() != ''
-            and not is_nonfinite_numeric_placeholder(el)
-            for el in raw
-        )
-    if isinstance(raw, dict):
-        return len(raw) == 0
-    return False
-
-
 def _accumulate_flat_metadata_key_stats(metadataKeys, flat_dict):
     """
     Merge one flat metadata dict into in-progress metadataKeys stats (same rules
@@ -166,7 +206,8 @@ def _finalize_metadata_keys_categories(metadataKeys, categorical_limit):
     """Assign categorical vs search vs numerical; JSON-safe sets and numerical ranges."""
     for key in metadataKeys.keys():
         bucket = metadataKeys[key]
-        bucket['unique'] = len(bucket['set'])
+        # unique may be precomputed when the set holds only the first categorical_limit values
+        bucket['unique'] = bucket.get('unique', len(bucket['set']))
         t = bucket['type']
         if t in ('string', 'array') and (
             bucket['unique'] < categorical_limit
@@ -334,6 +375,56 @@ def find_folder_by_path(folder, sibling_path, user):
     return current_folder
 
 
+# DIVE_Metadata rows written per bulk_write while processing a metadata file
+PROCESS_METADATA_WRITE_BATCH_SIZE = 1000
+
+
+def _index_dataset_folders_by_name(folder, user):
+    """
+    Map names to the readable dataset folders sharing the base parent of folder.
+
+    Entries are (order, folder) so merged lookups keep the order of a single find.
+    """
+    query = {
+        "meta.annotate": {'$in': TRUTHY_META_VALUES},
+        "baseParentId": folder['baseParentId'],
+    }
+    index = {}
+    for order, datasetFolder in enumerate(Folder().findWithPermissions(query=query, user=user)):
+        index.setdefault(datasetFolder['name'], []).append((order, datasetFolder))
+    return index
+
+
+def _matching_dataset_folders(index, value):
+    """Dataset folders named "Video {value}" or value"""
+    names = [f"Video {value}"]
+    if isinstance(value, str):
+        names.append(value)
+    candidates = sorted(
+        (entry for name in names for entry in index.get(name, [])), key=lambda entry: entry[0]
+    )
+    return [datasetFolder for _, datasetFolder in candidates]
+
+
+def _resource_path_resolver(user):
+    """
+    Get a function equivalent to getResourcePath for folders which caches
+    the paths of parent folders, as many datasets usually share a parent.
+    """
+    parent_paths = {}
+
+    def resolve(datasetFolder):
+        if datasetFolder['parentCollection'] != 'folder':
+            return path_util.getResourcePath('folder', datasetFolder, user=user)
+        parentId = datasetFolder['parentId']
+        if parentId not in parent_paths:
+            parent = Folder().load(parentId, user=user, level=AccessType.READ)
+            parent_paths[parentId] = path_util.getResourcePath('folder', parent, user=user)
+        return f"{parent_paths[parentId]}/{path_util.encode(datasetFolder['name'])}"
+
+    return resolve
+
+
 def _loads_metadata_import_json(s: str):
     """
     Parse JSON for metadata bulk / folder import.
@@ -344,9 +435,9 @@ def _loads_metadata_import_json(s: str):
     return json.loads(s, parse_constant=lambda _c: None)
 
 
-def load_ndjson_string(ndjson_string):
-    # Split the string into lines and parse each line as JSON
-    return [_loads_metadata_import_json(line) for line in ndjson_string.splitlines()]
+def load_ndjson_lines(lines):
+    """Parse each line of an iterable, such as a text stream, as JSON"""
+    return [_loads_metadata_import_json(line) for line in lines]
 
 
 def load_metadata_json(search_folder, type='ndjson'):
@@ -366,13 +457,12 @@ def load_metadata_json(search_folder, type='ndjson'):
         # Now lets convert the XML to TrackJSON
         if file is None:
             return None
-        file_generator = File().download(file, headers=False)()
-        file_string = b"".join(list(file_generator)).decode()
+        file_stream = text_stream(File().download(file, headers=False)())
         json_data = {}
         if type == 'json':
-            json_data = _loads_metadata_import_json(file_string)
+            json_data = _loads_metadata_import_json(file_stream.read())
         elif type == 'ndjson':
-            json_data = load_ndjson_string(file_string)
+            json_data = load_ndjson_lines(file_stream)
         # Now we determine data types from the array of data
         if not isinstance(json_data, list):
             print("JSON metadata isn't an array")
@@ -380,6 +470,221 @@ def load_metadata_json(search_folder, type='ndjson'):
         return json_data, file['name']
 
 
+def ingest_metadata(
+    folder,
+    user,
+    sibling_path,
+    fileType,
+    matcher,
+    path_key,
+    displayConfig,
+    ffprobeMetadata,
+    categoricalLimit,
+    additive,
+    progress: Callable[[int, int], None],
+):
+    """
+    Match the rows of the newest metadata file in a folder to the datasets under it
+    and save them as DIVE_Metadata.  Returns None if there is no metadata file to load.
+
+    :param progress: called with the number of rows handled and the total row count
+    """
+    # Delete existing data if it is there already:
+    rootQuery = {"root": str(folder["_id"])}
+    found = DIVE_Metadata().findOne(query=rootQuery, user=user)
+    if found and additive is not True:
+        DIVE_Metadata().removeWithQuery(rootQuery)
+        DIVE_MetadataKeys().removeWithQuery(rootQuery)
+        DIVE_MetadataCounts().removeWithQuery(rootQuery)
+        rootFolder = Folder().setMetadata(
+            folder, {DIVEMetadataMarker: None, DIVEMetadataFilter: None}
+        )
+        Folder().save(rootFolder)
+
+    # first determine the search folder for the system
+    search_folder = folder
+    if sibling_path:
+        found_folder = find_folder_by_path(folder, sibling_path, user)
+        if found_folder:
+            search_folder = found_folder
+    # lets first search for JSON files in the folder
+    data = None
+    errorLog = []
+    added = 0
+    dataFileName = ''
+    if fileType in ['json', 'ndjson']:
+        loaded = load_metadata_json(search_folder, fileType)
+        if loaded:
+            data, dataFileName = loaded
+    if not data:
+        return None
+    else:
+        metadataKeys = {}
+        root_name = folder['name']
+        key_import_descriptions = {}
+        # Preload everything a row can match rather than querying per row
+        datasetIndex = _index_dataset_folders_by_name(folder, user)
+        resolveResourcePath = _resource_path_resolver(user)
+        childFolders = list(Folder().childFolders(folder, 'folder', user=user))
+        metadataModel = DIVE_Metadata()
+        # Saving the keys below retokenizes the rows if the search keys change
+        searchKeys = DIVE_MetadataKeys().searchKeys(folder['_id'])
+        writes = []
+
+        def flush():
+            if writes:
+                # Ordered so a dataset matched by multiple rows keeps the last row
+                metadataModel.collection.bulk_write(writes, ordered=True)
+                DIVE_MetadataCounts().invalidate(folder['_id'])
+                writes.clear()
+
+        for handled, raw_row in enumerate(data):
+            item, row_desc = normalize_metadata_row_for_storage(raw_row)
+            merge_first_metadata_import_descriptions(key_import_descriptions, row_desc)
+            # need to use the matcher to try to find the DIVE dataset that matches the name
+            results = _matching_dataset_folders(datasetIndex, item[matcher])
+            if len(results) > 0:
+                matched = False
+                key_path = item.get(path_key, False)
+                base_modified_key_path = remove_before_folder(key_path, root_name)
+                modified_key_paths = [{"root": root_name, "modified_path": base_modified_key_path}]
+                for childFolder in childFolders:
+                    modified_key_paths.append(
+                        {
+                            "root": childFolder["name"],
+                            "modified_path": remove_before_folder(key_path, childFolder['name']),
+                        }
+                    )
+                resource_path = ""
+                for datasetFolder in results:
+                    resource_path = resolveResourcePath(datasetFolder)
+                    # lets modify the path so it contains only the root folder down
+                    for rootObj in modified_key_paths:
+                        root = rootObj['root']
+                        modified_path = rootObj['modified_path']
+                        if modified_path is None:
+                            continue
+                        resource_path = remove_before_folder(resource_path, root)
+                        if resource_path is None:
+                            continue
+                        resource_path = resource_path.replace(
+                            f'/Video {item[matcher]}', f'/{item[matcher]}'
+                        )
+                        # now we check to see if the path matches the DIVE dataset item found.
+                        if modified_path:
+                            if modified_path == resource_path:
+                                item['pathMatches'] = True
+                                # add in DIVE Keys:
+                                item['DIVE_DatasetId'] = str(datasetFolder['_id'])
+                                item['DIVE_Name'] = datasetFolder['lowerName']
+                                item['DIVE_Path'] = resource_path
+                                _ff_import = ffprobeMetadata.get('import', False)
+                                if isinstance(_ff_import, str):
+                                    _ff_import = _ff_import.strip().lower() in (
+                                        'true',
+                                        '1',
+                                        'yes',
+                                    )
+                                if _ff_import:  # Add in ffprobe metadata to the system
+                                    ffmetadata = datasetFolder.get('meta', {}).get(
+                                        'ffprobe_info', {}
+                                    )
+                                    ffkeys = ffprobeMetadata.get('keys', [])
+                                    if not isinstance(ffkeys, (list, tuple)):
+                                        ffkeys = []
+                                    for ffMetadataKey in ffkeys:
+                                        if ffmetadata.get(ffMetadataKey, False):
+                                            item[f'ffprobe_{ffMetadataKey}'] = ffmetadata.get(
+                                                ffMetadataKey, False
+                                            )
+                                sanitize_value_tree_for_girder_json(item, minmax_keys_to_zero=False)
+                                writes.append(
+                                    metadataModel.metadataUpsert(
+                                        datasetFolder, folder, user, item, search_keys=searchKeys
+                                    )
+                                )
+                                added += 1
+                                matched = True
+                                break
+                            else:
+                                item['pathMatches'] = False
+                    if matched:
+                        break
+
+                if not matched:
+                    errorLog.append(
+                        f"using matcher: {matcher} and key_path: {key_path} Could not find any matching key file path for Video file {item[matcher]} with path: {resource_path}"
+                    )
+
+            else:
+                errorLog.append(f"Could not find any results for Video file {item[matcher]}")
+            _accumulate_flat_metadata_key_stats(metadataKeys, item)
+            if len(writes) >= PROCESS_METADATA_WRITE_BATCH_SIZE:
+                flush()
+                progress(handled + 1, len(data))
+        flush()
+        progress(len(data), len(data))
+        # now we need to determine what is categorical vs what is a search field
+        _finalize_metadata_keys_categories(metadataKeys, categoricalLimit)
+        _apply_imported_descriptions_to_metadata_keys(metadataKeys, key_import_descriptions)
+        DIVE_MetadataKeys().createMetadataKeys(folder, user, metadataKeys)
+        # add metadata to root folder for
+        folder['meta'][DIVEMetadataMarker] = True
+        displayConfig['categoricalLimit'] = categoricalLimit
+        _ensure_filter_lists_in_display_config(displayConfig)
+        folder['meta'][DIVEMetadataFilter] = displayConfig
+        Folder().save(folder)
+
+    return {
+        "dataFileName": dataFileName,
+        "results": f"added {added} folders",
+        "errors": errorLog,
+        "metadataKeys": metadataKeys,
+    }
+
+
+def processMetadataJob(job):
+    """Run a process_metadata job on a thread, as local jobs are scheduled within the request"""
+    proc = threading.Thread(target=process_metadata_task, args=(job,), daemon=True)
+    proc.start()
+    return job, proc
+
+
+def process_metadata_task(job):
+    params = dict(job['kwargs']['params'])
+    user = User().load(params.pop('userId'), force=True)
+    folder = Folder().load(params.pop('folderId'), force=True)
+    job = Job().updateJob(
+        job,
+        log=f'Processing {params["fileType"]} metadata for {folder["name"]}\n',
+        status=JobStatus.RUNNING,
+    )
+
+    def progress(handled: int, total: int):
+        nonlocal job
+        job = Job().updateJob(job, progressCurrent=handled, progressTotal=total)
+
+    try:
+        result = ingest_metadata(folder, user, progress=progress, **params)
+    except Exception:
+        Job().updateJob(
+            job, log=f'Error processing metadata:\n{traceback.format_exc()}', status=JobStatus.ERROR
+        )
+        return
+    if result is None:
+        Job().updateJob(
+            job, log=f'No {params["fileType"]} metadata file was found\n', status=JobStatus.ERROR
+        )
+        return
+    errors = ''.join(f'{error}\n' for error in result['errors'])
+    Job().updateJob(
+        job,
+        log=f'{result["dataFileName"]}: {result["results"]}\n{errors}',
+        status=JobStatus.SUCCESS,
+        notify=True,
+    )
+
+
 _BULK_IMPORT_SKIP_KEYS = frozenset(
     {
         'divedataset',
@@ -391,11 +696,21 @@ _BULK_IMPORT_SKIP_KEYS = frozenset(
 )
 
 
+_METADATA_STATS_LOCKED_KEYS = (
+    'LastModifiedTime',
+    'LastModifiedBy',
+    'DIVEDataset',
+    'filename',
+    'DIVE_Path',
+)
+_METADATA_STATS_LOCKED_PREFIXES = ('DIVE_', 'ffprobe')
+
+
 def _metadata_schema_key_stats_refresh_is_locked(key: str) -> bool:
     """Keys whose schema buckets are managed separately; do not overwrite from DB scan."""
-    if key in ('LastModifiedTime', 'LastModifiedBy', 'DIVEDataset', 'filename', 'DIVE_Path'):
+    if key in _METADATA_STATS_LOCKED_KEYS:
         return True
-    if key.startswith('DIVE_') or key.startswith('ffprobe'):
+    if key.startswith(_METADATA_STATS_LOCKED_PREFIXES):
         return True
     return False
 
@@ -460,23 +775,200 @@ def _merge_recomputed_metadata_key_stats_into_existing(
     return out
 
 
-def refresh_metadata_keys_stats_from_stored_dive_metadata(root_folder, categorical_limit: int) -> None:
+_NONFINITE_DOUBLES = [float('nan'), float('inf'), float('-inf')]
+# BSON $type names mapped to python_to_javascript_type of the decoded python values
+_BSON_JAVASCRIPT_TYPES = {
+    'double': 'number',
+    'int': 'number',
+    'long': 'number',
+    'string': 'string',
+    'array': 'array',
+    'object': 'object',
+    'bool': 'boolean',
+}
+
+
+def _nonblank_string_elements(array):
+    """Aggregation expression for the non-blank string elements of an array"""
+    return {
+        '$filter': {
+            'input': array,
+            'as': 'el',
+            'cond': {
+                '$and': [
+                    {'$eq': [{'$type': '$$el'}, 'string']},
+                    {'$ne': [{'$trim': {'input': '$$el'}}, '']},
+                ]
+            },
+        }
+    }
+
+
+def _metadata_stats_values_pipeline(root_id: str) -> list:
+    """
+    Aggregation stages emitting a {k, v, t} document for every stored metadata value
+    of a root that is not locked and not blank per ``_is_blank_metadata_value_for_stats``.
+    """
+    is_blank = {
+        '$switch': {
+            'branches': [
+                {'case': {'$in': ['$t', ['null', 'undefined']]}, 'then': True},
+                {'case': {'$eq': ['$t', 'double']}, 'then': {'$in': ['$v', _NONFINITE_DOUBLES]}},
+                {
+                    'case': {'$eq': ['$t', 'string']},
+                    'then': {'$eq': [{'$trim': {'input': '$v'}}, '']},
+                },
+                {
+                    'case': {'$eq': ['$t', 'array']},
+                    'then': {
+                        '$or': [
+                            {'$eq': [{'$size': '$v'}, 0]},
+                            {
+                                '$and': [
+                                    {
+                                        '$allElementsTrue': [
+                                            {
+                                                '$map': {
+                                                    'input': '$v',
+                                                    'as': 'el',
+                                                    'in': {'$eq': [{'$type': '$$el'}, 'string']},
+                                                }
+                                            }
+                                        ]
+                                    },
+                                    {'$eq': [{'$size': _nonblank_string_elements('$v')}, 0]},
+                                ]
+                            },
+                        ]
+                    },
+                },
+                {'case': {'$eq': ['$t', 'object']}, 'then': {'$eq': ['$v', {}]}},
+            ],
+            'default': False,
+        }
+    }
+    locked_prefixes = '|'.join(re.escape(prefix) for prefix in _METADATA_STATS_LOCKED_PREFIXES)
+    return [
+        {'$match': {'root': root_id}},
+        {'$project': {'_id': 0, 'kv': {'$objectToArray': {'$ifNull': ['$metadata', {}]}}}},
+        {'$unwind': '$kv'},
+        {
+            '$match': {
+                'kv.k': {
+                    '$nin': list(_METADATA_STATS_LOCKED_KEYS),
+                    '$not': re.compile(f'^({locked_prefixes})'),
+                }
+            }
+        },
+        {'$project': {'k': '$kv.k', 'v': '$kv.v', 't': {'$type': '$kv.v'}}},
+        {'$match': {'$expr': {'$not': [is_blank]}}},
+    ]
+
+
+def _aggregate_metadata_key_stats(root_id: str, categorical_limit: int) -> dict:
+    """
+    Compute the same in-progress stats as ``_accumulate_flat_metadata_key_stats`` over every
+    ``DIVE_Metadata`` row of a root, using aggregations rather than reading each row.
+
+    A key's type comes from its first non-blank value in index order, as a find would return.
+    Sets are truncated to categorical_limit values, with the full size kept in ``unique``.
+    """
+    collection = DIVE_Metadata().collection
+    values = _metadata_stats_values_pipeline(root_id)
+    finite_number = {
+        '$let': {
+            'vars': {
+                'n': {
+                    '$cond': [
+                        {'$in': ['$t', ['double', 'int', 'long', 'string']]},
+                        {'$convert': {'input': '$v', 'to': 'double', 'onError': None}},
+                        None,
+                    ]
+                }
+            },
+            'in': {'$cond': [{'$in': ['$$n', [None, *_NONFINITE_DOUBLES]]}, None, '$$n']},
+        }
+    }
+    summary = {
+        '$group': {
+            '_id': '$k',
+            'type': {'$first': '$t'},
+            'scalarCount': {'$sum': {'$cond': [{'$in': ['$t', ['array', 'object']]}, 0, 1]}},
+            'arrayCount': {
+                '$sum': {
+                    '$cond': [
+                        {'$eq': ['$t', 'array']},
+                        {'$cond': [{'$gt': [{'$size': _nonblank_string_elements('$v')}, 0]}, 1, 0]},
+                        0,
+                    ]
+                }
+            },
+            'min': {'$min': finite_number},
+            'max': {'$max': finite_number},
+        }
+    }
+    accum: dict = {}
+    for key_stats in collection.aggregate([*values, summary], allowDiskUse=True):
+        typ = _BSON_JAVASCRIPT_TYPES.get(key_stats['type'], 'unknown')
+        bucket = {'type': typ, 'set': set(), 'count': 0}
+        if typ == 'string':
+            bucket['count'] = key_stats['scalarCount']
+            bucket['unique'] = 0
+        elif typ == 'array':
+            bucket['count'] = key_stats['arrayCount']
+            bucket['unique'] = 0
+        elif typ == 'number' and key_stats['min'] is not None:
+            bucket['range'] = {'min': key_stats['min'], 'max': key_stats['max']}
+        accum[key_stats['_id']] = bucket
+
+    string_keys = [key for key, bucket in accum.items() if bucket['type'] == 'string']
+    array_keys = [key for key, bucket in accum.items() if bucket['type'] == 'array']
+    if not string_keys and not array_keys:
+        return accum
+    distinct = [
+        {'$match': {'k': {'$in': string_keys + array_keys}}},
+        {
+            '$project': {
+                'k': 1,
+                'e': {
+                    '$cond': [
+                        {'$in': ['$k', array_keys]},
+                        {'$cond': [{'$eq': ['$t', 'array']}, _nonblank_string_elements('$v'), []]},
+                        {'$cond': [{'$in': ['$t', ['array', 'object']]}, [], ['$v']]},
+                    ]
+                },
+            }
+        },
+        {'$unwind': '$e'},
+        {'$group': {'_id': {'k': '$k', 'e': '$e'}}},
+    ]
+    for pair in collection.aggregate([*values, *distinct], allowDiskUse=True):
+        bucket = accum[pair['_id']['k']]
+        bucket['unique'] += 1
+        # Only sets below the limit are kept, so larger sets need not be held in memory
+        if len(bucket['set']) < categorical_limit:
+            bucket['set'].add(pair['_id']['e'])
+    return accum
+
+
+def refresh_metadata_keys_stats_from_stored_dive_metadata(
+    root_folder, categorical_limit: int, keys_doc=None
+) -> None:
     """
     Recompute aggregate fields on the metadata schema (count, type, unique, set/range,
     category) from all ``DIVE_Metadata`` rows for this root.
 
-    Used after bulk updates: ``updateKey`` / ``updateKeyValue`` only widen categorical
-    sets and numerical ranges and never maintain counts or ``type``/``unique`` like
-    ``process_metadata`` does.
+    Used after bulk updates, which write rows without going through ``updateKey``.
+    Keys are recounted from the stored rows the next time ``updateKey`` changes them.
+
+    :param keys_doc: the DIVE_MetadataKeys document to update and save, if already loaded
     """
     root_id = str(root_folder['_id'])
-    keys_doc = DIVE_MetadataKeys().findOne({'root': root_id})
+    if keys_doc is None:
+        keys_doc = DIVE_MetadataKeys().findOne({'root': root_id})
     if not keys_doc:
         return
-    accum: dict = {}
-    for row in DIVE_Metadata().find({'root': root_id}):
-        flat = _metadata_dict_for_schema_stats_refresh(row.get('metadata') or {})
-        _accumulate_flat_metadata_key_stats(accum, flat)
+    accum = _aggregate_metadata_key_stats(root_id, categorical_limit)
     _finalize_metadata_keys_categories(accum, categorical_limit)
     keys_doc['metadataKeys'] = _merge_recomputed_metadata_key_stats_into_existing(
         keys_doc['metadataKeys'],
@@ -485,6 +977,167 @@ def refresh_metadata_keys_stats_from_stored_dive_metadata(root_folder, categoric
     DIVE_MetadataKeys().save(keys_doc)
 
 
+# Default number of equal-width histogram bins and top values per key for metadata facets
+METADATA_FACET_BINS = 10
+METADATA_FACET_VALUE_LIMIT = 50
+
+
+def _metadata_facet_keys(metadata_keys: dict, keys=None) -> dict:
+    """Schema buckets of the keys that get facets: categorical, boolean and numerical keys."""
+    selected = {}
+    for key, bucket in metadata_keys.items():
+        if keys is not None and key not in keys:
+            continue
+        if not isinstance(bucket, dict):
+            continue
+        if bucket.get('category') in ('categorical', 'boolean', 'numerical'):
+            selected[key] = bucket
+    return selected
+
+
+def _metadata_facet_bins(bucket: dict, bins: int):
+    """Schema range and bin width of a numerical key; a zero width means a single bin."""
+    rng = bucket.get('range') or {}
+    lo = float(rng.get('min', 0.0))
+    hi = float(rng.get('max', 0.0))
+    return lo, hi, (hi - lo) / bins
+
+
+def _metadata_facets_pipeline(facet_keys: dict, bins: int, value_limit: int):
+    """
+    Build a ``$facet`` stage with the matching row count, the top value counts of each
+    categorical or boolean key, and an equal-width histogram over the schema range of each
+    numerical key.
+
+    :returns: the stage and the facet name of each key, as keys need not be valid field names
+    """
+    facets: dict = {'total': [{'$count': 'count'}]}
+    names = {}
+    for index, (key, bucket) in enumerate(facet_keys.items()):
+        name = f'f{index}'
+        names[key] = name
+        field = f'metadata.{key}'
+        if bucket['category'] == 'numerical':
+            lo, hi, width = _metadata_facet_bins(bucket, bins)
+            bin_index = 0
+            if width > 0:
+                bin_index = {
+                    '$min': [
+                        bins - 1,
+                        {'$floor': {'$divide': [{'$subtract': [f'${field}', lo]}, width]}},
+                    ]
+                }
+            facets[name] = [
+                {'$match': {field: {'$type': 'number', '$gte': lo, '$lte': hi}}},
+                {'$group': {'_id': bin_index, 'count': {'$sum': 1}}},
+            ]
+        else:
+            facets[name] = [
+                # Array values count once per element, as categorical filters match elements
+                {'$unwind': f'${field}'},
+                {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1, '_id': 1}},
+                {'$limit': value_limit},
+            ]
+    return {'$facet': facets}, names
+
+
+def _decode_metadata_facets(result: dict, facet_keys: dict, names: dict, bins: int) -> dict:
+    """Shape the output of ``_metadata_facets_pipeline`` for the API response."""
+    total = result.get('total') or [{'count': 0}]
+    facets = {}
+    for key, bucket in facet_keys.items():
+        rows = result.get(names[key], [])
+        if bucket['category'] == 'numerical':
+            lo, hi, width = _metadata_facet_bins(bucket, bins)
+            counts = {int(row['_id']): row['count'] for row in rows}
+            facets[key] = {
+                'category': 'numerical',
+                'range': {'min': lo, 'max': hi},
+                'histogram': [
+                    {
+                        'min': lo + index * width,
+                        'max': hi if index == bins - 1 or width == 0 else lo + (index + 1) * width,
+                        'count': counts.get(index, 0),
+                    }
+                    for index in range(bins if width > 0 else 1)
+                ],
+            }
+        else:
+            facets[key] = {
+                'category': bucket['category'],
+                'values': [{'value': row['_id'], 'count': row['count']} for row in rows],
+            }
+    return {'count': total[0]['count'], 'facets': facets}
+
+
+def _search_filter_query(field: str, key, text: str) -> dict:
+    """
+    Word-prefix search of text in a row field, narrowed by the (root, searchTokens) index.
+    The escaped substring regex keeps matches exact; rows stored before search tokens were
+    added fall back to it alone.
+
+    Words are runs of letters, digits and underscores, so this misses text inside a word,
+    e.g. 2024 in cam1_20240101. Filters only use it when they opt in with `prefix`.
+    """
+    substring = {field: {'$regex': re.escape(text)}}
+    tokens = search_query_tokens(key, text)
+    if not tokens:
+        return substring
+    indexed = {'$or': [{'searchTokens': {'$all': tokens}}, {'searchTokens': {'$exists': False}}]}
+    return {'$and': [indexed, substring]}
+
+
+def _sort_field_value(doc: dict, field: str):
+    """Value of a dotted sort field on a row, None when missing as in Mongo sort order."""
+    value = doc
+    for part in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+# Sort fields every row stores with one BSON type, which cursor range queries rely on
+FILTER_CURSOR_SORT_FIELDS = ('filename', 'created')
+
+
+def _encode_filter_cursor(doc: dict, field: str, direction: int) -> str:
+    """Opaque token resuming a filter after doc, for the sort it was listed with."""
+    state = {'sort': [field, direction], 'value': _sort_field_value(doc, field), 'id': doc['_id']}
+    return base64.urlsafe_b64encode(json_util.dumps(state).encode()).decode()
+
+
+def _decode_filter_cursor(token: str, field: str, direction: int):
+    try:
+        state = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+        value, last_id = state['value'], state['id']
+    except (ValueError, TypeError, KeyError):
+        raise RestException('Invalid filter cursor')
+    if state.get('sort') != [field, direction]:
+        raise RestException('The filter cursor was created for a different sort')
+    return value, last_id
+
+
+def _filter_cursor_query(field: str, direction: int, value, last_id) -> dict:
+    """
+    Rows after (value, last_id) in (field, _id) order. Missing and null values sort first.
+
+    $gt and $lt only match values of the same BSON type, so field must be one of
+    FILTER_CURSOR_SORT_FIELDS.
+    """
+    op = '$gt' if direction == SortDir.ASCENDING else '$lt'
+    tie = {field: value, '_id': {op: last_id}}
+    if value is None:
+        if direction == SortDir.ASCENDING:
+            return {'$or': [tie, {field: {'$ne': None}}]}
+        return tie
+    after = [{field: {op: value}}, tie]
+    if direction == SortDir.DESCENDING:
+        after.append({field: None})
+    return {'$or': after}
+
+
 _CREATE_METADATA_DISPLAY_DEFAULT = {
     "display": ['DIVE_DatasetId', 'DIVE_Name'],
     "hide": [""],
@@ -895,6 +1548,8 @@ def bulk_metadata_update_process(user, rootFolder, updates, replace=False):
                 if key not in new_keys:
                     new_keys[key] = set()
                 new_keys[key].add(value)
+    if new_keys and metadata_keys_doc['owner'] != str(user['_id']):
+        raise Exception('Only the Owner can modify key permissions')
     # Infer types/categories for new keys
     for key, values in new_keys.items():
         # CSV/partial rows often yield NaN for empty cells; min/max must stay JSON-finite.
@@ -913,7 +1568,38 @@ def bulk_metadata_update_process(user, rootFolder, updates, replace=False):
             info['set'] = categorical_values_for_schema(values)
         elif category == 'numerical':
             info['range'] = {'min': mm[0], 'max': mm[1]}
-        DIVE_MetadataKeys().addKey(rootFolder, user, key, info, unlocked=False)
+        metadata_keys_doc['metadataKeys'][key] = info
+
+    # Resolve every matcher with one query per matcher type
+    rootId = str(rootFolder["_id"])
+    dataset_ids = set()
+    video_names = set()
+    for entry in normalized_updates:
+        if entry.get('DIVEDataset', False):
+            dataset_ids.add(str(entry['DIVEDataset']))
+        elif entry.get('DIVE_DatasetId', False):
+            dataset_ids.add(str(entry['DIVE_DatasetId']))
+        elif entry.get('Filename', False):
+            video_names.add(str(entry['Filename']))
+    rows_by_dataset = {}
+    rows_by_filename = {}
+    if dataset_ids:
+        for row in DIVE_Metadata().find(
+            {'DIVEDataset': {'$in': list(dataset_ids)}, 'root': rootId}
+        ):
+            rows_by_dataset[row['DIVEDataset']] = row
+    if video_names:
+        for row in DIVE_Metadata().find({'filename': {'$in': list(video_names)}, 'root': rootId}):
+            # A row matched both ways must be updated through a single document
+            row = rows_by_dataset.setdefault(row['DIVEDataset'], row)
+            rows_by_filename.setdefault(row['filename'], []).append(row)
+    dataset_folders = {}
+    if rows_by_dataset:
+        datasetObjectIds = [ObjectId(datasetId) for datasetId in rows_by_dataset]
+        for dataset in Folder().find({'_id': {'$in': datasetObjectIds}}):
+            dataset_folders[str(dataset['_id'])] = dataset
+
+    updated_rows = {}
     for entry in normalized_updates:
         reason = None
         # Match order: DIVEDataset → DIVE_DatasetId → Filename (+ DIVE_Path if ambiguous)
@@ -931,19 +1617,11 @@ def bulk_metadata_update_process(user, rootFolder, updates, replace=False):
             video_name = entry['Filename']
             matcher = 'Filename'
         if dataset_id:
-            dive_metadata = DIVE_Metadata().findOne(
-                {"DIVEDataset": dataset_id, 'root': str(rootFolder["_id"])}
-            )
+            dive_metadata = rows_by_dataset.get(str(dataset_id))
             if not dive_metadata:
                 reason = f"No dataset found with id {dataset_id}"
         elif video_name:
-            # List matches once: the old code only set dive_metadata inside count() > 1, so a
-            # unique Filename never matched and every row looked like "not_found".
-            filename_matches = list(
-                DIVE_Metadata().find(
-                    {"filename": video_name, 'root': str(rootFolder["_id"])}
-                )
-            )
+            filename_matches = rows_by_filename.get(str(video_name), [])
             if len(filename_matches) == 0:
                 dive_metadata = None
             elif len(filename_matches) == 1:
@@ -968,31 +1646,36 @@ def bulk_metadata_update_process(user, rootFolder, updates, replace=False):
                 'Metadata Updates need DIVEDataset, DIVE_DatasetId, or Filename', code=400
             )
         if dive_metadata:
-            # Find the DIVE_Metadata entry for this dataset and root
-            dataset = Folder().load(dive_metadata['DIVEDataset'], level=AccessType.READ, user=user)
+            datasetId = dive_metadata['DIVEDataset']
+            dataset = dataset_folders.get(datasetId)
+            if dataset is None:
+                raise RestException(f'Dataset folder {datasetId} no longer exists', code=404)
+            Folder().requireAccess(dataset, user=user, level=AccessType.READ)
             updated_keys = []
             errors = []
             # initial pass for all metadata keys:
-            rootId = str(rootFolder["_id"])
             if replace:
-                DIVE_Metadata().removeCustomKeys(dataset, rootId, user)
+                for key in custom_metadata_keys(dive_metadata['metadata']):
+                    del dive_metadata['metadata'][key]
             for key, value in entry.items():
                 if _bulk_import_row_is_matcher_key(key):
                     continue
                 # Set the value for this key on the dataset
-                try:
-                    DIVE_Metadata().updateKey(
-                        dataset, rootId, user, key, value, categoricalLimit, force=True
-                    )
-                    updated_keys.append(key)
-                except Exception as ex:
-                    errors.append(f"Failed to set {key}: {str(ex)}")
+                key_info = metadata_keys_doc['metadataKeys'].get(key)
+                if key_info is None:
+                    errors.append(f"Failed to set {key}: Key: {key} is not in the metadata")
+                    continue
+                dive_metadata['metadata'][key] = stored_metadata_value(
+                    key_info['category'], value
+                )
+                updated_keys.append(key)
+            updated_rows[dive_metadata['_id']] = dive_metadata
             if updated_keys and not errors:
                 results.append(
                     {
                         "matcher": matcher,
                         "status": "success",
-                        "datasetId": str(dataset["_id"]),
+                        "datasetId": datasetId,
                         "updatedKeys": updated_keys,
                     }
                 )
@@ -1001,7 +1684,7 @@ def bulk_metadata_update_process(user, rootFolder, updates, replace=False):
                     {
                         "matcher": matcher,
                         "status": "partial_success",
-                        "datasetId": str(dataset["_id"]),
+                        "datasetId": datasetId,
                         "updatedKeys": updated_keys,
                         "errors": errors,
                     }
@@ -1011,7 +1694,7 @@ def bulk_metadata_update_process(user, rootFolder, updates, replace=False):
                     {
                         "matcher": matcher,
                         "status": "error",
-                        "datasetId": str(dataset["_id"]),
+                        "datasetId": datasetId,
                         "errors": errors,
                     }
                 )
@@ -1023,12 +1706,38 @@ def bulk_metadata_update_process(user, rootFolder, updates, replace=False):
                     "error": reason,
                 }
             )
-    if aggregated_descriptions:
-        DIVE_MetadataKeys().mergeImportedKeyDescriptions(
-            rootFolder, user, aggregated_descriptions
+    if updated_rows:
+        for row in updated_rows.values():
+            sanitize_value_tree_for_girder_json(row['metadata'], minmax_keys_to_zero=False)
+        search_keys = search_metadata_keys(metadata_keys_doc)
+        DIVE_Metadata().collection.bulk_write(
+            [
+                pymongo.UpdateOne(
+                    {'_id': _id},
+                    {
+                        '$set': {
+                            'metadata': row['metadata'],
+                            'searchTokens': metadata_search_tokens(
+                                row.get('filename'), row['metadata'], search_keys
+                            ),
+                        }
+                    },
+                )
+                for _id, row in updated_rows.items()
+            ],
+            ordered=False,
         )
+        DIVE_MetadataCounts().invalidate(rootFolder['_id'])
+    described = DIVE_MetadataKeys().applyImportedKeyDescriptions(
+        metadata_keys_doc, user, aggregated_descriptions
+    )
+    # The schema document is saved once, after its stats are recomputed from the updated rows
     if any(r.get('status') in ('success', 'partial_success') for r in results):
-        refresh_metadata_keys_stats_from_stored_dive_metadata(rootFolder, categoricalLimit)
+        refresh_metadata_keys_stats_from_stored_dive_metadata(
+            rootFolder, categoricalLimit, keys_doc=metadata_keys_doc
+        )
+    elif new_keys or described:
+        DIVE_MetadataKeys().save(metadata_keys_doc)
     return results
 
 
@@ -1053,6 +1762,7 @@ class DIVEMetadata(Resource):
         self.route("POST", (':id', "clone_filter"), self.clone_filter)
         self.route("GET", (':id', 'metadata_keys'), self.get_metadata_keys)
         self.route("GET", (':id', 'metadata_filter_values'), self.get_metadata_filter)
+        self.route("GET", (':id', 'facets'), self.get_metadata_facets)
         self.route(
             "DELETE",
             (
@@ -1160,8 +1870,6 @@ class DIVEMetadata(Resource):
         categoricalLimit,
         additive,
     ):
-        # Process the current folder for the specified fileType using the matcher to generate DIVE_Metadata
-        # make sure the folder is set to a DIVE Metadata folder using DIVE_METADATA = True
         user = self.getCurrentUser()
         displayConfig = _normalize_metadata_config(
             displayConfig, _PROCESS_METADATA_DISPLAY_DEFAULT
@@ -1169,150 +1877,31 @@ class DIVEMetadata(Resource):
         ffprobeMetadata = _normalize_metadata_config(
             ffprobeMetadata, _PROCESS_METADATA_FFPROBE_DEFAULT
         )
-        # Delete existing data if it is there already:
-        rootQuery = {"root": str(folder["_id"])}
-        found = DIVE_Metadata().findOne(query=rootQuery, user=user)
-        if found and additive is not True:
-            DIVE_Metadata().removeWithQuery(rootQuery)
-            DIVE_MetadataKeys().removeWithQuery(rootQuery)
-            rootFolder = Folder().setMetadata(
-                folder, {DIVEMetadataMarker: None, DIVEMetadataFilter: None}
-            )
-            Folder().save(rootFolder)
-
-        # first determine the search folder for the system
-        search_folder = folder
-        if sibling_path:
-            found_folder = find_folder_by_path(folder, sibling_path, user)
-            if found_folder:
-                search_folder = found_folder
-        # lets first search for JSON files in the folder
-        data = None
-        errorLog = []
-        added = 0
-        dataFileName = ''
-        if fileType in ['json', 'ndjson']:
-            data, dataFileName = load_metadata_json(search_folder, fileType)
-        if not data:
-            return False
-        else:
-            metadataKeys = {}
-            root_name = folder['name']
-            key_import_descriptions = {}
-            for raw_row in data:
-                item, row_desc = normalize_metadata_row_for_storage(raw_row)
-                merge_first_metadata_import_descriptions(key_import_descriptions, row_desc)
-                # need to use the matcher to try to find the DIVE dataset that matches the name
-
-                query = {
-                    '$and': [
-                        {'name': {'$in': [f"Video {item[matcher]}", item[matcher]]}},
-                        {"meta.annotate": {'$in': TRUTHY_META_VALUES}},
-                        {"baseParentId": folder['baseParentId']},
-                    ]
+        # Matching thousands of rows outlasts a request, so the import is run by a job
+        job = Job().createLocalJob(
+            module='dive_server.views_metadata',
+            function='processMetadataJob',
+            kwargs={
+                'params': {
+                    'folderId': str(folder['_id']),
+                    'userId': str(user['_id']),
+                    'sibling_path': sibling_path,
+                    'fileType': fileType,
+                    'matcher': matcher,
+                    'path_key': path_key,
+                    'displayConfig': displayConfig,
+                    'ffprobeMetadata': ffprobeMetadata,
+                    'categoricalLimit': categoricalLimit,
+                    'additive': additive,
                 }
-                results = list(Folder().findWithPermissions(query=query, user=user))
-                if len(results) > 0:
-                    matched = False
-                    key_path = item.get(path_key, False)
-                    base_modified_key_path = remove_before_folder(key_path, root_name)
-                    childFolders = list(Folder().childFolders(folder, 'folder', user=user))
-                    modified_key_paths = [
-                        {"root": root_name, "modified_path": base_modified_key_path}
-                    ]
-                    for childFolder in childFolders:
-                        modified_key_paths.append(
-                            {
-                                "root": childFolder["name"],
-                                "modified_path": remove_before_folder(
-                                    key_path, childFolder['name']
-                                ),
-                            }
-                        )
-                    resource_path = ""
-                    for datasetFolder in results:
-                        resource_path = path_util.getResourcePath(
-                            'folder', datasetFolder, user=user
-                        )
-                        # lets modify the path so it contains only the root folder down
-                        for rootObj in modified_key_paths:
-                            root = rootObj['root']
-                            modified_path = rootObj['modified_path']
-                            if modified_path is None:
-                                continue
-                            resource_path = remove_before_folder(resource_path, root)
-                            if resource_path is None:
-                                continue
-                            resource_path = resource_path.replace(
-                                f'/Video {item[matcher]}', f'/{item[matcher]}'
-                            )
-                            # now we check to see if the path matches the DIVE dataset item found.
-                            if modified_path:
-                                if modified_path == resource_path:
-                                    item['pathMatches'] = True
-                                    # add in DIVE Keys:
-                                    item['DIVE_DatasetId'] = str(datasetFolder['_id'])
-                                    item['DIVE_Name'] = datasetFolder['lowerName']
-                                    item['DIVE_Path'] = resource_path
-                                    datasetFolder.get('name')
-                                    _ff_import = ffprobeMetadata.get('import', False)
-                                    if isinstance(_ff_import, str):
-                                        _ff_import = _ff_import.strip().lower() in (
-                                            'true',
-                                            '1',
-                                            'yes',
-                                        )
-                                    if _ff_import:  # Add in ffprobe metadata to the system
-                                        ffmetadata = datasetFolder.get('meta', {}).get(
-                                            'ffprobe_info', {}
-                                        )
-                                        ffkeys = ffprobeMetadata.get('keys', [])
-                                        if not isinstance(ffkeys, (list, tuple)):
-                                            ffkeys = []
-                                        for ffMetadataKey in ffkeys:
-                                            if ffmetadata.get(ffMetadataKey, False):
-                                                item[f'ffprobe_{ffMetadataKey}'] = ffmetadata.get(
-                                                    ffMetadataKey, False
-                                                )
-                                    sanitize_value_tree_for_girder_json(
-                                        item, minmax_keys_to_zero=False
-                                    )
-                                    DIVE_Metadata().createMetadata(
-                                        datasetFolder, folder, user, item
-                                    )
-                                    added += 1
-                                    matched = True
-                                    break
-                                else:
-                                    item['pathMatches'] = False
-                        if matched:
-                            break
-
-                    if not matched:
-                        errorLog.append(
-                            f"using matcher: {matcher} and key_path: {key_path} Could not find any matching key file path for Video file {item[matcher]} with path: {resource_path}"
-                        )
-
-                else:
-                    errorLog.append(f"Could not find any results for Video file {item[matcher]}")
-                _accumulate_flat_metadata_key_stats(metadataKeys, item)
-            # now we need to determine what is categorical vs what is a search field
-            _finalize_metadata_keys_categories(metadataKeys, categoricalLimit)
-            _apply_imported_descriptions_to_metadata_keys(metadataKeys, key_import_descriptions)
-            DIVE_MetadataKeys().createMetadataKeys(folder, user, metadataKeys)
-            # add metadata to root folder for
-            folder['meta'][DIVEMetadataMarker] = True
-            displayConfig['categoricalLimit'] = categoricalLimit
-            _ensure_filter_lists_in_display_config(displayConfig)
-            folder['meta'][DIVEMetadataFilter] = displayConfig
-            Folder().save(folder)
-
-        return {
-            "dataFileName": dataFileName,
-            "results": f"added {added} folders",
-            "errors": errorLog,
-            "metadataKeys": metadataKeys,
-        }
+            },
+            title=f'Process DIVE Metadata for {folder["name"]}',
+            type='DIVE Metadata Process',
+            user=user,
+            asynchronous=True,
+        )
+        Job().scheduleJob(job)
+        return {'folderId': str(folder['_id']), 'jobId': str(job['_id'])}
 
     @access.user
     @autoDescribeRoute(
@@ -1808,9 +2397,10 @@ class DIVEMetadata(Resource):
             query=query,
             user=user,
         )
+        rebuilt = DIVE_MetadataKeys().rebuildStaleRanges(metadata_key)
         # NaN/inf in numerical ranges or categorical sets (common after partial CSV imports)
         # breaks json.dumps(allow_nan=False).
-        if sanitize_metadata_keys_doc_for_api(metadata_key):
+        if sanitize_metadata_keys_doc_for_api(metadata_key) or rebuilt:
             DIVE_MetadataKeys().save(metadata_key)
         if metadata_key.get('unlocked', False) is False:
             metadata_key['unlocked'] = []
@@ -1832,34 +2422,64 @@ class DIVEMetadata(Resource):
             required=False,
         )
         .pagingParams(defaultSort='filename')
+        .param(
+            "after",
+            "Opt in to cursor pagination: empty for the first page, then the 'next' token of "
+            "the previous page. Offset is ignored, and deep pages stay as fast as the first. "
+            "Only filename and created sorts are supported.",
+            required=False,
+        )
     )
-    def filter_folder(self, folder, filters, limit, offset, sort):
+    def filter_folder(self, folder, filters, limit, offset, sort, after=None):
         if folder['meta'].get(DIVEMetadataMarker, False) is False:
             raise RestException('Folder is not a DIVE Metadata folder', code=404)
 
         user = self.getCurrentUser()
         query = self.get_filter_query(folder, user, filters)
         total_query = self.get_filter_query(folder, user, {})
-        total_items = DIVE_Metadata().find(total_query).count()
-        metadata_items = DIVE_Metadata().find(
-            query, offset=offset, limit=limit, sort=sort, user=self.getCurrentUser()
-        )
-        if metadata_items is not None:
-            pages = math.ceil(metadata_items.count() / limit)
-            page_list = list(metadata_items)
-            # Dataset rows can contain pandas NaN in metadata (e.g. sparse CSV); Girder JSON forbids NaN.
-            for doc in page_list:
-                if sanitize_value_tree_for_girder_json(doc, minmax_keys_to_zero=False):
-                    DIVE_Metadata().save(doc)
-            structured_results = {
-                'totalPages': pages,
-                'pageResults': page_list,
-                'count': total_items,
-                'filtered': metadata_items.count(),
-            }
-            return structured_results
-
-        return metadata_items
+        total_items = DIVE_MetadataCounts().count(folder['_id'], total_query)
+        filtered_items = DIVE_MetadataCounts().count(folder['_id'], query)
+        next_cursor = None
+        fields = {'searchTokens': False}
+        if after is None:
+            page_list = list(
+                DIVE_Metadata().find(
+                    query, offset=offset, limit=limit, sort=sort, fields=fields, user=user
+                )
+            )
+        else:
+            field, direction = sort[0]
+            if field not in FILTER_CURSOR_SORT_FIELDS:
+                raise RestException(
+                    f'Cursor pagination can only sort by {", ".join(FILTER_CURSOR_SORT_FIELDS)}'
+                )
+            if after:
+                value, last_id = _decode_filter_cursor(after, field, direction)
+                query = {'$and': [query, _filter_cursor_query(field, direction, value, last_id)]}
+            # One extra row tells whether there is a next page
+            page_list = list(
+                DIVE_Metadata().find(
+                    query,
+                    limit=limit + 1,
+                    sort=[(field, direction), ('_id', direction)],
+                    fields=fields,
+                )
+            )
+            if len(page_list) > limit:
+                page_list = page_list[:limit]
+                next_cursor = _encode_filter_cursor(page_list[-1], field, direction)
+        # Rows are sanitized on write; this covers rows stored before that, without writing on read.
+        for doc in page_list:
+            sanitize_value_tree_for_girder_json(doc, minmax_keys_to_zero=False)
+        structured_results = {
+            'totalPages': math.ceil(filtered_items / limit) if limit else 1,
+            'pageResults': page_list,
+            'count': total_items,
+            'filtered': filtered_items,
+        }
+        if after is not None:
+            structured_results['next'] = next_cursor
+        return structured_results
 
     @access.user
     @autoDescribeRoute(
@@ -1878,7 +2498,7 @@ class DIVEMetadata(Resource):
             paramType="formData",
             description="Destination folder to clone into",
             model=Folder,
-            level=AccessType.READ,
+            level=AccessType.WRITE,
             required=True,
         )
         .jsonParam(
@@ -1898,7 +2518,12 @@ class DIVEMetadata(Resource):
 
         user = self.getCurrentUser()
         query = self.get_filter_query(baseFolder, user, filters)
-        metadata_items = DIVE_Metadata().find(query, user=self.getCurrentUser())
+        dataset_ids = [
+            str(item['DIVEDataset'])
+            for item in DIVE_Metadata().find(query, fields=['DIVEDataset'])
+        ]
+        if not dataset_ids:
+            raise RestException('Filter is empty can not clone', code=404)
         Folder().setMetadata(
             destFolder,
             {
@@ -1906,19 +2531,25 @@ class DIVEMetadata(Resource):
                 DIVEMetadataClonedFilterBase: baseFolder["_id"],
             },
         )
-        if metadata_items is not None:
-            for item in list(metadata_items):
-                item_folder = Folder().load(item['DIVEDataset'], level=AccessType.READ, user=user)
-                crud_dataset.createSoftClone(
-                    self.getCurrentUser(),
-                    item_folder,
-                    destFolder,
-                    item_folder['name'],
-                    None,
-                )
-            return str(destFolder['_id'])
-        else:
-            raise RestException('Filter is empty can not clone', code=404)
+        # Cloning thousands of datasets outlasts a request, so the clones are
+        # made by a job that reports progress and resumes if it is rescheduled
+        job = Job().createLocalJob(
+            module='dive_server.crud_dataset',
+            function='softCloneJob',
+            kwargs={
+                'params': {
+                    'datasetIds': dataset_ids,
+                    'destFolderId': str(destFolder['_id']),
+                    'userId': str(user['_id']),
+                }
+            },
+            title=f'Clone DIVE Metadata filter into {destFolder["name"]}',
+            type='DIVE Metadata Clone',
+            user=user,
+            asynchronous=True,
+        )
+        Job().scheduleJob(job)
+        return {'folderId': str(destFolder['_id']), 'jobId': str(job['_id'])}
 
     def get_filter_query(self, folder, user, filters):
         query = {'root': str(folder['_id'])}
@@ -1929,6 +2560,8 @@ class DIVEMetadata(Resource):
                     query["$and"].append(
                         {'filename': {'$regex': filters['search']}},
                     )
+                elif filters.get('searchPrefix', False) is True:
+                    query["$and"].append(_search_filter_query('filename', None, filters['search']))
                 else:
                     query["$and"].append(
                         {'filename': {'$regex': re.escape(filters['search'])}},
@@ -1936,6 +2569,7 @@ class DIVEMetadata(Resource):
             # Now we need to go through the other filters and create querys for them
             # each filter in metadataFilters will have a type associated with it
             if 'metadataFilters' in filters.keys():
+                search_keys = None
                 for key in filters['metadataFilters'].keys():
                     filter = filters['metadataFilters'][key]
                     if filter['category'] == 'categorical':
@@ -1957,6 +2591,15 @@ class DIVEMetadata(Resource):
                     if filter['category'] == 'search' and filter.get('value', False):
                         if filter.get('regEx', False) is True:
                             query["$and"].append({f'metadata.{key}': {'$regex': filter['value']}})
+                        elif filter.get('prefix', False) is True:
+                            if search_keys is None:
+                                search_keys = DIVE_MetadataKeys().searchKeys(folder['_id'])
+                            # Only the root's search keys have search tokens on the rows
+                            query["$and"].append(
+                                _search_filter_query(f'metadata.{key}', key, filter['value'])
+                                if key in search_keys
+                                else {f'metadata.{key}': {'$regex': re.escape(filter['value'])}}
+                            )
                         else:
                             query["$and"].append(
                                 {f'metadata.{key}': {'$regex': re.escape(filter['value'])}}
@@ -2016,6 +2659,64 @@ class DIVEMetadata(Resource):
         sanitize_value_tree_for_girder_json(results, minmax_keys_to_zero=False)
         return results
 
+    @access.user
+    @autoDescribeRoute(
+        Description("Get value counts and numeric histograms of the rows matching a filter")
+        .modelParam(
+            "id",
+            description="Base root Folder to filter on",
+            model=Folder,
+            level=AccessType.READ,
+        )
+        .jsonParam(
+            "filters",
+            "JSON Settings for the filtering",
+            required=False,
+        )
+        .jsonParam(
+            "keys",
+            "JSON keys to compute facets for in an array ['key1', 'key2'], defaults to every "
+            "categorical, boolean and numerical key",
+            required=False,
+        )
+        .param(
+            "bins",
+            "Number of equal-width histogram bins for numerical keys",
+            dataType="integer",
+            default=METADATA_FACET_BINS,
+            required=False,
+        )
+        .param(
+            "valueLimit",
+            "Maximum number of values counted for each categorical key, most frequent first",
+            dataType="integer",
+            default=METADATA_FACET_VALUE_LIMIT,
+            required=False,
+        )
+    )
+    def get_metadata_facets(self, folder, filters, keys, bins, valueLimit):
+        if folder['meta'].get(DIVEMetadataMarker, False) is False:
+            raise RestException('Folder is not a DIVE Metadata folder', code=404)
+        if bins < 1 or valueLimit < 1:
+            raise RestException('bins and valueLimit must be positive')
+        user = self.getCurrentUser()
+        metadata_keys = DIVE_MetadataKeys().findOne({'root': str(folder['_id'])})
+        if metadata_keys is None:
+            raise RestException(f'No metadata keys found for folder {folder["_id"]}', code=404)
+        # Histogram bins follow the schema ranges, which must be current
+        if DIVE_MetadataKeys().rebuildStaleRanges(metadata_keys):
+            DIVE_MetadataKeys().save(metadata_keys)
+        facet_keys = _metadata_facet_keys(metadata_keys['metadataKeys'], keys)
+        facet, names = _metadata_facets_pipeline(facet_keys, bins, valueLimit)
+        query = self.get_filter_query(folder, user, filters)
+        result = next(
+            DIVE_Metadata().collection.aggregate([{'$match': query}, facet], allowDiskUse=True),
+            {},
+        )
+        facets = _decode_metadata_facets(result, facet_keys, names, bins)
+        sanitize_value_tree_for_girder_json(facets, minmax_keys_to_zero=True)
+        return facets
+
     @access.user
     @autoDescribeRoute(
         Description("Delete Folder Metadata").modelParam(
@@ -2033,6 +2734,7 @@ class DIVEMetadata(Resource):
         if found:
             DIVE_Metadata().removeWithQuery(query)
             DIVE_MetadataKeys().removeWithQuery(query)
+            DIVE_MetadataCounts().removeWithQuery(query)
             root = Folder().setMetadata(root, {DIVEMetadataMarker: None, DIVEMetadataFilter: None})
             Folder().save(root)
         else:
@@ -2326,8 +3028,11 @@ class DIVEMetadata(Resource):
         }
         found = DIVE_Metadata().findOne(query=query, user=user)
         if found:
+            categoricalLimit = (
+                rootId['meta'].get(DIVEMetadataFilter, {}).get('categoricalLimit', 50)
+            )
             rootId = found['root']
-            DIVE_Metadata().deleteKey(divedataset, rootId, user, key)
+            DIVE_Metadata().deleteKey(divedataset, rootId, user, key, categoricalLimit)
         else:
             raise RestException(f'Could not find for FolderId: {divedataset["_id"]} to delete key.')
 
@@ -2452,70 +3157,35 @@ class DIVEMetadata(Resource):
 
         user = self.getCurrentUser()
         query = self.get_filter_query(folder, user, filters)
-        metadata_items = list(DIVE_Metadata().find(query, user=user))
-
-        filename = f"metadata_export.{format}"
-        if not metadata_items:
+        if DIVE_MetadataCounts().count(folder['_id'], query) == 0:
             raise RestException('No metadata items to export.')
+        metadata_items = DIVE_Metadata().find(query, fields={'searchTokens': False})
+        # Resolved while handling the request, as the response is streamed after it returns
+        viewer_url = f"{(baseURL or getApiUrl().replace('/api/v1', '')).rstrip('/')}/#/viewer/"
 
+        filename = f"metadata_export.{format}"
+        setRawResponse()
         if format == 'csv':
-            output = io.StringIO(newline='')
-            # Infer CSV headers from metadata keys, excluding columns we inject once (avoids duplicate Filename).
-            meta_headers = _metadata_fieldnames_for_export(metadata_items)
-            headers = ['DIVEDataset', 'Filename', 'DIVE_URL', *meta_headers]
-            writer = csv.DictWriter(output, fieldnames=headers, extrasaction='ignore')
-            writer.writeheader()
-            for item in metadata_items:
-
-                row = {key: item.get('metadata', {}).get(key, '') for key in meta_headers}
-                row['DIVEDataset'] = str(item['DIVEDataset'])
-                row['Filename'] = item.get('filename', '')
-                # generate the url for the dive metadata it should be of the format like
-                # base_url/#/viewer/{dataset_id}?diveMetadataRootId={metadata_root_id}
-                if baseURL:
-                    row['DIVE_URL'] = (
-                        f"{baseURL.rstrip('/')}/#/viewer/{item['DIVEDataset']}?"
-                        f"diveMetadataRootId={item['root']}"
-                    )
-                else:
-                    tempBaseURL = getApiUrl().replace('/api/v1', '')
-                    row['DIVE_URL'] = f"{tempBaseURL}/#/viewer/{item['DIVEDataset']}?diveMetadataRootId={item['root']}"
-                sanitize_value_tree_for_girder_json(row, minmax_keys_to_zero=False)
-                coerce_export_empty_strings(row)
-                writer.writerow(row)
-
-            csv_output = output.getvalue()
-            output.close()
-
-            setRawResponse()
+            # Headers are gathered by the database, so the rows are only read once as they are
+            # written. Row keys cover fields the schema leaves out, such as DIVE_Path.
+            metadata_keys = DIVE_MetadataKeys().findOne({'root': str(folder['_id'])}) or {}
+            row_keys = DIVE_Metadata().collection.aggregate(_metadata_row_keys_pipeline(query))
+            meta_headers = _metadata_fieldnames_for_export(
+                {*metadata_keys.get('metadataKeys', {}), *(row['_id'] for row in row_keys)}
+            )
             setContentDisposition(filename, mime='text/csv')
             setResponseHeader('Content-Type', 'text/csv')
-            return csv_output.encode('utf-8')
-
+            chunks = _stream_metadata_csv(metadata_items, meta_headers, viewer_url)
         else:  # JSON
-            export_data = []
-            for item in metadata_items:
-                export_item = _strip_injected_metadata_keys_copy(item.get('metadata', {}))
-                export_item['DIVEDataset'] = str(item['DIVEDataset'])
-                export_item['Filename'] = item.get('filename', '')
-                export_data.append(export_item)
-                # generate the url for the dive metadata it should be of the format like
-                # base_url/#/viewer/{dataset_id}?diveMetadataRootId={metadata_root_id}
-                if baseURL:
-                    export_item['DIVE_URL'] = (
-                        f"{baseURL.rstrip('/')}/#/viewer/{item['DIVEDataset']}?"
-                        f"diveMetadataRootId={item['root']}"
-                    )
-                else:
-                    tempBaseURL = getApiUrl().replace('/api/v1', '')
-                    export_item['DIVE_URL'] = f"{tempBaseURL}/#/viewer/{item['DIVEDataset']}?diveMetadataRootId={item['root']}"
-                sanitize_value_tree_for_girder_json(export_item, minmax_keys_to_zero=False)
-                coerce_export_empty_strings(export_item)
             setContentDisposition(filename, mime='application/json')
-            setRawResponse()
-
             setResponseHeader('Content-Type', 'application/json')
-            return json.dumps(export_data).encode('utf-8')
+            chunks = _stream_metadata_json(metadata_items, viewer_url)
+
+        def stream():
+            for chunk in chunks:
+                yield chunk.encode('utf-8')
+
+        return stream
 
     def bulk_metadata_process_file(self, user, rootFolder, updates, replace=False):
         query = self.get_filter_query(rootFolder, user, None)
@@ -2619,14 +3289,13 @@ class DIVEMetadata(Resource):
             file = next(Item().childFiles(item), None)
             if file is None:
                 raise RestException('No file found in the item to process.')
-            file_generator = File().download(file, headers=False)()
-            file_string = b"".join(list(file_generator)).decode()
+            file_stream = text_stream(File().download(file, headers=False)())
             if file['name'].endswith('.json'):  # standard json file
-                updates = _loads_metadata_import_json(file_string)
+                updates = _loads_metadata_import_json(file_stream.read())
             elif file['name'].endswith('.ndjson'):  # new line delimited json
-                updates = [_loads_metadata_import_json(line) for line in file_string.splitlines()]
+                updates = load_ndjson_lines(file_stream)
             elif file['name'].endswith('.csv'):  # use pandas for automatic type conversion
-                df = pd.read_csv(io.StringIO(file_string))
+                df = pd.read_csv(file_stream)
                 updates = df.to_dict(orient='records')
             Item().remove(item)
             results = self.bulk_metadata_process_file(user, rootFolder, updates, replace)
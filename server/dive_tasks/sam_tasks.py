@@ -18,7 +18,7 @@ from pycocotools import mask as mask_utils
 
 from dive_tasks import utils
 from dive_tasks.manager import patch_manager
-from dive_utils import asbool, constants
+from dive_utils import asbool, constants, masks
 
 
 def _sam2_mask_tracking_enabled(dive_config: dict) -> bool:
@@ -413,7 +413,7 @@ def process_masks_folder(
     maskLogic: Literal['replace', 'merge'] = 'merge',
 ):
     """
-    Upload mask images and RLE_MASKS.json file (if available or generate an empty one).
+    Upload mask images and RLE_MASKS.json file (if available or encode one from the images).
     """
     if maskLogic == 'replace':
         folders = list(gc.listFolder(folderId, 'folder', name=subfolder_name))
@@ -427,12 +427,10 @@ def process_masks_folder(
     # Create subfolder in Girder for masks
     rle_path = masks_path / 'RLE_MASKS.json'
     has_rle_mask = rle_path.exists()
+    # The server merges an uploaded RLE_MASKS.json into its per-frame RLE, have it take
+    # any earlier upload first so the new file does not replace those masks
+    gc.post('dive_annotation/rle_mask', parameters={'folderId': folderId, 'trackFrameList': '[]'})
     if has_rle_mask:
-        rle_masks = list(gc.listItem(masks_folder['_id'], name='RLE_MASKS.json'))
-        if len(rle_masks) > 0:
-            # Delete the existing RLE_MASKS.json file
-            gc.delete(f"item/{rle_masks[0]['_id']}")
-
         rle_item = gc.uploadFileToFolder(masks_folder['_id'], str(rle_path))
         gc.addMetadataToItem(
             rle_item['itemId'],
@@ -444,6 +442,8 @@ def process_masks_folder(
 
     # Upload all image files
     rle_masks_json = None
+    # Masks are encoded together once uploaded, serially in a worker, see encode_mask_pngs
+    encode_frames = []
     if not has_rle_mask:
         rle_masks_json = {}
     for track_dir in masks_path.iterdir():
@@ -486,33 +486,18 @@ def process_masks_folder(
                 },
             )
             if not has_rle_mask:
-                rle_masks_json[str(track_id)][str(frame_number)] = {
-                    'file_name': str(image_path),
-                    'rle': {},
-                }
-                # Create RLE for the image
-                image = Image.open(image_path)
-                np_img = np.array(image.convert('1'))
-                # COCO RLE expects Fortran order and uint8 data
-                rle = mask_utils.encode(np.asfortranarray(np_img.astype(np.uint8)))
-                # The counts value needs to be JSON serializable (i.e. a string)
-                rle['counts'] = rle['counts'].decode('utf-8')
-
-                rle_masks_json[str(track_id)][str(frame_number)]['rle'] = {
-                    "size": list(image.size),
-                    "counts": rle['counts'],
-                }
+                encode_frames.append((track_id, frame_number, image_path))
 
     # Handle RLE_MASKS.json
     if rle_masks_json is not None:
-        # Create empty RLE file
+        rles = masks.encode_mask_pngs([image_path for _, _, image_path in encode_frames])
+        for (track_id, frame_number, image_path), rle in zip(encode_frames, rles):
+            rle_masks_json[str(track_id)][str(frame_number)] = {
+                'file_name': image_path.name,
+                'rle': rle,
+            }
         with open(rle_path, 'w') as fp:
-            json.dump({}, fp)
-        rle_masks = list(gc.listItem(masks_folder['_id'], name='RLE_MASKS.json'))
-        if len(rle_masks) > 0:
-            # Delete the existing RLE_MASKS.json file
-            gc.delete(f"item/{rle_masks[0]['_id']}")
-
+            json.dump(rle_masks_json, fp)
         rle_item = gc.uploadFileToFolder(masks_folder['_id'], str(rle_path))
         gc.addMetadataToItem(
             rle_item['itemId'],
@@ -636,19 +621,12 @@ def run_inference(
         )
         for item in downloaded_tracks:
             track_data['tracks'][str(item['id'])] = item
+    # Only frames produced by this run, the server keeps the RLE of existing masks per frame
     rle_masks = {}
 
     mask_folder = gc.createFolder(
         datasetId, name='masks', reuseExisting=True, metadata={'mask': True}
     )
-    rle_mask_items = list(gc.listItem(mask_folder['_id'], name='RLE_MASKS.json'))
-    if len(rle_mask_items) > 0:
-        base_rle_mask_path = working_directory / 'RLE_MASKS/RLE_MASKS.json'
-        gc.downloadItem(rle_mask_items[0]['_id'], working_directory, name="RLE_MASKS")
-        with open(base_rle_mask_path, 'r') as f:
-            rle_masks = json.load(f)
-        # Delete the existing RLE_MASKS.json file
-        gc.delete(f"item/{rle_mask_items[0]['_id']}")
 
     # Target directory you want to link to
     GlobalHydra.instance().clear()
@@ -811,27 +789,13 @@ def update_annotation(
         gc.patch(
             '/dive_annotation', {"preventRevision": True, "folderId": datasetId}, json=patch_data
         )
-    # Now send a task update with a json structure of the ItemId and the new Track data to be added
-    if rle_masks_json is not None:
-        # Create empty RLE file
-        rle_path = output_dir / 'RLE_MASKS'
-        with open(rle_path, 'w') as fp:
-            json.dump(rle_masks_json, fp)
-        rle_masks = list(gc.listItem(mask_folder['_id'], name='RLE_MASKS.json'))
-        if len(rle_masks) > 0:
-            # Delete the existing RLE_MASKS.json file
-            gc.delete(f"item/{rle_masks[0]['_id']}")
-
-        rle_item = gc.uploadFileToFolder(
-            mask_folder['_id'], str(rle_path), filename="RLE_MASKS.json"
-        )
-        gc.addMetadataToItem(
-            rle_item['itemId'],
-            {
-                'description': 'Nested JSON with COCO RLE for all tracks and frames',
-                'RLE_MASK_FILE': True,
-            },
+    if item:
+        # Store the RLE of just this frame instead of rewriting RLE_MASKS.json
+        gc.post(
+            'dive_annotation/rle_mask',
+            parameters={'folderId': datasetId, 'trackFrameList': json.dumps([[trackId, frameId]])},
         )
+    # Now send a task update with a json structure of the ItemId and the new Track data to be added
     if item and track_obj:
         rle_data = rle_masks_json[str(trackId)][str(frameId)] if rle_masks_json else None
         rleMask = None
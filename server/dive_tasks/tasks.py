@@ -8,18 +8,15 @@ from typing import Dict, Literal
 import zipfile
 
 from GPUtil import getGPUs
-from PIL import Image
 from girder_client import GirderClient
 from girder_worker.app import app
 from girder_worker.task import Task
 from girder_worker.utils import JobManager, JobStatus
-import numpy as np
-from pycocotools import mask as mask_utils
 
 from dive_tasks import utils
 from dive_tasks.frame_alignment import check_and_fix_frame_alignment
 from dive_tasks.manager import patch_manager
-from dive_utils import constants, fromMeta, prevent_assetstore_transcoding
+from dive_utils import constants, fromMeta, masks, prevent_assetstore_transcoding
 from dive_utils.types import GirderModel
 
 
@@ -377,7 +374,7 @@ def process_masks_folder(
     maskLogic: Literal['replace', 'merge'] = 'replace',
 ):
     """
-    Upload mask images and RLE_MASKS.json file (if available or generate an empty one).
+    Upload mask images and RLE_MASKS.json file (if available or encode one from the images).
     """
     if maskLogic == 'replace':
         folders = list(gc.listFolder(folderId, 'folder', name=subfolder_name))
@@ -392,14 +389,11 @@ def process_masks_folder(
     # Create subfolder in Girder for masks
     rle_path = masks_path / 'RLE_MASKS.json'
     has_rle_mask = rle_path.exists()
+    # The server merges an uploaded RLE_MASKS.json into its per-frame RLE, have it take
+    # any earlier upload first so the new file does not replace those masks
+    gc.post('dive_annotation/rle_mask', parameters={'folderId': folderId, 'trackFrameList': '[]'})
     if has_rle_mask:
         manager.write("Found RLE_MASKS.json, uploading...\n")
-        rle_masks = list(gc.listItem(masks_folder['_id'], name='RLE_MASKS.json'))
-        if len(rle_masks) > 0:
-            # Delete the existing RLE_MASKS.json file
-            manager.write("Deleting existing RLE_MASKS.json\n")
-            gc.delete(f"item/{rle_masks[0]['_id']}")
-
         rle_item = gc.uploadFileToFolder(masks_folder['_id'], str(rle_path))
         gc.addMetadataToItem(
             rle_item['itemId'],
@@ -411,6 +405,8 @@ def process_masks_folder(
 
     # Upload all image files
     rle_masks_json = None
+    # Masks are encoded together once uploaded, serially in a worker, see encode_mask_pngs
+    encode_frames = []
     if not has_rle_mask:
         rle_masks_json = {}
     manager.write(f"Processing mask tracks...{masks_path}\n")
@@ -460,35 +456,19 @@ def process_masks_folder(
                 },
             )
             if not has_rle_mask:
-                rle_masks_json[str(track_id)][str(frame_number)] = {
-                    'file_name': str(image_path),
-                    'rle': {},
-                }
-                # Create RLE for the image
-                image = Image.open(image_path)
-                np_img = np.array(image.convert('1'))
-                # COCO RLE expects Fortran order and uint8 data
-                rle = mask_utils.encode(np.asfortranarray(np_img.astype(np.uint8)))
-                # The counts value needs to be JSON serializable (i.e. a string)
-                rle['counts'] = rle['counts'].decode('utf-8')
-
-                rle_masks_json[str(track_id)][str(frame_number)]['rle'] = {
-                    "size": list(image.size),
-                    "counts": rle['counts'],
-                }
+                encode_frames.append((track_id, frame_number, image_path))
 
     # Handle RLE_MASKS.json
     if rle_masks_json is not None:
-        # Create empty RLE file
+        rles = masks.encode_mask_pngs([image_path for _, _, image_path in encode_frames])
+        for (track_id, frame_number, image_path), rle in zip(encode_frames, rles):
+            rle_masks_json[str(track_id)][str(frame_number)] = {
+                'file_name': image_path.name,
+                'rle': rle,
+            }
         with open(rle_path, 'w') as fp:
-            json.dump({}, fp)
-        manager.write("Created empty RLE_MASKS.json\n")
-        rle_masks = list(gc.listItem(masks_folder['_id'], name='RLE_MASKS.json'))
-        if len(rle_masks) > 0:
-            # Delete the existing RLE_MASKS.json file
-            manager.write("Deleting existing RLE_MASKS.json\n")
-            gc.delete(f"item/{rle_masks[0]['_id']}")
-
+            json.dump(rle_masks_json, fp)
+        manager.write(f"Created RLE_MASKS.json for {len(rles)} masks\n")
         rle_item = gc.uploadFileToFolder(masks_folder['_id'], str(rle_path))
         gc.addMetadataToItem(
             rle_item['itemId'],
@@ -1,8 +1,9 @@
 """Utilities that are common to both the viame server and tasks package."""
 
+import io
 import itertools
 import re
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, Iterable, Iterator, List, Union
 import unicodedata
 
 from girder.api.rest import setResponseHeader
@@ -99,6 +100,37 @@ def slugify(value, allow_unicode=False):
     return re.sub(r'[-\s]+', '-', value)
 
 
+class _ByteChunkReader(io.RawIOBase):
+    """Raw binary stream reading sequentially from an iterable of byte chunks"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks: Iterator[bytes] = iter(chunks)
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not len(self._pending):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def text_stream(chunks: Iterable[bytes], encoding='utf-8') -> io.TextIOWrapper:
+    """
+    Decode an iterable of byte chunks, such as a Girder file download generator,
+    as a text stream without joining the chunks in memory.  Iterating the stream
+    yields lines split with universal newlines, regardless of chunk boundaries.
+    """
+    return io.TextIOWrapper(io.BufferedReader(_ByteChunkReader(chunks)), encoding=encoding)
+
+
 def setContentDisposition(filename: str, disposition='attachment', mime='application/json'):
     if disposition == 'attachment':
         setResponseHeader('Content-Type', mime)
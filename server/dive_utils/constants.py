@@ -76,6 +76,8 @@ PublishedMarker = "published"
 SharedMarker = "shared"
 ProcessedMarker = "processed"
 ForeignMediaIdMarker = "foreign_media_id"
+SoftCloneSourceMarker = "soft_clone_source_id"
+SoftClonePendingMarker = "soft_clone_pending"
 TrainedPipelineMarker = "trained_pipeline"
 TypeMarker = "type"
 AssetstoreSourceMarker = "import_source"
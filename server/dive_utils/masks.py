@@ -0,0 +1,149 @@
+"""Encoding of binary mask images as COCO RLE, shared by the server and tasks."""
+
+from concurrent.futures import ProcessPoolExecutor
+import io
+import multiprocessing
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Union
+
+from PIL import Image
+import numpy as np
+from pycocotools import mask as mask_utils
+
+# A path to a mask PNG on local disk, or the PNG contents
+MaskSource = Union[str, Path, bytes]
+
+# Worker processes used to encode many masks at once
+MASK_ENCODE_PROCESSES = min(8, os.cpu_count() or 1)
+# Masks sent to a worker per task, so each round trip amortizes pickling overhead
+MASK_ENCODE_CHUNK_SIZE = 64
+# Mask count below which worker startup outweighs parallel encoding
+MASK_ENCODE_POOL_MIN_MASKS = 256
+# Largest mask accepted as RLE, as rendering it decodes every pixel in memory (8K is 33M)
+MASK_RLE_MAX_PIXELS = 64 * 1024 * 1024
+
+
+def encode_mask_png(source: MaskSource) -> Dict:
+    """
+    Encode a mask image as COCO RLE.
+
+    Any nonzero pixel is part of the mask.  The counts value is decoded to a string
+    so that the result is JSON serializable.
+    """
+    image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    np_img = np.array(image.convert('1'))
+    # COCO RLE expects Fortran order and uint8 data
+    rle = mask_utils.encode(np.asfortranarray(np_img.astype(np.uint8)))
+    return {'size': [int(value) for value in rle['size']], 'counts': rle['counts'].decode('utf-8')}
+
+
+def _encode_chunk(sources: Sequence[MaskSource]) -> List[Dict]:
+    return [encode_mask_png(source) for source in sources]
+
+
+def encode_mask_pngs(sources: Sequence[MaskSource], processes: Optional[int] = None) -> List[Dict]:
+    """
+    Encode many mask images as COCO RLE, in a process pool when there are enough of them.
+
+    Paths are read by the workers themselves, so only file names cross the process
+    boundary for masks on local disk.
+
+    Daemonic processes cannot start children, so this always encodes serially inside
+    girder_worker tasks, whose prefork pool children are daemonic.  The pool is used
+    by the server, for example in update_RLE_masks, and by scripts.
+
+    :param sources: Mask image paths or contents.
+    :param processes: Worker count, defaulting to MASK_ENCODE_PROCESSES.  1 encodes serially.
+    :return: RLE dicts in the order of ``sources``.
+    """
+    if processes is None:
+        processes = MASK_ENCODE_PROCESSES
+    chunks = [
+        sources[start : start + MASK_ENCODE_CHUNK_SIZE]
+        for start in range(0, len(sources), MASK_ENCODE_CHUNK_SIZE)
+    ]
+    if (
+        processes <= 1
+        or len(chunks) <= 1
+        or len(sources) < MASK_ENCODE_POOL_MIN_MASKS
+        # Daemonic worker processes are not allowed to start children
+        or multiprocessing.current_process().daemon
+    ):
+        return _encode_chunk(sources)
+    with ProcessPoolExecutor(
+        max_workers=min(processes, len(chunks)),
+        # Forking a threaded server holding database connections is unsafe
+        mp_context=multiprocessing.get_context('spawn'),
+    ) as pool:
+        return [rle for encoded in pool.map(_encode_chunk, chunks) for rle in encoded]
+
+
+def rle_run_lengths(counts: str) -> List[int]:
+    """
+    Decode the run lengths of a compressed COCO RLE counts string.
+
+    This mirrors ``rleFrString`` in the COCO API, but rejects malformed input
+    instead of reading past the end of the string.
+    """
+    runs: List[int] = []
+    position = 0
+    while position < len(counts):
+        value = 0
+        shift = 0
+        more = True
+        while more:
+            if position >= len(counts):
+                raise ValueError('RLE counts end in the middle of a run')
+            char = ord(counts[position]) - 48
+            if not 0 <= char < 64:
+                raise ValueError('RLE counts contain an invalid character')
+            value |= (char & 0x1F) << shift
+            more = bool(char & 0x20)
+            position += 1
+            shift += 5
+            if not more and char & 0x10:
+                value |= -1 << shift
+        if len(runs) > 2:
+            value += runs[-2]
+        runs.append(value)
+    return runs
+
+
+def validate_mask_rle(rle: Dict, frame_size: Optional[Sequence[int]] = None) -> Dict:
+    """
+    Check that a client-computed COCO RLE describes a whole mask of its size.
+
+    :param frame_size: [height, width] of the dataset frames, if known.
+    :return: The RLE with only its size and counts.
+    :raises ValueError: If the size or counts are malformed or do not agree, or the
+        size is not the frame size or is larger than MASK_RLE_MAX_PIXELS.
+    """
+    size = rle.get('size')
+    counts = rle.get('counts')
+    if (
+        not isinstance(size, list)
+        or len(size) != 2
+        or not all(isinstance(value, int) and value > 0 for value in size)
+    ):
+        raise ValueError('RLE size must be [height, width] with positive integers')
+    if frame_size is not None and size != list(frame_size):
+        raise ValueError(f'RLE size {size} does not match the frame size {list(frame_size)}')
+    if size[0] * size[1] > MASK_RLE_MAX_PIXELS:
+        raise ValueError(f'RLE size {size} is larger than {MASK_RLE_MAX_PIXELS} pixels')
+    if not isinstance(counts, str):
+        raise ValueError('RLE counts must be a compressed COCO string')
+    runs = rle_run_lengths(counts)
+    if any(run < 0 for run in runs):
+        raise ValueError('RLE counts contain a negative run')
+    if sum(runs) != size[0] * size[1]:
+        raise ValueError('RLE counts do not cover a mask of the given size')
+    return {'size': size, 'counts': counts}
+
+
+def render_mask_png(rle: Dict) -> bytes:
+    """Render a COCO RLE as a black and white mask PNG."""
+    mask = mask_utils.decode({'size': rle['size'], 'counts': rle['counts'].encode('utf-8')})
+    output = io.BytesIO()
+    Image.fromarray(mask * 255).save(output, format='PNG')
+    return output.getvalue()
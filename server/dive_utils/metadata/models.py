@@ -1,18 +1,179 @@
+from collections import Counter
 import datetime
+import hashlib
 import math
+import re
+from typing import Iterable, Optional, Set
 
+from bson import json_util
 from dateutil import parser
-from girder import events
+from girder import events, logger
 from girder.constants import SortDir
 from girder.exceptions import ValidationException
+from girder.models.folder import Folder
 from girder.models.model_base import Model
+import pymongo
 
+from dive_utils.constants import DIVEMetadataFilter
 from dive_utils.metadata.numeric import (
+    as_finite_float_or_none,
     categorical_values_for_schema,
     is_nonfinite_numeric_placeholder,
     merge_numeric_sample_into_range_dict,
+    sanitize_value_tree_for_girder_json,
 )
 
+_NONFINITE_DOUBLES = [float('nan'), float('inf'), float('-inf')]
+# Words longer than this are indexed and searched by their prefix of this length
+SEARCH_TOKEN_PREFIX_LENGTH = 24
+# Filter queries whose counts are cached per root; the oldest are dropped past this
+METADATA_COUNTS_MAX_QUERIES = 200
+# Rows whose search tokens are rewritten per bulk write when a root's search keys change
+SEARCH_TOKENS_BATCH_SIZE = 1000
+_SEARCH_WORD = re.compile(r'\w+')
+
+
+def stored_metadata_value(category, value):
+    """
+    Value stored on a DIVE_Metadata row when setting a key of the given schema category.
+    Non-finite numbers and placeholders are stored as None.
+    """
+    if category == 'numerical':
+        try:
+            fv = float(value)
+        except (TypeError, ValueError):
+            fv = float('nan')
+        # Sparse CSV cells become NaN — never persist (breaks Girder JSON on filter/metadata APIs).
+        return fv if math.isfinite(fv) else None
+    if is_nonfinite_numeric_placeholder(value):
+        return None
+    return value
+
+
+def is_custom_metadata_key(key):
+    """Whether a metadata key is user data rather than a DIVE or ffprobe field"""
+    return (
+        key not in ['LastModifiedTime', 'LastModifiedBy', 'DIVEDataset', 'filename', 'DIVE_Path']
+        and not key.startswith('DIVE_')
+        and not key.startswith('ffprobe')
+    )
+
+
+def custom_metadata_keys(metadata):
+    """Keys of a DIVE_Metadata row that are user data rather than DIVE or ffprobe fields"""
+    return [key for key in metadata.keys() if is_custom_metadata_key(key)]
+
+
+def search_token(key, prefix):
+    """Search token of a word prefix in the filename (key None) or in a metadata key"""
+    if key is None:
+        return f'f:{prefix}'
+    return f'm:{key}:{prefix}'
+
+
+def search_query_tokens(key, text):
+    """
+    Tokens a row must have for text to be a word-prefix search match on the filename
+    (key None) or a metadata key: every word of text must start a word of the value.
+    """
+    return [
+        search_token(key, word[:SEARCH_TOKEN_PREFIX_LENGTH])
+        for word in _SEARCH_WORD.findall(text.lower())
+    ]
+
+
+def search_metadata_keys(keys_doc) -> Set[str]:
+    """Keys of a DIVE_MetadataKeys document in the search category"""
+    metadataKeys = (keys_doc or {}).get('metadataKeys') or {}
+    return {
+        key
+        for key, bucket in metadataKeys.items()
+        if isinstance(bucket, dict) and bucket.get('category') == 'search'
+    }
+
+
+def metadata_search_tokens(filename, metadata, search_keys: Iterable[str] = ()):
+    """
+    Lowercase prefixes of every word in the filename and the string values of the search
+    keys of a row, stored on the row so that search filters can use the (root, searchTokens)
+    index.  Only search keys are searched by word prefix, so other keys are not tokenized.
+    """
+    tokens = set()
+
+    def add(key, text):
+        for word in _SEARCH_WORD.findall(text.lower()):
+            for length in range(1, min(len(word), SEARCH_TOKEN_PREFIX_LENGTH) + 1):
+                tokens.add(search_token(key, word[:length]))
+
+    if isinstance(filename, str):
+        add(None, filename)
+    metadata = metadata or {}
+    for key in search_keys:
+        value = metadata.get(key)
+        for element in value if isinstance(value, list) else [value]:
+            if isinstance(element, str):
+                add(key, element)
+    return sorted(tokens)
+
+
+def is_blank_metadata_value(raw) -> bool:
+    """
+    True when a stored value should not contribute to count / set / range aggregates.
+
+    Skips nulls, NaN/inf placeholders, whitespace-only strings, empty containers, and
+    string-only lists/tuples where every string is empty or whitespace.
+    """
+    if raw is None:
+        return True
+    if is_nonfinite_numeric_placeholder(raw):
+        return True
+    if isinstance(raw, str):
+        return raw.strip() == ''
+    if isinstance(raw, (list, tuple)):
+        if len(raw) == 0:
+            return True
+        if any(not isinstance(el, str) for el in raw):
+            return False
+        return not any(
+            isinstance(el, str) and el.strip() != '' and not is_nonfinite_numeric_placeholder(el)
+            for el in raw
+        )
+    if isinstance(raw, dict):
+        return len(raw) == 0
+    return False
+
+
+def counted_metadata_values(array_key, value):
+    """
+    Values a row contributes to the occurrence counters of a categorical or search key:
+    the non-blank string elements for array keys, otherwise the scalar value itself.
+    """
+    if is_blank_metadata_value(value):
+        return []
+    if array_key:
+        if not isinstance(value, (list, tuple)):
+            return []
+        return [el for el in value if isinstance(el, str) and el.strip() != '']
+    if isinstance(value, (list, tuple, dict)):
+        return []
+    return [value]
+
+
+def categorize_counted_key(bucket, unique, values, categoricalLimit):
+    """Move a counted key between categorical and search as its unique values change."""
+    bucket['unique'] = unique
+    if unique < categoricalLimit:
+        bucket['category'] = 'categorical'
+        bucket['set'] = categorical_values_for_schema(values)
+    else:
+        bucket['category'] = 'search'
+        bucket.pop('set', None)
+
+
+def _metadata_field(key):
+    """Aggregation expression for a metadata key, which may contain dots or start with $"""
+    return {'$getField': {'field': {'$literal': key}, 'input': '$metadata'}}
+
 
 class DIVE_Metadata(Model):
     # This is NOT an access controlled model; it is expected that all endpoints
@@ -30,13 +191,43 @@ class DIVE_Metadata(Model):
         dive_dataset = self.findOne({'DIVEDataset': str(folderId)})
         if dive_dataset is not None:
             self.remove(dive_dataset)
+            self._removeValueStats(dive_dataset)
+
+    def _removeValueStats(self, row):
+        """Take the custom values of a removed row out of its root's key stats."""
+        metadataKeys = DIVE_MetadataKeys().findOne({'root': row['root']})
+        if not metadataKeys:
+            return
+        rootFolder = Folder().load(row['root'], force=True) or {}
+        categoricalLimit = (
+            rootFolder.get('meta', {}).get(DIVEMetadataFilter, {}).get('categoricalLimit', 50)
+        )
+        changes = {
+            key: (row['metadata'][key], None) for key in custom_metadata_keys(row['metadata'])
+        }
+        if DIVE_MetadataKeys().applyValueChanges(metadataKeys, changes, categoricalLimit):
+            DIVE_MetadataKeys().save(metadataKeys)
 
     def initialize(self):
         self.name = 'DIVE_Metadata'
         self.ensureIndices(
             [
-                'root',
                 'DIVEDataset',
+                # One row per dataset in each metadata root, also serves queries on root alone
+                (
+                    [('root', SortDir.ASCENDING), ('DIVEDataset', SortDir.ASCENDING)],
+                    {'unique': True},
+                ),
+                # The _id tie-breaker lets filter pages sorted by filename resume from a cursor
+                (
+                    [
+                        ('root', SortDir.ASCENDING),
+                        ('filename', SortDir.ASCENDING),
+                        ('_id', SortDir.ASCENDING),
+                    ],
+                    {},
+                ),
+                ([('root', SortDir.ASCENDING), ('searchTokens', SortDir.ASCENDING)], {}),
                 (
                     [
                         ('created', SortDir.ASCENDING),
@@ -46,6 +237,60 @@ class DIVE_Metadata(Model):
             ]
         )
 
+    def _createIndex(self, index):
+        try:
+            super()._createIndex(index)
+        except pymongo.errors.OperationFailure:
+            if not (isinstance(index, (list, tuple)) and index[1].get('unique')):
+                raise
+            # Rows duplicated before the index was unique are removed by `dive migrate`,
+            # until then a non-unique index keeps the model usable
+            logger.warning(
+                'DIVE_Metadata has duplicate rows, so index %s is not unique.'
+                ' Run `dive migrate` to remove them.',
+                index[0],
+            )
+            self.collection.create_index(index[0])
+
+    def save(self, document, *args, **kwargs):
+        document = super().save(document, *args, **kwargs)
+        DIVE_MetadataCounts().invalidate(document['root'])
+        return document
+
+    def remove(self, document, *args, **kwargs):
+        result = super().remove(document, *args, **kwargs)
+        DIVE_MetadataCounts().invalidate(document['root'])
+        return result
+
+    def _metadataUpdate(
+        self, folder, root, owner, metadata, created_date=None, replace=True, search_keys=None
+    ):
+        """
+        Get the (query, update) pair that upserts the row for folder in root.
+
+        :param search_keys: the root's search keys, looked up if None
+        """
+        if search_keys is None:
+            search_keys = DIVE_MetadataKeys().searchKeys(root['_id'])
+        # NaN is sanitized on write so that reads can return rows as stored
+        sanitize_value_tree_for_girder_json(metadata, minmax_keys_to_zero=False)
+        if created_date is None:
+            created = datetime.datetime.utcnow()
+        else:
+            created = parser.parse(created_date)
+        query = {'DIVEDataset': str(folder['_id']), 'root': str(root['_id'])}
+        fields = {
+            'metadata': metadata,
+            'filename': str(folder['name']),
+            'owner': str(owner['_id']),
+            'searchTokens': metadata_search_tokens(str(folder['name']), metadata, search_keys),
+        }
+        if replace:
+            update = {'$set': fields, '$setOnInsert': {'created': created}}
+        else:
+            update = {'$setOnInsert': {**fields, 'created': created}}
+        return query, update
+
     def createMetadata(
         self,
         folder,
@@ -55,38 +300,52 @@ class DIVE_Metadata(Model):
         created_date=None,
         replace=True,
     ):  # noqa: B006
-        existing = self.findOne({'DIVEDataset': str(folder['_id']), 'root': str(root['_id'])})
-        if existing and not replace:
-            return existing
-        if not existing:
-            if created_date is None:
-                created = datetime.datetime.utcnow()
-            else:
-                created = parser.parse(created_date)
+        query, update = self._metadataUpdate(folder, root, owner, metadata, created_date, replace)
+        # A single atomic upsert, so concurrent indexers cannot create duplicate rows
+        row = self.collection.find_one_and_update(
+            query, update, upsert=True, return_document=pymongo.ReturnDocument.AFTER
+        )
+        DIVE_MetadataCounts().invalidate(root['_id'])
+        return row
 
-            existing = dict(
-                DIVEDataset=str(folder['_id']),
-                filename=str(folder['name']),
-                root=str(root['_id']),
-                metadata=metadata,
-                created=created,
-                owner=str(owner['_id']),
-            )
-        else:
-            existing['metadata'] = metadata
-            existing['filename'] = str(folder['name'])
-            existing['root'] = str(root['_id'])
-            existing['owner'] = str(owner['_id'])
-        existing = self.save(existing)
-        return existing
+    def metadataUpsert(self, folder, root, owner, metadata, created_date=None, search_keys=None):
+        """
+        Build a bulk_write operation equivalent to createMetadata with replace=True.
+        The caller must invalidate the root's DIVE_MetadataCounts once it is written.
+        """
+        query, update = self._metadataUpdate(
+            folder, root, owner, metadata, created_date, search_keys=search_keys
+        )
+        return pymongo.UpdateOne(query, update, upsert=True)
 
     def validate(self, doc):
         if not doc.get('DIVEDataset') or not isinstance(doc['DIVEDataset'], str):
             raise ValidationException('DIVEDataset must be a string')
         if 'root' not in doc or not isinstance(doc['root'], str):
             raise ValidationException('root must be a string')
+        if isinstance(doc.get('metadata'), dict):
+            sanitize_value_tree_for_girder_json(doc['metadata'], minmax_keys_to_zero=False)
+            doc['searchTokens'] = metadata_search_tokens(
+                doc.get('filename'), doc['metadata'], DIVE_MetadataKeys().searchKeys(doc['root'])
+            )
         return doc
 
+    def updateSearchTokens(self, root, search_keys: Set[str]):
+        """Rewrite the search tokens of every row in root for a new set of search keys."""
+        root = str(root)
+        writes = []
+        for row in self.collection.find({'root': root}, {'filename': 1, 'metadata': 1}):
+            tokens = metadata_search_tokens(row.get('filename'), row.get('metadata'), search_keys)
+            writes.append(
+                pymongo.UpdateOne({'_id': row['_id']}, {'$set': {'searchTokens': tokens}})
+            )
+            if len(writes) >= SEARCH_TOKENS_BATCH_SIZE:
+                self.collection.bulk_write(writes, ordered=False)
+                writes = []
+        if writes:
+            self.collection.bulk_write(writes, ordered=False)
+        DIVE_MetadataCounts().invalidate(root)
+
     def updateKey(self, folder, root, owner, key, value, categoricalLimit=50, force=False):
         # root is the DIVE metadata *collection* folder id (string); folder is the dataset Girder folder.
         root_id = str(root)
@@ -131,32 +390,58 @@ class DIVE_Metadata(Model):
                 f'Key: {key} is not in the metadata only keys: {editable_keys} can be updated'
             )
         cat = metadataKeys['metadataKeys'][key]['category']
-        finite_num = None
-        non_num_stored = None
-        if cat == 'numerical':
-            try:
-                fv = float(value)
-            except (TypeError, ValueError):
-                fv = float('nan')
-            # Sparse CSV cells become NaN — never persist (breaks Girder JSON on filter/metadata APIs).
-            if math.isfinite(fv):
-                existing['metadata'][key] = fv
-                finite_num = fv
-            else:
-                existing['metadata'][key] = None
-        else:
-            non_num_stored = value
-            if is_nonfinite_numeric_placeholder(non_num_stored):
-                non_num_stored = None
-            existing['metadata'][key] = non_num_stored
+        stored = stored_metadata_value(cat, value)
+        previous = existing['metadata'].get(key)
+        existing['metadata'][key] = stored
         self.save(existing)
-        # now we need to update the metadataKey aggregate (skip non-finite numericals)
-        if cat == 'numerical' and finite_num is not None:
-            DIVE_MetadataKeys().updateKeyValue(existing['root'], owner, key, finite_num, categoricalLimit)
-        elif cat != 'numerical' and non_num_stored is not None:
-            DIVE_MetadataKeys().updateKeyValue(existing['root'], owner, key, non_num_stored, categoricalLimit)
+        # now we need to update the metadataKey aggregate
+        if is_custom_metadata_key(key):
+            if DIVE_MetadataKeys().applyValueChanges(
+                metadataKeys, {key: (previous, stored)}, categoricalLimit
+            ):
+                DIVE_MetadataKeys().save(metadataKeys)
+        elif stored is not None:
+            # skip non-finite numericals
+            DIVE_MetadataKeys().updateKeyValue(
+                existing['root'], owner, key, stored, categoricalLimit
+            )
+
+    def numericKeyStats(self, root, key):
+        """
+        Count, min and max of the finite numeric values of a key over the rows of a root.
 
-    def deleteKey(self, folder, root, owner, key):
+        :returns: a dict with count, min and max, or None when the key has no numeric values
+        """
+        pipeline = [
+            {'$match': {'root': str(root)}},
+            {
+                '$project': {
+                    'n': {
+                        '$convert': {'input': _metadata_field(key), 'to': 'double', 'onError': None}
+                    },
+                    't': {'$type': _metadata_field(key)},
+                }
+            },
+            {
+                '$match': {
+                    't': {'$in': ['double', 'int', 'long', 'string']},
+                    'n': {'$nin': [None, *_NONFINITE_DOUBLES]},
+                }
+            },
+            {
+                '$group': {
+                    '_id': None,
+                    'count': {'$sum': 1},
+                    'min': {'$min': '$n'},
+                    'max': {'$max': '$n'},
+                }
+            },
+        ]
+        for stats in self.collection.aggregate(pipeline):
+            return {'count': stats['count'], 'min': stats['min'], 'max': stats['max']}
+        return None
+
+    def deleteKey(self, folder, root, owner, key, categoricalLimit=50):
         root_id = str(root)
         existing = self.findOne({'DIVEDataset': str(folder['_id']), 'root': root_id})
         if not existing:
@@ -172,10 +457,14 @@ class DIVE_Metadata(Model):
                 f'(deleteKey context datasetId={folder["_id"]})'
             )
         if existing['metadata'].get(key, None) is not None:
-            del existing['metadata'][key]
+            previous = existing['metadata'].pop(key)
             self.save(existing)
+            if is_custom_metadata_key(key) and DIVE_MetadataKeys().applyValueChanges(
+                metadataKeys, {key: (previous, None)}, categoricalLimit
+            ):
+                DIVE_MetadataKeys().save(metadataKeys)
 
-    def removeCustomKeys(self, folder, root, owner):
+    def removeCustomKeys(self, folder, root, owner, categoricalLimit=50):
         # Must scope by root: the same dataset id must not be paired with another metadata collection's row.
         root_id = str(root)
         existing = self.findOne({'DIVEDataset': str(folder['_id']), 'root': root_id})
@@ -194,17 +483,12 @@ class DIVE_Metadata(Model):
                 f'No DIVE_MetadataKeys document for metadataRoot={query["root"]} and owner={owner["_id"]} '
                 f'(removeCustomKeys context datasetId={folder["_id"]})'
             )
-        keys_to_remove = [
-            key
-            for key in existing['metadata'].keys()
-            if key
-            not in ['LastModifiedTime', 'LastModifiedBy', 'DIVEDataset', 'filename', 'DIVE_Path']
-            and not key.startswith('DIVE_')
-            and not key.startswith('ffprobe')
-        ]
-        for key in keys_to_remove:
-            del existing['metadata'][key]
+        changes = {}
+        for key in custom_metadata_keys(existing['metadata']):
+            changes[key] = (existing['metadata'].pop(key), None)
         self.save(existing)
+        if DIVE_MetadataKeys().applyValueChanges(metadataKeys, changes, categoricalLimit):
+            DIVE_MetadataKeys().save(metadataKeys)
 
     def deleteKeys(self, root, owner, key):
         existing = self.find({'root': str(root['_id'])})
@@ -292,6 +576,21 @@ class DIVE_MetadataKeys(Model):
             raise ValidationException('owner must be a string')
         return doc
 
+    def save(self, document, *args, **kwargs):
+        previous: Optional[dict] = None
+        if '_id' in document:
+            previous = self.findOne({'_id': document['_id']}, fields=['metadataKeys'])
+        document = super().save(document, *args, **kwargs)
+        search_keys = search_metadata_keys(document)
+        if search_keys != search_metadata_keys(previous):
+            # Rows only carry search tokens for the search keys of their root
+            DIVE_Metadata().updateSearchTokens(document['root'], search_keys)
+        return document
+
+    def searchKeys(self, root) -> Set[str]:
+        """Keys of the rows of root that are in the search category"""
+        return search_metadata_keys(self.findOne({'root': str(root)}, fields=['metadataKeys']))
+
     def updateKeyDescription(self, folder, owner, key, description):
         existing = self.findOne({'root': str(folder['_id'])})
         if not existing:
@@ -316,6 +615,17 @@ class DIVE_MetadataKeys(Model):
         existing = self.findOne({'root': str(folder['_id'])})
         if not existing:
             return
+        if self.applyImportedKeyDescriptions(existing, owner, descriptions):
+            self.save(existing)
+
+    def applyImportedKeyDescriptions(self, existing, owner, descriptions):
+        """
+        Apply descriptions to a loaded metadata keys document without saving it.
+
+        :returns: whether any description changed
+        """
+        if not descriptions:
+            return False
         if owner['_id'] and existing['owner'] != str(owner['_id']):
             raise Exception('Only the Owner can modify key descriptions')
         changed = False
@@ -330,8 +640,7 @@ class DIVE_MetadataKeys(Model):
                 key_data['description'] = t
                 existing['metadataKeys'][key] = key_data
                 changed = True
-        if changed:
-            self.save(existing)
+        return changed
 
     def modifyKeyPermission(self, folder, owner, key, unlocked):
         existing = self.findOne({'root': str(folder['_id'])})
@@ -404,6 +713,7 @@ class DIVE_MetadataKeys(Model):
             if key in existing['metadataKeys'].keys():
                 del existing['metadataKeys'][key]
                 self.save(existing)
+                DIVE_MetadataValueCounts().removeKeys(existing['root'], [key])
             else:
                 raise Exception(f'Key: {key} not found in the current metdata')
 
@@ -434,6 +744,95 @@ class DIVE_MetadataKeys(Model):
                 if key in existing['metadataKeys'].keys():
                     del existing['metadataKeys'][key]
             self.save(existing)
+            DIVE_MetadataValueCounts().removeKeys(existing['root'], keys_to_remove)
+
+    def applyValueChanges(self, existing, changes, categoricalLimit):
+        """
+        Maintain the stats of custom keys in a loaded metadata keys document as one
+        DIVE_Metadata row changes, without saving it.
+
+        The row must already be saved: a key is seeded from the stored rows the first time
+        it changes, and is kept up to date incrementally from then on.
+
+        :param changes: {key: (old value, new value)}, with None for an absent value
+        :returns: whether the document changed
+        """
+        changed = False
+        for key, (old, new) in changes.items():
+            bucket = existing['metadataKeys'].get(key)
+            if bucket is None or old == new:
+                continue
+            category = bucket.get('category')
+            if category == 'numerical':
+                self._applyNumericChange(existing['root'], key, bucket, old, new)
+            elif category in ('categorical', 'search'):
+                self._applyCountedChange(existing['root'], key, bucket, old, new, categoricalLimit)
+            else:
+                continue
+            changed = True
+        return changed
+
+    def _applyNumericChange(self, root, key, bucket, old, new):
+        if not bucket.get('counted'):
+            stats = DIVE_Metadata().numericKeyStats(root, key)
+            bucket['count'] = 0 if stats is None else stats['count']
+            if stats is not None:
+                bucket['range'] = {'min': stats['min'], 'max': stats['max']}
+            bucket.pop('rangeStale', None)
+            bucket['counted'] = True
+            return
+        removed = as_finite_float_or_none(old)
+        added = as_finite_float_or_none(new)
+        rng = bucket.get('range')
+        if removed is not None:
+            bucket['count'] = max(bucket.get('count', 0) - 1, 0)
+            # The next extreme is only known after a rescan, which is deferred to the next read
+            if isinstance(rng, dict) and (
+                removed <= rng.get('min', removed) or removed >= rng.get('max', removed)
+            ):
+                bucket['rangeStale'] = True
+        if added is not None:
+            bucket['count'] = bucket.get('count', 0) + 1
+            if isinstance(rng, dict):
+                merge_numeric_sample_into_range_dict(rng, added)
+            else:
+                bucket['range'] = {'min': added, 'max': added}
+        if bucket['count'] == 0:
+            bucket.pop('rangeStale', None)
+
+    def _applyCountedChange(self, root, key, bucket, old, new, categoricalLimit):
+        counts = DIVE_MetadataValueCounts()
+        array_key = bucket.get('type') == 'array'
+        if bucket.get('counted'):
+            removed = counted_metadata_values(array_key, old)
+            added = counted_metadata_values(array_key, new)
+            delta = Counter(added)
+            delta.subtract(removed)
+            counts.applyDelta(root, key, delta)
+            bucket['count'] = max(bucket.get('count', 0) + bool(added) - bool(removed), 0)
+        else:
+            bucket['count'] = counts.rebuildKey(root, key, array_key)
+            bucket['counted'] = True
+        unique = counts.uniqueCount(root, key)
+        values = counts.values(root, key) if unique < categoricalLimit else []
+        categorize_counted_key(bucket, unique, values, categoricalLimit)
+
+    def rebuildStaleRanges(self, existing):
+        """
+        Rescan the numerical ranges whose extremes were removed since they were computed.
+
+        :returns: whether any range was rebuilt
+        """
+        changed = False
+        for key, bucket in existing['metadataKeys'].items():
+            if not isinstance(bucket, dict) or not bucket.pop('rangeStale', False):
+                continue
+            stats = DIVE_Metadata().numericKeyStats(existing['root'], key)
+            if stats is not None:
+                bucket['count'] = stats['count']
+                bucket['range'] = {'min': stats['min'], 'max': stats['max']}
+            changed = True
+        return changed
 
     def updateKeyValue(self, folderId, owner, key, value, categoricalLimit):
         existing = self.findOne({'root': folderId})
@@ -458,3 +857,208 @@ class DIVE_MetadataKeys(Model):
             merge_numeric_sample_into_range_dict(keyData['range'], value)
         existing['metadataKeys'][key] = keyData
         self.save(existing)
+
+
+class DIVE_MetadataValueCounts(Model):
+    """
+    Occurrences of each value of the categorical and search keys of a metadata root, so
+    their sets and unique counts follow row changes without rescanning every row.
+    """
+
+    def __init__(self):
+        events.bind('model.folder.remove', 'removeMetadataValueCounts', self._cleanupDeletedEntity)
+        super().__init__()
+
+    def _cleanupDeletedEntity(self, event):
+        self.collection.delete_many({'root': str(event.info['_id'])})
+
+    def initialize(self):
+        self.name = 'DIVE_MetadataValueCounts'
+        self.ensureIndices(
+            [
+                (
+                    [
+                        ('root', SortDir.ASCENDING),
+                        ('key', SortDir.ASCENDING),
+                        ('value', SortDir.ASCENDING),
+                    ],
+                    {'unique': True},
+                ),
+            ]
+        )
+
+    def validate(self, doc):
+        return doc
+
+    def applyDelta(self, root, key, delta):
+        """Apply a {value: change in occurrences} delta to the counters of a key."""
+        ops = [
+            pymongo.UpdateOne(
+                {'root': str(root), 'key': key, 'value': value},
+                {'$inc': {'count': change}},
+                upsert=True,
+            )
+            for value, change in delta.items()
+            if change
+        ]
+        if not ops:
+            return
+        self.collection.bulk_write(ops, ordered=False)
+        if any(change < 0 for change in delta.values()):
+            self.collection.delete_many({'root': str(root), 'key': key, 'count': {'$lte': 0}})
+
+    def removeKeys(self, root, keys):
+        self.collection.delete_many({'root': str(root), 'key': {'$in': list(keys)}})
+
+    def uniqueCount(self, root, key):
+        return self.collection.count_documents({'root': str(root), 'key': key})
+
+    def values(self, root, key):
+        return [
+            doc['value'] for doc in self.find({'root': str(root), 'key': key}, fields=['value'])
+        ]
+
+    def rebuildKey(self, root, key, array_key):
+        """
+        Recount the values of a key over the stored DIVE_Metadata rows of a root,
+        with the same rules as ``counted_metadata_values``.
+
+        :returns: the number of rows with a counted value
+        """
+        self.removeKeys(root, [key])
+        value = _metadata_field(key)
+        value_type = {'$type': value}
+        if array_key:
+            elements = {
+                '$cond': [
+                    {'$eq': [value_type, 'array']},
+                    {
+                        '$filter': {
+                            'input': value,
+                            'cond': {
+                                '$and': [
+                                    {'$eq': [{'$type': '$$this'}, 'string']},
+                                    {'$ne': [{'$trim': {'input': '$$this'}}, '']},
+                                ]
+                            },
+                        }
+                    },
+                    [],
+                ]
+            }
+        else:
+            elements = {
+                '$switch': {
+                    'branches': [
+                        {
+                            'case': {'$in': [value_type, ['missing', 'null', 'array', 'object']]},
+                            'then': [],
+                        },
+                        {
+                            'case': {'$eq': [value_type, 'string']},
+                            'then': {
+                                '$cond': [{'$eq': [{'$trim': {'input': value}}, '']}, [], [value]]
+                            },
+                        },
+                        {'case': {'$in': [value, _NONFINITE_DOUBLES]}, 'then': []},
+                    ],
+                    'default': [value],
+                }
+            }
+        counted_rows = [
+            {'$match': {'root': str(root)}},
+            {'$project': {'_id': 0, 'e': elements}},
+            {'$match': {'e.0': {'$exists': True}}},
+        ]
+        metadata = DIVE_Metadata().collection
+        metadata.aggregate(
+            [
+                *counted_rows,
+                {'$unwind': '$e'},
+                {'$group': {'_id': '$e', 'count': {'$sum': 1}}},
+                {
+                    '$project': {
+                        '_id': 0,
+                        'root': {'$literal': str(root)},
+                        'key': {'$literal': key},
+                        'value': '$_id',
+                        'count': 1,
+                    }
+                },
+                {
+                    '$merge': {
+                        'into': self.name,
+                        'on': ['root', 'key', 'value'],
+                        'whenMatched': 'replace',
+                        'whenNotMatched': 'insert',
+                    }
+                },
+            ],
+            allowDiskUse=True,
+        )
+        for result in metadata.aggregate([*counted_rows, {'$count': 'rows'}]):
+            return result['rows']
+        return 0
+
+
+class DIVE_MetadataCounts(Model):
+    """
+    Cached numbers of DIVE_Metadata rows matching filter queries, one document per root.
+
+    Every write to a root's rows bumps its generation and drops the cached counts. A count
+    is only cached if the generation it was computed under is still current, and only the
+    last METADATA_COUNTS_MAX_QUERIES queries are kept.
+    """
+
+    def __init__(self):
+        events.bind('model.folder.remove', 'removeMetadataCounts', self._cleanupDeletedEntity)
+        super().__init__()
+
+    def _cleanupDeletedEntity(self, event):
+        self.collection.delete_many({'root': str(event.info['_id'])})
+
+    def initialize(self):
+        self.name = 'DIVE_MetadataCounts'
+        self.ensureIndices([(['root'], {'unique': True})])
+
+    def validate(self, doc):
+        return doc
+
+    def invalidate(self, root):
+        self.collection.update_one(
+            {'root': str(root)},
+            {'$inc': {'generation': 1}, '$unset': {'counts': ''}},
+            upsert=True,
+        )
+
+    def count(self, root, query):
+        """Get the number of DIVE_Metadata rows matching query, a query on rows of root."""
+        root = str(root)
+        digest = hashlib.sha1(json_util.dumps(query, sort_keys=True).encode()).hexdigest()
+        cached = self.collection.find_one(
+            {'root': root}, {'generation': 1, 'counts': {'$elemMatch': {'digest': digest}}}
+        )
+        if cached and cached.get('counts'):
+            return cached['counts'][0]['count']
+        count = DIVE_Metadata().collection.count_documents(query)
+        entry = {'digest': digest, 'count': count}
+        try:
+            if cached is None:
+                self.collection.update_one(
+                    {'root': root},
+                    {'$setOnInsert': {'generation': 0, 'counts': [entry]}},
+                    upsert=True,
+                )
+            else:
+                self.collection.update_one(
+                    {'root': root, 'generation': cached.get('generation')},
+                    {
+                        '$push': {
+                            'counts': {'$each': [entry], '$slice': -METADATA_COUNTS_MAX_QUERIES}
+                        }
+                    },
+                )
+        except pymongo.errors.DuplicateKeyError:
+            # Another request created the document first; the count is simply not cached
+            pass
+        return count
@@ -1,8 +1,10 @@
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar, Union
 
 from bson.objectid import ObjectId
+import numpy as np
 from pydantic import BaseModel, Field, validator
+from pydantic.fields import SHAPE_DICT, SHAPE_LIST, SHAPE_SINGLETON
 from typing_extensions import Literal
 
 from dive_utils import constants
@@ -111,12 +113,29 @@ class TrackItemSchema(Track):
     dataset: PydanticObjectId
     rev_created: int = 0
     rev_deleted: Optional[int]
+    rev_head: Optional[bool]
 
 
 class GroupItemSchema(Group):
     dataset: PydanticObjectId
     rev_created: int = 0
     rev_deleted: Optional[int]
+    rev_head: Optional[bool]
+
+
+class MaskRle(BaseModel):
+    """COCO RLE of a binary mask, with counts in the compressed string form"""
+
+    size: List[int]
+    counts: str
+
+
+class MaskRleItemSchema(BaseModel):
+    dataset: PydanticObjectId
+    track: int
+    frame: int
+    rle: MaskRle
+    file_name: Optional[str]
 
 
 class RevisionLog(BaseModel):
@@ -705,6 +724,49 @@ class DIVESystemConfig(BaseModel):
     AssetstoreImportSettings: Optional[AssetstoreImportSettings]
 
 
+TrustedModel = TypeVar('TrustedModel', bound=BaseModel)
+
+
+def construct_trusted(model: Type[TrustedModel], values: dict) -> TrustedModel:
+    """
+    Build a model without validation from data that was validated when it was written,
+    such as annotations read back from Mongo.  Nested models are constructed recursively
+    and unknown keys are dropped, so .dict() matches the validated model for such data.
+    """
+    fields = {}
+    for name, field in model.__fields__.items():
+        if name not in values:
+            continue
+        value = values[name]
+        if (
+            value is not None
+            and isinstance(field.type_, type)
+            and issubclass(field.type_, BaseModel)
+        ):
+            if field.shape == SHAPE_SINGLETON:
+                value = construct_trusted(field.type_, value)
+            elif field.shape == SHAPE_LIST:
+                value = [construct_trusted(field.type_, v) for v in value]
+            elif field.shape == SHAPE_DICT:
+                value = {k: construct_trusted(field.type_, v) for k, v in value.items()}
+        fields[name] = value
+    return model.construct(**fields)
+
+
+def dict_trusted(model: Type[BaseModel], values: dict) -> dict:
+    """
+    Equivalent of model(**values).dict(exclude_none=True) for data that was stored from
+    such a dict, such as annotations read back from Mongo.
+
+    Only top-level unknown keys and None values are dropped.  Nested values are returned
+    as stored, so documents written by other means with None inside nested models, such
+    as features, differ from the validated output there.
+    """
+    return {
+        key: value for key, value in values.items() if key in model.__fields__ and value is not None
+    }
+
+
 # interpolate all features [a, b)
 def interpolate(a: Feature, b: Feature) -> List[Feature]:
     if a.interpolate is False:
@@ -722,3 +784,23 @@ def interpolate(a: Feature, b: Feature) -> List[Feature]:
         ]
         feature_list.append(Feature(frame=a.frame + frame, bounds=bounds, keyframe=False))
     return feature_list
+
+
+def interpolate_bounds(a: Feature, b: Feature) -> Tuple[List[int], List[List[int]]]:
+    """
+    Vectorized equivalent of interpolate() for frames (a, b) exclusive,
+    returning only the frame numbers and bounds rather than Feature objects.
+    """
+    if a.interpolate is False:
+        raise ValueError('Cannot interpolate feature without interpolate enabled')
+    if b.frame <= a.frame:
+        raise ValueError('b.frame must be larger than a.frame')
+    frame_range = b.frame - a.frame
+    frames = np.arange(1, frame_range)
+    delta = (frames / frame_range)[:, np.newaxis]
+    inverse_delta = 1 - delta
+    abox = np.array(a.bounds, dtype=np.float64)
+    bbox = np.array(b.bounds, dtype=np.float64)
+    # np.round rounds half to even, matching the builtin round() used by interpolate()
+    bounds = np.round((abox * inverse_delta) + (bbox * delta)).astype(np.int64)
+    return (frames + a.frame).tolist(), bounds.tolist()
@@ -1,4 +1,5 @@
-from typing import Any
+import json
+from typing import Any, Generator, Iterable, Type
 
 from dive_utils import constants, models, types
 
@@ -32,3 +33,32 @@ def migrate(jsonData: Any) -> types.DIVEAnnotationSchema:
             }
         )
     raise ValueError(f'Version unknown: {version}')
+
+
+def _export_annotation_map(
+    annotations: Iterable[dict], model: Type[models.BaseAnnotation], trusted: bool
+) -> Generator[str, None, None]:
+    separator = ''
+    for annotation in annotations:
+        if trusted:
+            serialized = models.dict_trusted(model, annotation)
+        else:
+            serialized = model(**annotation).dict(exclude_none=True)
+        yield f'{separator}{json.dumps(str(serialized["id"]))}: {json.dumps(serialized)}'
+        separator = ', '
+
+
+def export_annotations_json(
+    tracks: Iterable[dict], groups: Iterable[dict], trusted=False
+) -> Generator[str, None, None]:
+    """
+    Stream a DIVE json annotation file one annotation at a time.
+    Output matches json.dumps of the equivalent DIVEAnnotationSchema dict.
+
+    :param trusted: skip validation for annotations that were validated when stored
+    """
+    yield '{"tracks": {'
+    yield from _export_annotation_map(tracks, models.Track, trusted)
+    yield '}, "groups": {'
+    yield from _export_annotation_map(groups, models.Group, trusted)
+    yield f'}}, "version": {constants.AnnotationsCurrentVersion}}}'
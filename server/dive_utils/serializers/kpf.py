@@ -6,7 +6,7 @@ It is the python implementation of client/platform/backend/serializers/kpf.ts
 """
 
 from collections import defaultdict
-from typing import Dict, List, Mapping, Tuple, TypedDict, cast
+from typing import Dict, List, Mapping, TextIO, Tuple, TypedDict, Union, cast
 
 import yaml
 
@@ -72,8 +72,8 @@ def get_default_kpf_data() -> KPFData:
     }
 
 
-def load(input: str) -> KPFData:
-    """Load from files into formal data structures"""
+def load(input: Union[str, TextIO]) -> KPFData:
+    """Load from files or text streams into formal data structures"""
     kpf_data = get_default_kpf_data()
     parsed = yaml.safe_load(input)
     for row in parsed:
@@ -3,7 +3,7 @@ KWCOCO JSON format deserializer
 """
 
 import functools
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Generator, List, Optional, Set, Tuple
 
 from dive_utils import constants, strNumericCompare, types
 from dive_utils.models import CocoMetadata, Feature, Track
@@ -197,14 +197,21 @@ def load_coco_metadata(coco: Dict[str, List[dict]]) -> CocoMetadata:
     )
 
 
-def load_coco_as_tracks_and_attributes(
+def _assemble_coco_tracks(
     coco: Dict[str, List[dict]],
-) -> Tuple[types.DIVEAnnotationSchema, dict]:
+    metadata_attributes: Dict[str, Dict[str, Any]],
+    streaming=False,
+) -> Generator[Dict[str, Any], None, None]:
     """
-    Convert KWCOCO json to DIVE json tracks.
+    Assemble DIVE track dicts from KWCOCO annotations.
+
+    metadata_attributes is filled in place and is only complete once the generator is exhausted.
+
+    :param streaming: yield each track as soon as an annotation for a different track is read,
+        keeping only one Track in memory.  Requires annotations to be grouped by track id.
     """
     tracks: Dict[int, Track] = {}
-    metadata_attributes: Dict[str, Dict[str, Any]] = {}
+    completed: Set[int] = set()
     test_vals: Dict[str, Dict[str, int]] = {}
     meta = load_coco_metadata(coco)
     annotations = coco.get('annotations', [])
@@ -220,6 +227,13 @@ def load_coco_as_tracks_and_attributes(
         trackId, _, frame, _ = annotation_info(annotation, meta)
 
         if trackId not in tracks:
+            if streaming:
+                if trackId in completed:
+                    raise ValueError(f'COCO annotations for track {trackId} are not contiguous')
+                for previousId, previous in tracks.items():
+                    completed.add(previousId)
+                    yield previous.dict(exclude_none=True)
+                tracks.clear()
             tracks[trackId] = Track(begin=frame, end=frame, id=trackId)
 
         track = tracks[trackId]
@@ -236,11 +250,49 @@ def load_coco_as_tracks_and_attributes(
 
     # Now we process all the metadata_attributes for the types
     viame.calculate_attribute_types(metadata_attributes, test_vals)
+    for track in tracks.values():
+        yield track.dict(exclude_none=True)
+
+
+def is_track_sorted_coco(coco: Dict[str, List[dict]]) -> bool:
+    """Check whether all annotations of each track are contiguous"""
+    seen: Set[int] = set()
+    previous = None
+    for annotation in coco.get('annotations', []):
+        trackId = int(annotation.get('track_id', annotation['id']))
+        if trackId != previous:
+            if trackId in seen:
+                return False
+            seen.add(trackId)
+            previous = trackId
+    return True
+
+
+def stream_coco_tracks(
+    coco: Dict[str, List[dict]],
+    metadata_attributes: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    Convert track-sorted KWCOCO json to DIVE json tracks one track at a time.
+
+    :param metadata_attributes: filled in place with the attribute types
+        once the generator is exhausted
+    """
+    if metadata_attributes is None:
+        metadata_attributes = {}
+    return _assemble_coco_tracks(coco, metadata_attributes, streaming=True)
 
+
+def load_coco_as_tracks_and_attributes(
+    coco: Dict[str, List[dict]],
+) -> Tuple[types.DIVEAnnotationSchema, dict]:
+    """
+    Convert KWCOCO json to DIVE json tracks.
+    """
+    metadata_attributes: Dict[str, Dict[str, Any]] = {}
+    tracks = _assemble_coco_tracks(coco, metadata_attributes)
     converted: types.DIVEAnnotationSchema = {
-        'tracks': {
-            str(trackId): track.dict(exclude_none=True) for trackId, track in tracks.items()
-        },
+        'tracks': {str(track['id']): track for track in tracks},
         'groups': {},
         'version': constants.AnnotationsCurrentVersion,
     }
@@ -8,10 +8,13 @@ import io
 import json
 import os
 import re
-from typing import Any, Dict, Generator, List, Optional, Tuple, Union
+from typing import Any, Dict, Generator, Iterable, List, Optional, Set, Tuple, Union
 
 from dive_utils import constants, types
-from dive_utils.models import Feature, Track, interpolate
+from dive_utils.models import Track, construct_trusted, interpolate_bounds
+
+# Characters of CSV output buffered between yields of export_tracks_as_csv
+CSV_EXPORT_CHUNK_SIZE = 64 * 1024
 
 
 def format_timestamp(fps: int, frame: int) -> str:
@@ -77,10 +80,34 @@ def _deduceType(value: str) -> Union[bool, float, str]:
         return value
 
 
-def create_geoJSONFeature(features: Dict[str, Any], type: str, coords: List[Any], key=''):
+# Trailing column tokenizers, dispatched on the column prefix by _parse_row
+KEYPOINT_PREFIX = '(kp) '
+ATTRIBUTE_PREFIX = '(atr) '
+TRACK_ATTRIBUTE_PREFIX = '(trk-atr) '
+POLYGON_PREFIX = '(poly) '
+HEAD_REGEX = re.compile(r"^\(kp\) head (-?[0-9]+\.*-?[0-9]*) (-?[0-9]+\.*-?[0-9]*)")
+TAIL_REGEX = re.compile(r"^\(kp\) tail (-?[0-9]+\.*-?[0-9]*) (-?[0-9]+\.*-?[0-9]*)")
+ATTRIBUTE_REGEX = re.compile(r"^\(atr\) (.*?)\s(.+)")
+TRACK_ATTRIBUTE_REGEX = re.compile(r"^\(trk-atr\) (.*?)\s(.+)")
+POLYGON_REGEX = re.compile(r"^(\(poly\)) ((?:-?[0-9]+\.*-?[0-9]*\s*)+)")
+
+
+def create_geoJSONFeature(
+    features: Dict[str, Any],
+    type: str,
+    coords: List[Any],
+    key='',
+    index: Optional[Dict[Tuple[str, str], Dict[str, Any]]] = None,
+):
+    """
+    :param index: optional map of (type, key) to the first matching feature in features,
+        maintained by this function, to avoid a linear scan of the existing features
+    """
     feature = {}
     if "geometry" not in features:
         features["geometry"] = {"type": "FeatureCollection", "features": []}
+    elif index is not None:
+        feature = index.get((type, key), {})
     else:  # check for existing type/key pairs
         if features["geometry"]["features"]:
             for subfeature in features["geometry"]["features"]:
@@ -96,6 +123,8 @@ def create_geoJSONFeature(features: Dict[str, Any], type: str, coords: List[Any]
             "properties": {"key": key},
             "geometry": {"type": type},
         }
+        if index is not None:
+            index[(type, key)] = feature
     if type == 'Polygon':
         feature["geometry"]['coordinates'] = [coords]
     elif type in ["LineString", "Point"]:
@@ -109,6 +138,7 @@ def _parse_row(row: List[str]) -> Tuple[Dict, Dict, Dict, List]:
     Parse a single CSV line into its composite track and detection parts
     """
     features: Dict[str, Any] = {}
+    feature_index: Dict[Tuple[str, str], Dict[str, Any]] = {}
     attributes: Dict[str, Any] = {}
     track_attributes: Dict[str, Any] = {}
     confidence_pairs: List[Tuple[str, float]] = [
@@ -121,39 +151,44 @@ def _parse_row(row: List[str]) -> Tuple[Dict, Dict, Dict, List]:
     start = 9 + len(sorted_confidence_pairs) * 2
 
     for j in range(start, len(row)):
-        # (kp) head x y
-        head_regex = re.match(r"^\(kp\) head (-?[0-9]+\.*-?[0-9]*) (-?[0-9]+\.*-?[0-9]*)", row[j])
-        if head_regex:
-            point = [float(head_regex[1]), float(head_regex[2])]
-            head_tail.append(point)
-            create_geoJSONFeature(features, 'Point', point, 'head')
-
-        # (kp) tail x y
-        tail_regex = re.match(r"^\(kp\) tail (-?[0-9]+\.*-?[0-9]*) (-?[0-9]+\.*-?[0-9]*)", row[j])
-        if tail_regex:
-            point = [float(tail_regex[1]), float(tail_regex[2])]
-            head_tail.append(point)
-            create_geoJSONFeature(features, 'Point', point, 'tail')
-
-        # (atr) text
-        atr_regex = re.match(r"^\(atr\) (.*?)\s(.+)", row[j])
-        if atr_regex:
-            attributes[atr_regex[1]] = _deduceType(atr_regex[2])
-
-        # (trk-atr) text
-        trk_regex = re.match(r"^\(trk-atr\) (.*?)\s(.+)", row[j])
-        if trk_regex:
-            track_attributes[trk_regex[1]] = _deduceType(trk_regex[2])
-
-        # (poly) x1 y1 x2 y2 ...
-        poly_regex = re.match(r"^(\(poly\)) ((?:-?[0-9]+\.*-?[0-9]*\s*)+)", row[j])
-        if poly_regex:
-            temp = [float(x) for x in poly_regex[2].split()]
-            coords = list(zip(temp[::2], temp[1::2]))
-            create_geoJSONFeature(features, 'Polygon', coords)
+        column = row[j]
+        if column.startswith(KEYPOINT_PREFIX):
+            # (kp) head x y
+            head_regex = HEAD_REGEX.match(column)
+            if head_regex:
+                point = [float(head_regex[1]), float(head_regex[2])]
+                head_tail.append(point)
+                create_geoJSONFeature(features, 'Point', point, 'head', feature_index)
+
+            # (kp) tail x y
+            tail_regex = TAIL_REGEX.match(column)
+            if tail_regex:
+                point = [float(tail_regex[1]), float(tail_regex[2])]
+                head_tail.append(point)
+                create_geoJSONFeature(features, 'Point', point, 'tail', feature_index)
+
+        elif column.startswith(ATTRIBUTE_PREFIX):
+            # (atr) text
+            atr_regex = ATTRIBUTE_REGEX.match(column)
+            if atr_regex:
+                attributes[atr_regex[1]] = _deduceType(atr_regex[2])
+
+        elif column.startswith(TRACK_ATTRIBUTE_PREFIX):
+            # (trk-atr) text
+            trk_regex = TRACK_ATTRIBUTE_REGEX.match(column)
+            if trk_regex:
+                track_attributes[trk_regex[1]] = _deduceType(trk_regex[2])
+
+        elif column.startswith(POLYGON_PREFIX):
+            # (poly) x1 y1 x2 y2 ...
+            poly_regex = POLYGON_REGEX.match(column)
+            if poly_regex:
+                temp = [float(x) for x in poly_regex[2].split()]
+                coords = [[x, y] for x, y in zip(temp[::2], temp[1::2])]
+                create_geoJSONFeature(features, 'Polygon', coords, index=feature_index)
 
     if len(head_tail) == 2:
-        create_geoJSONFeature(features, 'LineString', head_tail, 'HeadTails')
+        create_geoJSONFeature(features, 'LineString', head_tail, 'HeadTails', feature_index)
 
     # ensure confidence pairs list is not empty
     if len(sorted_confidence_pairs) == 0:
@@ -169,17 +204,18 @@ def _parse_row(row: List[str]) -> Tuple[Dict, Dict, Dict, List]:
     return features, attributes, track_attributes, sorted_confidence_pairs
 
 
-def _parse_row_for_tracks(row: List[str]) -> Tuple[Feature, Dict, Dict, List]:
+def _parse_row_for_tracks(row: List[str]) -> Tuple[Dict, Dict, Dict, List]:
+    """
+    Parse a single CSV line into a feature dict equivalent to
+    Feature(...).dict(exclude_none=True), skipping model validation
+    since every value is produced here with the schema's types.
+    """
     head_tail_feature, attributes, track_attributes, confidence_pairs = _parse_row(row)
     _, _, frame, bounds, fishLength = row_info(row)
 
-    feature = Feature(
-        frame=frame,
-        bounds=bounds,
-        attributes=attributes,
-        fishLength=fishLength if fishLength > 0 else None,
-        **head_tail_feature,
-    )
+    feature = {'frame': frame, 'bounds': bounds, 'attributes': attributes, **head_tail_feature}
+    if fishLength > 0:
+        feature['fishLength'] = fishLength
 
     # Pass the rest of the unchanged info through as well
     return feature, attributes, track_attributes, confidence_pairs
@@ -285,18 +321,24 @@ def load_json_as_track_and_attributes(
     return json_data, metadata_attributes
 
 
-def load_csv_as_tracks_and_attributes(
-    rows: List[str], imageMap: Optional[Dict[str, int]] = None
-) -> Tuple[types.DIVEAnnotationSchema, dict]:
+def _assemble_csv_tracks(
+    rows: Iterable[str],
+    imageMap: Optional[Dict[str, int]],
+    metadata_attributes: Dict[str, Dict[str, Any]],
+    streaming=False,
+) -> Generator[Dict[str, Any], None, None]:
     """
-    Convert VIAME CSV to json tracks
+    Assemble track dicts from VIAME CSV rows.
 
-    :param rows: string rows of a VIAME CSV file
-    :param imageMap: map of image names to frame numbers.  keys do NOT include file extension
+    Track dicts are equivalent to Track(...).dict(exclude_none=True).
+    metadata_attributes is filled in place and is only complete once the generator is exhausted.
+
+    :param streaming: yield each track as soon as a row for a different track is read,
+        keeping only one track in memory.  Requires rows to be grouped by track id.
     """
     reader = csv.reader(row for row in rows)
-    tracks: Dict[int, Track] = {}
-    metadata_attributes: Dict[str, Dict[str, Any]] = {}
+    tracks: Dict[int, Dict[str, Any]] = {}
+    completed: Set[int] = set()
     test_vals: Dict[str, Dict[str, int]] = {}
     reordered = False
     anyImageMatched = False
@@ -312,22 +354,37 @@ def load_csv_as_tracks_and_attributes(
             confidence_pairs,
         ) = _parse_row_for_tracks(row)
 
-        trackId, imageFile, _, _, _ = row_info(row)
+        trackId, imageFile = int(row[0]), str(row[1])
         if imageMap:
             # validate image ordering if the imageMap is provided
             imageName, _ = os.path.splitext(os.path.basename(imageFile))
             expectedFrameNumber = imageMap.get(imageName)
             if expectedFrameNumber is None:
                 missingImages.append(imageFile)
-            elif expectedFrameNumber != feature.frame:
+            elif expectedFrameNumber != feature['frame']:
                 # force reorder the annotations
                 reordered = True
                 anyImageMatched = True
-                feature.frame = expectedFrameNumber
+                feature['frame'] = expectedFrameNumber
             else:
                 anyImageMatched = True
+        frame = feature['frame']
         if trackId not in tracks:
-            tracks[trackId] = Track(begin=feature.frame, end=feature.frame, id=trackId)
+            if streaming:
+                if trackId in completed:
+                    raise ValueError(f'CSV rows for track {trackId} are not contiguous')
+                for previousId, previous in tracks.items():
+                    completed.add(previousId)
+                    yield previous
+                tracks.clear()
+            tracks[trackId] = {
+                'begin': frame,
+                'end': frame,
+                'id': trackId,
+                'confidencePairs': [],
+                'attributes': {},
+                'features': [],
+            }
         elif reordered:
             # trackId was already in tracks, so the track consists of multiple frames
             raise ValueError(
@@ -338,19 +395,17 @@ def load_csv_as_tracks_and_attributes(
             )
 
         track = tracks[trackId]
-        track.begin = min(feature.frame, track.begin)
-        track.end = max(track.end, feature.frame)
-        track.features.append(feature)
-        track.confidencePairs = confidence_pairs
+        track['begin'] = min(frame, track['begin'])
+        track['end'] = max(track['end'], frame)
+        track['features'].append(feature)
+        track['confidencePairs'] = confidence_pairs
 
         for key, val in track_attributes.items():
-            track.attributes[key] = val
+            track['attributes'][key] = val
             create_attributes(metadata_attributes, test_vals, 'track', key, val)
         for key, val in attributes.items():
             create_attributes(metadata_attributes, test_vals, 'detection', key, val)
 
-    trackarr = tracks.items()
-
     if imageMap and len(missingImages) and anyImageMatched:
         examples = ', '.join(missingImages[:3])
         raise ValueError(
@@ -367,8 +422,56 @@ def load_csv_as_tracks_and_attributes(
         )
     # Now we process all the metadata_attributes for the types
     calculate_attribute_types(metadata_attributes, test_vals)
+    yield from tracks.values()
+
+
+def is_track_sorted_csv(rows: Iterable[str]) -> bool:
+    """Check whether all rows of each track are contiguous in a VIAME CSV file"""
+    seen: Set[str] = set()
+    previous = None
+    for row in csv.reader(row for row in rows):
+        if len(row) == 0 or row[0].startswith('#'):
+            continue
+        trackId = row[0]
+        if trackId != previous:
+            if trackId in seen:
+                return False
+            seen.add(trackId)
+            previous = trackId
+    return True
+
+
+def stream_csv_tracks(
+    rows: Iterable[str],
+    imageMap: Optional[Dict[str, int]] = None,
+    metadata_attributes: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    Convert a track-sorted VIAME CSV to json tracks one track at a time
+
+    :param rows: string rows of a VIAME CSV file, grouped by track id
+    :param imageMap: map of image names to frame numbers.  keys do NOT include file extension
+    :param metadata_attributes: filled in place with the attribute types
+        once the generator is exhausted
+    """
+    if metadata_attributes is None:
+        metadata_attributes = {}
+    return _assemble_csv_tracks(rows, imageMap, metadata_attributes, streaming=True)
+
+
+def load_csv_as_tracks_and_attributes(
+    rows: Iterable[str], imageMap: Optional[Dict[str, int]] = None
+) -> Tuple[types.DIVEAnnotationSchema, dict]:
+    """
+    Convert VIAME CSV to json tracks
+
+    :param rows: string rows of a VIAME CSV file, such as a list or a text stream
+    :param imageMap: map of image names to frame numbers.  keys do NOT include file extension
+    """
+    metadata_attributes: Dict[str, Dict[str, Any]] = {}
+    tracks = _assemble_csv_tracks(rows, imageMap, metadata_attributes)
     annotations: types.DIVEAnnotationSchema = {
-        'tracks': {str(trackId): track.dict(exclude_none=True) for trackId, track in trackarr},
+        'tracks': {str(track['id']): track for track in tracks},
         'groups': {},
         'version': constants.AnnotationsCurrentVersion,
     }
@@ -384,6 +487,8 @@ def export_tracks_as_csv(
     header=True,
     typeFilter=None,
     revision=None,
+    trusted=False,
+    chunkSize=CSV_EXPORT_CHUNK_SIZE,
 ) -> Generator[str, None, None]:
     """
     Export track json to a CSV format.
@@ -394,6 +499,8 @@ def export_tracks_as_csv(
     :param fps: if FPS is set, column 2 will be video timestamp derived from (frame / fps)
     :param header: include or omit header
     :param typeFilter: set of track types to only export if not empty
+    :param trusted: skip validation for tracks that were validated when stored
+    :param chunkSize: approximate number of characters buffered before each yield
     """
     if thresholds is None:
         thresholds = {}
@@ -410,8 +517,17 @@ def export_tracks_as_csv(
             metadata["revision"] = revision
         writeHeader(writer, metadata)
 
+    def frameIdentifier(frame: int) -> str:
+        # If FPS is set, column 2 will be video timestamp
+        if fps is not None and fps > 0:
+            return format_timestamp(fps, frame)
+        # else if filenames is set, column 2 will be image file name
+        elif filenames and frame < len(filenames):
+            return filenames[frame]
+        return ""
+
     for t in track_iterator:
-        track = Track(**t)
+        track = construct_trusted(Track, t) if trusted else Track(**t)
         if (not excludeBelowThreshold) or track.exceeds_thresholds(thresholds):
             # filter by types if applicable
             if typeFilter:
@@ -425,69 +541,74 @@ def export_tracks_as_csv(
             sorted_confidence_pairs = sorted(
                 confidence_pairs, key=lambda item: item[1], reverse=True
             )
+            # Columns shared by every row of the track
+            pair_columns = [value for pair in sorted_confidence_pairs for value in pair]
+            track_attribute_columns = [
+                f"(trk-atr) {key} {valueToString(val)}" for key, val in track.attributes.items()
+            ]
 
             for index, keyframe in enumerate(track.features):
-                features = [keyframe]
+                confidence = sorted_confidence_pairs[0][1]
+                columns = [
+                    track.id,
+                    frameIdentifier(keyframe.frame),
+                    keyframe.frame,
+                    *keyframe.bounds,
+                    confidence,
+                    keyframe.fishLength or -1,
+                    *pair_columns,
+                ]
+
+                if keyframe.attributes:
+                    for key, val in keyframe.attributes.items():
+                        columns.append(f"(atr) {key} {valueToString(val)}")
+
+                columns.extend(track_attribute_columns)
+
+                if keyframe.geometry and "FeatureCollection" == keyframe.geometry.type:
+                    for geoJSONFeature in keyframe.geometry.features:
+                        if 'Polygon' == geoJSONFeature.geometry.type:
+                            # Coordinates need to be flattened out from their list of tuples
+                            coordinates = [
+                                item
+                                for sublist in geoJSONFeature.geometry.coordinates[
+                                    0
+                                ]  # type: ignore
+                                for item in sublist  # type: ignore
+                            ]
+                            columns.append(
+                                f"(poly) {' '.join(map(lambda x: str(round(x)), coordinates))}"
+                            )
+                        if 'Point' == geoJSONFeature.geometry.type:
+                            coordinates = geoJSONFeature.geometry.coordinates  # type: ignore
+                            columns.append(
+                                f"(kp) {geoJSONFeature.properties['key']} "
+                                f"{round(coordinates[0])} {round(coordinates[1])}"
+                            )
+                        # TODO: support for multiple GeoJSON Objects of the same type
+                        # once the CSV supports it
+
+                writer.writerow(columns)
 
                 # If this is not the last keyframe, and interpolation is
-                # enabled for this keyframe, interpolate
+                # enabled for this keyframe, interpolate all features in (a,b)
                 if keyframe.interpolate and index < len(track.features) - 1:
-                    nextKeyframe = track.features[index + 1]
-                    # interpolate all features in [a,b)
-                    features = interpolate(keyframe, nextKeyframe)
-
-                for feature in features:
-                    columns = [
-                        track.id,
-                        "",
-                        feature.frame,
-                        *feature.bounds,
-                        sorted_confidence_pairs[0][1],
-                        feature.fishLength or -1,
-                    ]
-
-                    # If FPS is set, column 2 will be video timestamp
-                    if fps is not None and fps > 0:
-                        columns[1] = format_timestamp(fps, feature.frame)
-                    # else if filenames is set, column 2 will be image file name
-                    elif filenames and feature.frame < len(filenames):
-                        columns[1] = filenames[feature.frame]
-
-                    for pair in sorted_confidence_pairs:
-                        columns.extend(list(pair))
-
-                    if feature.attributes:
-                        for key, val in feature.attributes.items():
-                            columns.append(f"(atr) {key} {valueToString(val)}")
-
-                    if track.attributes:
-                        for key, val in track.attributes.items():
-                            columns.append(f"(trk-atr) {key} {valueToString(val)}")
-
-                    if feature.geometry and "FeatureCollection" == feature.geometry.type:
-                        for geoJSONFeature in feature.geometry.features:
-                            if 'Polygon' == geoJSONFeature.geometry.type:
-                                # Coordinates need to be flattened out from their list of tuples
-                                coordinates = [
-                                    item
-                                    for sublist in geoJSONFeature.geometry.coordinates[
-                                        0
-                                    ]  # type: ignore
-                                    for item in sublist  # type: ignore
-                                ]
-                                columns.append(
-                                    f"(poly) {' '.join(map(lambda x: str(round(x)), coordinates))}"
-                                )
-                            if 'Point' == geoJSONFeature.geometry.type:
-                                coordinates = geoJSONFeature.geometry.coordinates  # type: ignore
-                                columns.append(
-                                    f"(kp) {geoJSONFeature.properties['key']} "
-                                    f"{round(coordinates[0])} {round(coordinates[1])}"
-                                )
-                            # TODO: support for multiple GeoJSON Objects of the same type
-                            # once the CSV supports it
-
-                    writer.writerow(columns)
+                    frames, bounds = interpolate_bounds(keyframe, track.features[index + 1])
+                    writer.writerows(
+                        [
+                            track.id,
+                            frameIdentifier(frame),
+                            frame,
+                            *frame_bounds,
+                            confidence,
+                            -1,
+                            *pair_columns,
+                            *track_attribute_columns,
+                        ]
+                        for frame, frame_bounds in zip(frames, bounds)
+                    )
+
+                if csvFile.tell() >= chunkSize:
                     yield csvFile.getvalue()
                     csvFile.seek(0)
                     csvFile.truncate(0)
@@ -1,3 +1,4 @@
 from scripts import cli  # noqa: F401
 import scripts.commands_dev  # noqa: F401
 import scripts.commands_main  # noqa: F401
+import scripts.migrations  # noqa: F401
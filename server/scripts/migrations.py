@@ -1,7 +1,306 @@
+import datetime
+import threading
+from typing import Set
+
 import click
+from girder.models import getDbConnection
+from girder.models.folder import Folder
+from girder.models.item import Item
+from pymongo import IndexModel, UpdateOne
+from pymongo.collection import Collection
 
+from dive_server.crud_annotation import (
+    ANNOTATION_INDICES,
+    DATASET,
+    MASK_RLE_INDICES,
+    REVISION_DELETED,
+    REVISION_HEAD,
+    BaseItem,
+    GroupItem,
+    MaskRleItem,
+    RevisionLogItem,
+    TrackItem,
+    import_legacy_rle_masks,
+)
+from dive_utils import TRUTHY_META_VALUES, constants
+from dive_utils.metadata.models import metadata_search_tokens, search_metadata_keys
+from dive_utils.metadata.numeric import sanitize_value_tree_for_girder_json
 from scripts import cli
 
+# Indices replaced by the DIVE_Metadata model indices
+STALE_DIVE_METADATA_INDICES = ['root_1_filename_1']
+SANITIZE_BATCH_SIZE = 1000
+INDEX_PROGRESS_INTERVAL = 5
+# Names of the migration steps that have completed, so server starts skip them
+MIGRATIONS_COLLECTION = 'dive_migrations'
+
+
+def report_index_progress(collection: Collection):
+    """Print the progress of in-flight index builds on a collection."""
+    ops = collection.database.client.admin.aggregate(
+        [
+            {'$currentOp': {'allUsers': True}},
+            {'$match': {'command.createIndexes': collection.name}},
+        ]
+    )
+    for op in ops:
+        progress = op.get('progress', {})
+        if progress.get('total'):
+            click.echo(
+                f'{collection.name}: {op.get("msg", "building index")}'
+                f' {progress["done"]}/{progress["total"]}'
+                f' ({100 * progress["done"] / progress["total"]:.1f}%)'
+            )
+
+
+def build_index(collection: Collection, keys: list, options: dict, dry_run: bool):
+    """
+    Build an index online while reporting progress.
+
+    Existing indices with the same name but different options are dropped first,
+    as createIndexes would otherwise fail with a conflict.
+    """
+    index = IndexModel(keys, **options)
+    name = index.document['name']
+    existing = collection.index_information().get(name)
+    if existing is not None:
+        if all(existing.get(key) == value for key, value in options.items()):
+            click.echo(f'{collection.name}: index {name} is up to date')
+            return
+        click.echo(f'{collection.name}: dropping index {name} with outdated options')
+        if not dry_run:
+            collection.drop_index(name)
+    click.echo(f'{collection.name}: building index {name}')
+    if dry_run:
+        return
+    errors = []
+
+    def create():
+        try:
+            collection.create_indexes([index])
+        except Exception as err:
+            errors.append(err)
+
+    builder = threading.Thread(target=create)
+    builder.start()
+    builder.join(INDEX_PROGRESS_INTERVAL)
+    while builder.is_alive():
+        report_index_progress(collection)
+        builder.join(INDEX_PROGRESS_INTERVAL)
+    if errors:
+        raise errors[0]
+    click.echo(f'{collection.name}: index {name} built')
+
+
+def migrate_annotation_indices(dry_run: bool):
+    database = getDbConnection().get_database()
+    for model in [TrackItem, GroupItem]:
+        collection = database[model.NAME]
+        for keys, options in ANNOTATION_INDICES:
+            build_index(collection, keys, options, dry_run)
+
+
+def migrate_mask_rle(dry_run: bool):
+    """Move every RLE_MASKS.json file into the per-frame maskRle collection."""
+    collection = getDbConnection().get_database()[MaskRleItem.NAME]
+    for keys, options in MASK_RLE_INDICES:
+        build_index(collection, keys, options, dry_run)
+    rle_items = Item().find(
+        {f'meta.{constants.MASK_RLE_FILE_MARKER}': {'$in': TRUTHY_META_VALUES}},
+        fields=['folderId'],
+    )
+    folderIds = sorted({item['folderId'] for item in rle_items})
+    for index, folderId in enumerate(folderIds):
+        mask_folder = Folder().load(folderId, force=True)
+        if mask_folder is None:
+            continue
+        click.echo(
+            f'{collection.name} [{index + 1}/{len(folderIds)}] dataset={mask_folder["parentId"]}'
+        )
+        if not dry_run:
+            import_legacy_rle_masks(mask_folder)
+
+
+def invalidate_metadata_counts(roots: Set[str], dry_run: bool):
+    """Drop the cached DIVE_Metadata counts of roots whose rows were rewritten."""
+    if not roots:
+        return
+    click.echo(f'DIVE_MetadataCounts: invalidating cached counts of {len(roots)} roots')
+    if not dry_run:
+        getDbConnection().get_database()['DIVE_MetadataCounts'].update_many(
+            {'root': {'$in': list(roots)}},
+            {'$inc': {'generation': 1}, '$unset': {'counts': ''}},
+        )
+
+
+def dedupe_dive_metadata(dry_run: bool):
+    """
+    Remove duplicate DIVE_Metadata rows for the same dataset and root, keeping
+    the most recently created, so the unique (root, DIVEDataset) index can be built.
+    """
+    collection = getDbConnection().get_database()['DIVE_Metadata']
+    duplicates = collection.aggregate(
+        [
+            {'$sort': {'created': -1, '_id': -1}},
+            {
+                '$group': {
+                    '_id': {'root': '$root', 'DIVEDataset': '$DIVEDataset'},
+                    'ids': {'$push': '$_id'},
+                    'count': {'$sum': 1},
+                }
+            },
+            {'$match': {'count': {'$gt': 1}}},
+        ],
+        allowDiskUse=True,
+    )
+    removed = 0
+    roots: Set[str] = set()
+    for group in duplicates:
+        stale = group['ids'][1:]
+        if not dry_run:
+            collection.delete_many({'_id': {'$in': stale}})
+        removed += len(stale)
+        roots.add(str(group['_id']['root']))
+    click.echo(f'{collection.name}: removed {removed} duplicate rows')
+    invalidate_metadata_counts(roots, dry_run)
+    build_index(collection, [('root', 1), ('DIVEDataset', 1)], {'unique': True}, dry_run)
+    build_index(collection, [('root', 1), ('filename', 1), ('_id', 1)], {}, dry_run)
+    for name in STALE_DIVE_METADATA_INDICES:
+        if name in collection.index_information():
+            click.echo(f'{collection.name}: dropping stale index {name}')
+            if not dry_run:
+                collection.drop_index(name)
+
+
+def sanitize_dive_metadata(dry_run: bool):
+    """
+    Replace NaN/inf in stored DIVE_Metadata rows, which are now sanitized on write,
+    so reads no longer have to write rows back.
+    """
+    collection = getDbConnection().get_database()['DIVE_Metadata']
+    writes = []
+    sanitized = 0
+    roots: Set[str] = set()
+    for row in collection.find({}, {'root': 1, 'metadata': 1}):
+        metadata = row.get('metadata')
+        if not isinstance(metadata, dict):
+            continue
+        if sanitize_value_tree_for_girder_json(metadata, minmax_keys_to_zero=False):
+            sanitized += 1
+            writes.append(UpdateOne({'_id': row['_id']}, {'$set': {'metadata': metadata}}))
+            roots.add(str(row.get('root')))
+        if len(writes) >= SANITIZE_BATCH_SIZE:
+            if not dry_run:
+                collection.bulk_write(writes, ordered=False)
+            writes = []
+    if writes and not dry_run:
+        collection.bulk_write(writes, ordered=False)
+    click.echo(f'{collection.name}: sanitized {sanitized} rows')
+    invalidate_metadata_counts(roots, dry_run)
+
+
+def tokenize_dive_metadata(dry_run: bool, limit: int):
+    """
+    Store search tokens on every DIVE_Metadata row for its filename and the search keys
+    of its root, replacing tokens of every string value written by earlier versions.
+    """
+    database = getDbConnection().get_database()
+    collection = database['DIVE_Metadata']
+    roots = collection.distinct('root')
+    if limit:
+        roots = roots[:limit]
+    for index, root in enumerate(roots):
+        search_keys = search_metadata_keys(database['DIVE_MetadataKeys'].find_one({'root': root}))
+        writes = []
+        for row in collection.find({'root': root}, {'filename': 1, 'metadata': 1}):
+            tokens = metadata_search_tokens(row.get('filename'), row.get('metadata'), search_keys)
+            writes.append(UpdateOne({'_id': row['_id']}, {'$set': {'searchTokens': tokens}}))
+            if len(writes) >= SANITIZE_BATCH_SIZE:
+                if not dry_run:
+                    collection.bulk_write(writes, ordered=False)
+                writes = []
+        if writes and not dry_run:
+            collection.bulk_write(writes, ordered=False)
+        click.echo(
+            f'{collection.name} [{index + 1}/{len(roots)}] root={root}'
+            f' search keys={sorted(search_keys)}'
+        )
+    invalidate_metadata_counts({str(root) for root in roots}, dry_run)
+    build_index(collection, [('root', 1), ('searchTokens', 1)], {}, dry_run)
+
+
+def backfill_revision_head(model: BaseItem, dry_run: bool, limit: int):
+    """
+    Mark the live version of every annotation with the head revision marker.
+
+    Also repairs annotations restored by older rollbacks, which left a
+    rev_deleted value newer than the dataset head in place.
+    """
+    datasets = model.collection.distinct(DATASET)
+    if limit:
+        datasets = datasets[:limit]
+    for index, datasetId in enumerate(datasets):
+        head = RevisionLogItem().latest({'_id': datasetId})
+        restoreQuery = {DATASET: datasetId, REVISION_DELETED: {'$gt': head}}
+        markQuery = {
+            DATASET: datasetId,
+            REVISION_DELETED: {'$exists': False},
+            REVISION_HEAD: {'$ne': True},
+        }
+        if dry_run:
+            restored = model.collection.count_documents(restoreQuery)
+            marked = model.collection.count_documents(markQuery)
+        else:
+            restored = model.collection.update_many(
+                restoreQuery, {'$unset': {REVISION_DELETED: ""}}
+            ).modified_count
+            marked = model.collection.update_many(
+                markQuery, {'$set': {REVISION_HEAD: True}}
+            ).modified_count
+        click.echo(
+            f'{model.name} [{index + 1}/{len(datasets)}] dataset={datasetId}'
+            f' restored={restored} marked={marked}'
+        )
+
+
+def backfill_revision_heads(dry_run: bool, limit: int):
+    for model in [TrackItem(), GroupItem()]:
+        backfill_revision_head(model, dry_run, limit)
+
+
+# (name, step, run on server start); a step is recorded once it completes, and
+# only `dive migrate` runs the steps that delete data
+MIGRATION_STEPS = [
+    ('annotation_indices', lambda dry_run, limit: migrate_annotation_indices(dry_run), True),
+    ('dive_metadata_dedupe', lambda dry_run, limit: dedupe_dive_metadata(dry_run), False),
+    ('dive_metadata_sanitize', lambda dry_run, limit: sanitize_dive_metadata(dry_run), True),
+    ('dive_metadata_search_tokens', tokenize_dive_metadata, True),
+    ('revision_head', backfill_revision_heads, True),
+    ('mask_rle', lambda dry_run, limit: migrate_mask_rle(dry_run), True),
+]
+
+
+def run_migrations(dry_run: bool = False, limit: int = 0, on_start: bool = False):
+    """
+    Bring stored annotations, metadata and masks up to date.  Every step is idempotent.
+
+    :param on_start: Run as part of server start: skip the steps already recorded as
+        complete, and the ones that delete data.
+    """
+    migrations = getDbConnection().get_database()[MIGRATIONS_COLLECTION]
+    completed = set()
+    if on_start:
+        completed = {doc['_id'] for doc in migrations.find({}, {'_id': 1})}
+    # Build indices before the models are instantiated, which would build them blocking
+    for name, step, runs_on_start in MIGRATION_STEPS:
+        if on_start and (name in completed or not runs_on_start):
+            continue
+        step(dry_run, limit)
+        if not dry_run and not limit:
+            migrations.update_one(
+                {'_id': name}, {'$set': {'completed': datetime.datetime.utcnow()}}, upsert=True
+            )
+
 
 @cli.command(name="migrate")
 @click.option('--dry-run', is_flag=True)
@@ -10,7 +309,7 @@ def migrate_server(dry_run, limit):
     """
     Migration script is idempotent.
     """
-    pass
+    run_migrations(dry_run, limit)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+import os
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def mongo_database():
+    """
+    A scratch database on the MongoDB at DIVE_TEST_MONGO_URI, dropped after the test.
+
+    Each test gets its own database so that runs in parallel do not share collections.
+    """
+    pymongo = pytest.importorskip('pymongo')
+    client = pymongo.MongoClient(
+        os.environ.get('DIVE_TEST_MONGO_URI', 'mongodb://localhost:27017'),
+        serverSelectionTimeoutMS=1000,
+    )
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        client.close()
+        pytest.skip('MongoDB is not available')
+    name = f'dive_test_{uuid.uuid4().hex[:12]}'
+    yield client[name]
+    client.drop_database(name)
+    client.close()
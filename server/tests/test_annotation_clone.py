@@ -0,0 +1,123 @@
+"""
+Tests for cloning annotations with an aggregation $merge, against the MongoDB at
+DIVE_TEST_MONGO_URI.
+"""
+
+from __future__ import annotations
+
+import pytest
+
+pytest.importorskip('girder')
+
+from bson.objectid import ObjectId  # noqa: E402
+
+from dive_server import crud_annotation  # noqa: E402
+
+USER = {'_id': ObjectId(), 'login': 'owner'}
+
+
+@pytest.fixture
+def annotation_models(mongo_database, monkeypatch):
+    """Scratch track, group and revision log collections standing in for the models."""
+    database = mongo_database
+    instances = {}
+    for model in [crud_annotation.TrackItem, crud_annotation.GroupItem]:
+        # Girder models connect on construction, so only the collection is set up
+        instance = object.__new__(model)
+        instance.collection = database[model.NAME]
+        for keys, options in crud_annotation.ANNOTATION_INDICES:
+            instance.collection.create_index(keys, **options)
+        instances[model.__name__] = instance
+        monkeypatch.setattr(crud_annotation, model.__name__, lambda instance=instance: instance)
+    revisions = database['revisionLogItem']
+
+    class FakeRevisionLogItem:
+        collection = revisions
+
+    monkeypatch.setattr(crud_annotation, 'RevisionLogItem', FakeRevisionLogItem)
+    return instances['TrackItem'], instances['GroupItem'], revisions
+
+
+def _track(dataset, trackId, created, head=True, deleted=None):
+    track = {
+        'dataset': dataset,
+        'id': trackId,
+        'begin': 0,
+        'end': 1,
+        'features': [],
+        'confidencePairs': [['fish', 1.0]],
+        'attributes': {},
+        'rev_created': created,
+    }
+    if head:
+        track['rev_head'] = True
+    if deleted is not None:
+        track['rev_deleted'] = deleted
+    return track
+
+
+def test_merge_clone_copies_head_records(annotation_models):
+    tracks, _, _ = annotation_models
+    source, clone = ObjectId(), ObjectId()
+    tracks.collection.insert_many(
+        [
+            _track(source, 1, 1, head=False, deleted=2),
+            _track(source, 1, 2),
+            _track(source, 2, 1),
+            _track(ObjectId(), 3, 1),
+        ]
+    )
+    query, hint = tracks.list_query({'_id': source})
+    assert tracks.merge_clone(query, hint, {source: clone}, 1) == {clone: 2}
+
+    cloned = list(tracks.collection.find({'dataset': clone}, sort=[('id', 1)]))
+    assert [track['id'] for track in cloned] == [1, 2]
+    assert all(track['rev_created'] == 1 and track['rev_head'] for track in cloned)
+    assert all('rev_deleted' not in track for track in cloned)
+    assert tracks.collection.count_documents({'dataset': source}) == 3
+
+
+def test_merge_clone_copies_a_previous_revision(annotation_models):
+    tracks, _, _ = annotation_models
+    source, clone = ObjectId(), ObjectId()
+    tracks.collection.insert_many(
+        [_track(source, 1, 1, head=False, deleted=2), _track(source, 2, 2)]
+    )
+    query, hint = tracks.list_query({'_id': source}, revision=1)
+    assert tracks.merge_clone(query, hint, {source: clone}, 1) == {clone: 1}
+    (cloned,) = tracks.collection.find({'dataset': clone})
+    assert cloned['id'] == 1 and cloned['rev_head']
+
+
+def test_clone_head_annotations_maps_many_datasets(annotation_models):
+    tracks, groups, revisions = annotation_models
+    sources = [ObjectId() for _ in range(3)]
+    clones = [ObjectId() for _ in range(3)]
+    tracks.collection.insert_many(
+        [_track(sources[0], 1, 1), _track(sources[0], 2, 1), _track(sources[1], 1, 1)]
+    )
+    groups.collection.insert_one(
+        {'dataset': sources[1], 'id': 0, 'members': {}, 'rev_created': 1, 'rev_head': True}
+    )
+    additions = crud_annotation.clone_head_annotations(dict(zip(sources, clones)), USER)
+
+    assert additions == {clones[0]: 2, clones[1]: 2}
+    assert tracks.collection.count_documents({'dataset': clones[0]}) == 2
+    assert groups.collection.count_documents({'dataset': clones[1], 'rev_head': True}) == 1
+    logged = {entry['dataset']: entry['additions'] for entry in revisions.find()}
+    assert logged == {clones[0]: 2, clones[1]: 2}
+
+
+def test_merge_clone_sends_the_hint_as_a_document():
+    calls = []
+
+    class FakeCollection:
+        def aggregate(self, pipeline, **options):
+            calls.append(options)
+            return []
+
+    tracks = object.__new__(crud_annotation.TrackItem)
+    tracks.collection = FakeCollection()
+    query, hint = tracks.list_query({'_id': ObjectId()})
+    tracks.merge_clone(query, hint, {ObjectId(): ObjectId()}, 1)
+    assert calls[0]['hint'] == dict(crud_annotation.HEAD_INDEX)
@@ -0,0 +1,59 @@
+import io
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pycocotools')
+
+from PIL import Image  # noqa: E402
+from pycocotools import mask as mask_utils  # noqa: E402
+
+from dive_utils import masks  # noqa: E402
+
+MASKS = 2000
+WORKERS = 4
+MIN_SPEEDUP = 1.5
+
+
+def write_masks(directory, count, size=(480, 640)):
+    """Mask PNGs holding one filled ellipse each, at varying positions"""
+    rows, cols = np.ogrid[: size[0], : size[1]]
+    paths = []
+    for index in range(count):
+        center = (50 + index % 380, 50 + (index * 7) % 540)
+        mask = ((rows - center[0]) / 40) ** 2 + ((cols - center[1]) / 60) ** 2 <= 1
+        path = directory / f'{index}.png'
+        Image.fromarray(mask.astype(np.uint8) * 255).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_encode_mask_pngs_matches_serial_encoding(tmp_path, monkeypatch):
+    paths = write_masks(tmp_path, 6, size=(20, 30))
+    monkeypatch.setattr(masks, 'MASK_ENCODE_CHUNK_SIZE', 2)
+    monkeypatch.setattr(masks, 'MASK_ENCODE_POOL_MIN_MASKS', 1)
+    serial = masks.encode_mask_pngs(paths, processes=1)
+    assert masks.encode_mask_pngs(paths, processes=2) == serial
+    assert masks.encode_mask_pngs([path.read_bytes() for path in paths]) == serial
+
+    # RLE size is (height, width) and decodes back to the source mask
+    rle = serial[3]
+    assert rle['size'] == [20, 30]
+    decoded = mask_utils.decode({'size': rle['size'], 'counts': rle['counts'].encode()})
+    source = np.array(Image.open(io.BytesIO(paths[3].read_bytes())).convert('1'))
+    assert (decoded == source).all()
+
+
+@pytest.mark.benchmark
+def test_mask_encoding_benchmark(tmp_path):
+    paths = write_masks(tmp_path, MASKS)
+    results = {}
+    for processes in [1, WORKERS]:
+        start = time.perf_counter()
+        encoded = masks.encode_mask_pngs(paths, processes=processes)
+        results[processes] = (MASKS / (time.perf_counter() - start), encoded)
+        print(f'{processes} process(es): {results[processes][0]:.0f} masks/sec')
+    assert results[1][1] == results[WORKERS][1]
+    if masks.MASK_ENCODE_PROCESSES >= WORKERS:
+        assert results[WORKERS][0] >= MIN_SPEEDUP * results[1][0]
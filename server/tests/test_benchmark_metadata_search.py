@@ -0,0 +1,63 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip('girder')
+
+from dive_server.views_metadata import _search_filter_query  # noqa: E402
+from dive_utils.metadata.models import metadata_search_tokens  # noqa: E402
+
+ROWS = int(os.environ.get('DIVE_BENCHMARK_ROWS', 1_000_000))
+INSERT_BATCH = 10_000
+WORDS = ['reef', 'coral', 'sand', 'kelp', 'wreck', 'trench', 'shelf', 'lagoon']
+
+
+def make_row(index):
+    note = f'{WORDS[index % 8]} survey {WORDS[(index // 8) % 8]} transect {index}'
+    filename = f'dive_{index:07d}.mp4'
+    metadata = {'note': note, 'site': WORDS[(index // 64) % 8]}
+    return {
+        'root': 'root',
+        'DIVEDataset': str(index),
+        'filename': filename,
+        'metadata': metadata,
+        'searchTokens': metadata_search_tokens(filename, metadata),
+    }
+
+
+@pytest.fixture
+def search_collection(mongo_database):
+    collection = mongo_database['DIVE_Metadata_search_benchmark']
+    for start in range(0, ROWS, INSERT_BATCH):
+        collection.insert_many(
+            [make_row(index) for index in range(start, min(start + INSERT_BATCH, ROWS))]
+        )
+    collection.create_index([('root', 1), ('filename', 1), ('_id', 1)])
+    collection.create_index([('root', 1), ('searchTokens', 1)])
+    return collection
+
+
+def seconds(collection, query, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        matched = collection.count_documents(query)
+    return (time.perf_counter() - start) / repeat, matched
+
+
+@pytest.mark.benchmark
+def test_metadata_search_benchmark(search_collection):
+    results = {}
+    for field, key, text in [
+        ('filename', None, f'dive_{ROWS - 1:07d}'),
+        ('metadata.note', 'note', f'transect {ROWS // 2}'),
+    ]:
+        regex = {'$and': [{'root': 'root'}, {field: {'$regex': text}}]}
+        indexed = {'$and': [{'root': 'root'}, _search_filter_query(field, key, text)]}
+        before, expected = seconds(search_collection, regex)
+        after, matched = seconds(search_collection, indexed)
+        assert matched == expected == 1
+        results[field] = (before, after)
+        print(f'{field}: regex {before * 1e3:.1f}ms, prefix tokens {after * 1e3:.1f}ms')
+    for before, after in results.values():
+        assert before / after > 10
@@ -0,0 +1,62 @@
+import json
+import time
+
+import pytest
+
+from dive_utils import models
+from dive_utils.serializers import dive, viame
+
+TRACKS = 1000
+DETECTIONS_PER_TRACK = 100
+
+
+def make_stored_tracks():
+    """100k detections across 1k tracks, as stored in Mongo after write-time validation"""
+    tracks = []
+    for trackId in range(TRACKS):
+        features = [
+            {
+                'frame': frame,
+                'bounds': [frame, frame, frame + 10, frame + 10],
+                'attributes': {'quality': frame % 3},
+                'keyframe': True,
+            }
+            for frame in range(DETECTIONS_PER_TRACK)
+        ]
+        track = models.Track(
+            id=trackId,
+            begin=0,
+            end=DETECTIONS_PER_TRACK - 1,
+            confidencePairs=[['fish', 0.9], ['rock', 0.1]],
+            attributes={'reviewed': True},
+            features=features,
+        )
+        tracks.append(track.dict(exclude_none=True))
+    return tracks
+
+
+def per_track_seconds(export, tracks) -> float:
+    start = time.perf_counter()
+    for _ in export(tracks):
+        pass
+    return (time.perf_counter() - start) / len(tracks)
+
+
+@pytest.mark.benchmark
+def test_trusted_read_benchmark():
+    tracks = make_stored_tracks()
+    validated_json = ''.join(dive.export_annotations_json(tracks, []))
+    trusted_json = ''.join(dive.export_annotations_json(tracks, [], trusted=True))
+    assert json.loads(validated_json) == json.loads(trusted_json)
+
+    results = {}
+    for name, export in [
+        ('dive_json', lambda t, trusted: dive.export_annotations_json(t, [], trusted=trusted)),
+        ('viame_csv', lambda t, trusted: viame.export_tracks_as_csv(t, trusted=trusted)),
+    ]:
+        before = per_track_seconds(lambda t: export(t, False), tracks)
+        after = per_track_seconds(lambda t: export(t, True), tracks)
+        results[name] = (before, after)
+        print(f'{name}: validated {before * 1e6:.0f}us/track, trusted {after * 1e6:.0f}us/track')
+    for before, after in results.values():
+        assert after < before
@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+from dive_utils.serializers import viame
+
+ROWS = 100_000
+MIN_ROWS_PER_SECOND = 5_000
+
+
+def make_csv_rows():
+    """Generated VIAME CSV with keypoints, polygons and attributes on every row"""
+    rows = ['# 1: Detection or Track-id,2: Video or Image Identifier']
+    for index in range(ROWS):
+        trackId = index // 100
+        frame = index % 100
+        rows.append(
+            ','.join(
+                [
+                    str(trackId),
+                    f'{frame}.png',
+                    str(frame),
+                    '10.5,20,110.5,220',
+                    '0.9',
+                    '-1',
+                    'fish,0.9',
+                    'rock,0.1',
+                    '(kp) head 12.5 30',
+                    '(kp) tail 100 200.25',
+                    '(poly) 10 20 110 20 110 220 10 220',
+                    f'(atr) occluded {"true" if frame % 2 else "false"}',
+                    f'(atr) score {frame / 10}',
+                    '(trk-atr) species salmon',
+                ]
+            )
+        )
+    return rows
+
+
+@pytest.mark.benchmark
+def test_viame_csv_import_throughput():
+    rows = make_csv_rows()
+    start = time.perf_counter()
+    converted, attributes = viame.load_csv_as_tracks_and_attributes(rows)
+    elapsed = time.perf_counter() - start
+    rows_per_second = ROWS / elapsed
+    print(f'viame csv import: {rows_per_second:.0f} rows/sec')
+    assert len(converted['tracks']) == ROWS // 100
+    assert set(attributes.keys()) == {'detection_occluded', 'detection_score', 'track_species'}
+    assert rows_per_second >= MIN_ROWS_PER_SECOND
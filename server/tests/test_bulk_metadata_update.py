@@ -0,0 +1,136 @@
+"""
+Unit tests for the batched ``bulk_metadata_update_process`` engine.
+"""
+
+from __future__ import annotations
+
+import pytest
+
+pytest.importorskip('girder')
+
+from bson.objectid import ObjectId  # noqa: E402
+
+from dive_server import views_metadata  # noqa: E402
+
+ROOT_ID = ObjectId()
+USER = {'_id': ObjectId()}
+
+
+def _matches(value, condition):
+    if isinstance(condition, dict):
+        return value in condition['$in']
+    return value == condition
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    datasets = [ObjectId() for _ in range(3)]
+    rows = [
+        {
+            '_id': f'row{index}',
+            'DIVEDataset': str(datasetId),
+            'root': str(ROOT_ID),
+            'filename': name,
+            'metadata': {'DIVE_Path': f'/{name}', 'old': 1},
+        }
+        for index, (datasetId, name) in enumerate(zip(datasets, ['a', 'b', 'b']))
+    ]
+    keys_doc = {
+        'root': str(ROOT_ID),
+        'owner': str(USER['_id']),
+        'metadataKeys': {'old': {'category': 'numerical', 'range': {'min': 1, 'max': 1}}},
+    }
+    calls = {'queries': [], 'writes': [], 'saves': 0, 'refresh': [], 'invalidated': []}
+
+    class FakeCollection:
+        def bulk_write(self, ops, ordered=True):
+            calls['writes'].append(ops)
+
+    class FakeMetadata:
+        collection = FakeCollection()
+
+        def find(self, query):
+            calls['queries'].append(query)
+            return [
+                row
+                for row in rows
+                if all(_matches(row[key], value) for key, value in query.items())
+            ]
+
+    class FakeKeys:
+        def findOne(self, query):
+            return keys_doc
+
+        def applyImportedKeyDescriptions(self, doc, owner, descriptions):
+            return False
+
+        def save(self, doc):
+            calls['saves'] += 1
+
+    class FakeFolder:
+        def find(self, query):
+            return [{'_id': _id} for _id in query['_id']['$in']]
+
+        def requireAccess(self, doc, user=None, level=None):
+            pass
+
+    class FakeCounts:
+        def invalidate(self, root):
+            calls['invalidated'].append(root)
+
+    def fake_refresh(root_folder, categorical_limit, keys_doc=None):
+        calls['refresh'].append(keys_doc)
+
+    monkeypatch.setattr(views_metadata, 'DIVE_Metadata', FakeMetadata)
+    monkeypatch.setattr(views_metadata, 'DIVE_MetadataKeys', FakeKeys)
+    monkeypatch.setattr(views_metadata, 'Folder', FakeFolder)
+    monkeypatch.setattr(views_metadata, 'DIVE_MetadataCounts', FakeCounts)
+    monkeypatch.setattr(
+        views_metadata, 'refresh_metadata_keys_stats_from_stored_dive_metadata', fake_refresh
+    )
+    return rows, keys_doc, calls
+
+
+def test_bulk_metadata_update_batches_queries_and_writes(fakes):
+    rows, keys_doc, calls = fakes
+    root = {'_id': ROOT_ID, 'meta': {'DIVEMetadata': True}}
+    updates = [
+        {'DIVEDataset': rows[0]['DIVEDataset'], 'color': 'red', 'old': 'nan'},
+        {'Filename': 'a', 'size': 3},
+        {'DIVE_DatasetId': rows[1]['DIVEDataset'], 'color': 'blue'},
+        {'Filename': 'b', 'color': 'green'},
+        {'Filename': 'missing', 'color': 'green'},
+    ]
+    results = views_metadata.bulk_metadata_update_process(USER, root, updates)
+
+    assert [r['status'] for r in results] == [
+        'success',
+        'success',
+        'success',
+        'not_found',
+        'not_found',
+    ]
+    assert results[3]['error'].startswith('Multiple datasets found with videoName b')
+    # One $in query per matcher type and a single bulk write
+    assert len(calls['queries']) == 2
+    assert len(calls['writes']) == 1
+    assert calls['invalidated'] == [ROOT_ID]
+    written = {op._filter['_id']: op._doc['$set']['metadata'] for op in calls['writes'][0]}
+    assert written == {
+        'row0': {'DIVE_Path': '/a', 'old': None, 'color': 'red', 'size': 3.0},
+        'row1': {'DIVE_Path': '/b', 'old': 1, 'color': 'blue'},
+    }
+    # New keys are added to the schema, which is saved once by the stats refresh
+    assert set(keys_doc['metadataKeys']) >= {'old', 'color', 'size'}
+    assert calls['refresh'] == [keys_doc]
+    assert calls['saves'] == 0
+
+
+def test_bulk_metadata_update_replace_removes_custom_keys(fakes):
+    rows, _, calls = fakes
+    root = {'_id': ROOT_ID, 'meta': {'DIVEMetadata': True}}
+    views_metadata.bulk_metadata_update_process(
+        USER, root, [{'DIVE_DatasetId': rows[0]['DIVEDataset'], 'color': 'red'}], replace=True
+    )
+    (op,) = calls['writes'][0]
+    assert op._doc['$set']['metadata'] == {'DIVE_Path': '/a', 'color': 'red'}
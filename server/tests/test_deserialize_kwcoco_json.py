@@ -1,3 +1,4 @@
+import copy
 import json
 from typing import Dict, List, Tuple
 
@@ -705,6 +706,20 @@ def test_read_kwcoco_json(
     assert json.dumps(attributes, sort_keys=True) == json.dumps(expected_attributes, sort_keys=True)
 
 
+# The importer converts bbox values in place, so each test needs its own input
+@pytest.mark.parametrize("input,expected_tracks,expected_attributes", copy.deepcopy(test_tuple))
+def test_stream_kwcoco_json(
+    input: Dict[str, List[dict]],
+    expected_tracks: Dict[str, dict],
+    expected_attributes: Dict[str, dict],
+):
+    assert kwcoco.is_track_sorted_coco(input)
+    attributes: Dict[str, dict] = {}
+    tracks = {str(track['id']): track for track in kwcoco.stream_coco_tracks(input, attributes)}
+    assert json.dumps(tracks, sort_keys=True) == json.dumps(expected_tracks, sort_keys=True)
+    assert json.dumps(attributes, sort_keys=True) == json.dumps(expected_attributes, sort_keys=True)
+
+
 def test_is_coco_json_without_info():
     assert kwcoco.is_coco_json(test_tuple[0][0])
     assert not kwcoco.is_coco_json({'tracks': {}, 'groups': {}, 'version': 2})
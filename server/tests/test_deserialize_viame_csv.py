@@ -20,3 +20,24 @@ def test_read_viame_csv(
         expected_tracks, sort_keys=True
     )
     assert json.dumps(attributes, sort_keys=True) == json.dumps(expected_attributes, sort_keys=True)
+
+
+@pytest.mark.parametrize("input,expected_tracks,expected_attributes", test_tuple)
+def test_stream_viame_csv(
+    input: List[str],
+    expected_tracks: Dict[str, dict],
+    expected_attributes: Dict[str, dict],
+):
+    if not viame.is_track_sorted_csv(input):
+        with pytest.raises(ValueError):
+            list(viame.stream_csv_tracks(input))
+        return
+    attributes: Dict[str, dict] = {}
+    tracks = {str(track['id']): track for track in viame.stream_csv_tracks(input, None, attributes)}
+    assert json.dumps(tracks, sort_keys=True) == json.dumps(expected_tracks, sort_keys=True)
+    assert json.dumps(attributes, sort_keys=True) == json.dumps(expected_attributes, sort_keys=True)
+
+
+def test_is_track_sorted_csv():
+    assert viame.is_track_sorted_csv(['# header', '1,a.png,0', '1,b.png,1', '2,a.png,0'])
+    assert not viame.is_track_sorted_csv(['1,a.png,0', '2,a.png,0', '1,b.png,1'])
@@ -0,0 +1,275 @@
+"""
+Tests for the per-frame maskRle storage and the legacy RLE_MASKS.json import.
+"""
+
+from __future__ import annotations
+
+import json
+
+import pytest
+
+pytest.importorskip('girder')
+
+from bson.objectid import ObjectId  # noqa: E402
+
+from dive_server import crud_annotation  # noqa: E402
+from dive_utils import masks, models  # noqa: E402
+
+RLE = {'size': [2, 2], 'counts': '04'}
+# Covers a 60000 x 60000 mask in a few bytes
+OVERSIZED_RLE = {'size': [60000, 60000], 'counts': 'PPYWY[3'}
+
+
+def _mask_rle_model(collection=None):
+    # Girder models connect on construction, so only the schema and collection are set up
+    instance = object.__new__(crud_annotation.MaskRleItem)
+    instance.schema = models.MaskRleItemSchema
+    instance.collection = collection
+    return instance
+
+
+@pytest.fixture
+def legacy_file(monkeypatch):
+    dataset = ObjectId()
+    mask_folder = {'_id': ObjectId(), 'parentId': dataset}
+    contents = {
+        '1': {'0': {'rle': RLE, 'file_name': '0.png'}, '1': {'rle': {}}},
+        '2': {'5': {'rle': RLE}},
+        'bad': {'0': {'rle': RLE}},
+    }
+    calls = {'writes': [], 'removed': []}
+
+    class FakeCollection:
+        def bulk_write(self, writes, ordered=True):
+            calls['writes'].extend(writes)
+
+    class FakeItem:
+        def findOne(self, query):
+            assert query['folderId'] == mask_folder['_id']
+            return {'_id': 'rle_item'}
+
+        def childFiles(self, item):
+            return iter([{'_id': 'rle_file'}])
+
+        def remove(self, item):
+            calls['removed'].append(item['_id'])
+
+    class FakeFile:
+        def download(self, file, headers=True):
+            return lambda: iter([json.dumps(contents).encode()])
+
+    model = _mask_rle_model(FakeCollection())
+    monkeypatch.setattr(crud_annotation, 'MaskRleItem', lambda: model)
+    monkeypatch.setattr(crud_annotation, 'Item', FakeItem)
+    monkeypatch.setattr(crud_annotation, 'File', FakeFile)
+    return dataset, mask_folder, calls
+
+
+def test_import_legacy_rle_masks(legacy_file):
+    dataset, mask_folder, calls = legacy_file
+    crud_annotation.import_legacy_rle_masks(mask_folder)
+
+    # Placeholder entries and non-integer tracks are skipped
+    assert [write._filter for write in calls['writes']] == [
+        {'dataset': dataset, 'track': 1, 'frame': 0},
+        {'dataset': dataset, 'track': 2, 'frame': 5},
+    ]
+    first = calls['writes'][0]._doc
+    assert first['rle'] == RLE and first['file_name'] == '0.png'
+    assert calls['writes'][1]._doc['file_name'] is None
+    assert calls['removed'] == ['rle_item']
+
+
+@pytest.fixture
+def mask_rle_collection(mongo_database):
+    """A scratch maskRle collection on the MongoDB at DIVE_TEST_MONGO_URI."""
+    collection = mongo_database[crud_annotation.MaskRleItem.NAME]
+    for keys, options in crud_annotation.MASK_RLE_INDICES:
+        collection.create_index(keys, **options)
+    return collection
+
+
+def test_legacy_json_assembles_stored_frames(mask_rle_collection):
+    model = _mask_rle_model(mask_rle_collection)
+    dataset = ObjectId()
+    entry = {'rle': RLE, 'file_name': '3.png'}
+    mask_rle_collection.bulk_write(
+        [
+            model.upsert(dataset, '7', '3', {'rle': {'size': [1, 1], 'counts': '1'}}),
+            model.upsert(dataset, 7, 3, entry),
+            model.upsert(dataset, 2, 10, {'rle': RLE}),
+            model.upsert(ObjectId(), 2, 10, entry),
+        ]
+    )
+    assert model.legacy_json({'dataset': dataset}) == {
+        '2': {'10': {'rle': RLE}},
+        '7': {'3': entry},
+    }
+
+
+def test_get_mask_json_filters_frames_and_tracks(mask_rle_collection, monkeypatch):
+    model = _mask_rle_model(mask_rle_collection)
+    monkeypatch.setattr(crud_annotation, 'MaskRleItem', lambda: model)
+    monkeypatch.setattr(crud_annotation, 'get_mask_folder', lambda folder: {'_id': ObjectId()})
+    monkeypatch.setattr(crud_annotation, 'import_legacy_rle_masks', lambda mask_folder: None)
+    dataset = {'_id': ObjectId()}
+    mask_rle_collection.bulk_write(
+        [
+            model.upsert(dataset['_id'], track, frame, {'rle': RLE})
+            for track in [1, 2]
+            for frame in range(5)
+        ]
+    )
+    assert crud_annotation.get_mask_json(dataset, 1, 2, [2]) == {
+        '2': {'1': {'rle': RLE}, '2': {'rle': RLE}}
+    }
+    assert list(crud_annotation.get_mask_json(dataset, startFrame=4)['1']) == ['4']
+    assert set(crud_annotation.get_mask_json(dataset, endFrame=0)) == {'1', '2'}
+    with pytest.raises(crud_annotation.RestException):
+        crud_annotation.get_mask_json(dataset, trackIds=['a'])
+
+
+@pytest.fixture
+def mask_tree(monkeypatch):
+    """Fake mask folder with tracks 1 and 2, each holding frames 0-2, that counts queries."""
+    dataset = {'_id': ObjectId()}
+    mask_folder = {'_id': ObjectId(), 'parentId': dataset['_id']}
+    tracks = [{'_id': ObjectId(), 'parentId': mask_folder['_id'], 'name': str(t)} for t in [1, 2]]
+    items = [
+        {'_id': ObjectId(), 'folderId': track['_id'], 'name': f'{frame}.png'}
+        for track in tracks
+        for frame in range(3)
+    ]
+    calls = {'find': 0, 'removed': []}
+
+    def _in(value, condition):
+        return value in condition['$in'] if isinstance(condition, dict) else value == condition
+
+    def _find(docs, query):
+        calls['find'] += 1
+        return [doc for doc in docs if all(_in(doc[k], c) for k, c in query.items())]
+
+    class FakeFolder:
+        def find(self, query):
+            return _find(tracks, query)
+
+        def remove(self, doc):
+            calls['removed'].append(doc['name'])
+
+    class FakeItem:
+        def find(self, query):
+            return _find(items, query)
+
+        def remove(self, doc):
+            calls['removed'].append(doc['name'])
+
+    class FakeFile:
+        def find(self, query):
+            files = [{'itemId': item['_id'], 'name': item['name']} for item in items]
+            return _find(files, query)
+
+    class FakeCollection:
+        def bulk_write(self, writes, ordered=True):
+            calls['rle_deletes'] = writes
+
+    monkeypatch.setattr(crud_annotation, 'Folder', FakeFolder)
+    monkeypatch.setattr(crud_annotation, 'Item', FakeItem)
+    monkeypatch.setattr(crud_annotation, 'File', FakeFile)
+    monkeypatch.setattr(crud_annotation, 'get_mask_folder', lambda folder: mask_folder)
+    monkeypatch.setattr(crud_annotation, 'import_legacy_rle_masks', lambda mask_folder: None)
+    model = _mask_rle_model(FakeCollection())
+    monkeypatch.setattr(crud_annotation, 'MaskRleItem', lambda: model)
+    return dataset, calls
+
+
+def test_get_mask_items_batches_lookups(mask_tree):
+    dataset, calls = mask_tree
+    pairs = [(1, 0), (1, 2), (2, 1), (2, 7), (3, 0)]
+    files = crud_annotation.get_mask_items(None, dataset, pairs)
+    assert {track: sorted(frames) for track, frames in files.items()} == {1: [0, 2], 2: [1]}
+    assert files[1][2]['name'] == '2.png'
+    # One query each for the track folders, the frame items and their files
+    assert calls['find'] == 3
+
+
+def test_delete_masks_batches_lookups(mask_tree):
+    dataset, calls = mask_tree
+    result = crud_annotation.delete_masks(None, dataset, [(1, 0), (1, 5), (2, -1), (2, 1), (4, 0)])
+    assert result == {
+        'deletedTracks': [2],
+        'deletedFrames': [(1, 0)],
+        'missingTracks': [2, 4],
+        'missingFrames': [(1, 5)],
+    }
+    assert calls['removed'] == ['0.png', '2']
+    assert calls['find'] == 2
+    assert len(calls['rle_deletes']) == 3
+
+
+def test_validate_mask_rle():
+    assert masks.validate_mask_rle({'size': [2, 2], 'counts': '04', 'area': 4}) == RLE
+    for rle in [
+        {'size': [2], 'counts': '04'},
+        {'size': [2, 0], 'counts': '04'},
+        {'size': [2, 2], 'counts': [0, 4]},
+        {'size': [2, 3], 'counts': '04'},  # Runs cover fewer pixels than the size
+        {'size': [2, 2], 'counts': '0'},  # Single run
+        {'size': [2, 2], 'counts': '0\x7f'},
+        {'size': [2, 2], 'counts': '0P'},  # Ends mid-run
+    ]:
+        with pytest.raises(ValueError):
+            masks.validate_mask_rle(rle)
+    # Sizes are checked before the runs are decoded
+    with pytest.raises(ValueError, match='larger than'):
+        masks.validate_mask_rle(OVERSIZED_RLE)
+    assert masks.validate_mask_rle(RLE, frame_size=[2, 2]) == RLE
+    with pytest.raises(ValueError, match='frame size'):
+        masks.validate_mask_rle(RLE, frame_size=[4, 4])
+
+
+@pytest.fixture
+def rle_item(monkeypatch):
+    """A mask item saved from RLE, with fakes recording the rendered PNG"""
+    dataset = {'_id': ObjectId()}
+    item = {'_id': ObjectId(), 'name': '3.png', 'meta': {}}
+    stored = {'writes': [], 'uploads': []}
+
+    class FakeCollection:
+        def bulk_write(self, writes, ordered=True):
+            stored['writes'].extend(writes)
+
+    class FakeMaskRle:
+        collection = FakeCollection()
+        upsert = _mask_rle_model().upsert
+
+    class FakeUpload:
+        def uploadFromFile(self, obj, size, name, parentType=None, parent=None, **kwargs):
+            assert (name, parent, kwargs['mimeType']) == ('3.png', item, 'image/png')
+            stored['uploads'].append(obj.read())
+            return {'_id': name}
+
+    monkeypatch.setattr(crud_annotation, 'MaskRleItem', FakeMaskRle)
+    monkeypatch.setattr(crud_annotation, 'Upload', FakeUpload)
+    monkeypatch.setattr(crud_annotation, 'get_mask_item', lambda *args: item)
+    return dataset, item, stored
+
+
+def test_set_mask_rle_attaches_rendered_png(rle_item):
+    dataset, item, stored = rle_item
+    with pytest.raises(crud_annotation.RestException):
+        crud_annotation.set_mask_rle(None, dataset, 7, 3, {'size': [2, 3], 'counts': '04'})
+    assert not stored['uploads'] and not stored['writes']
+
+    with pytest.raises(crud_annotation.RestException) as oversized:
+        crud_annotation.set_mask_rle(None, dataset, 7, 3, OVERSIZED_RLE)
+    assert oversized.value.code == 400
+    video = {**dataset, 'meta': {'ffprobe_info': {'width': 1920, 'height': 1080}}}
+    with pytest.raises(crud_annotation.RestException):
+        crud_annotation.set_mask_rle(None, video, 7, 3, RLE)
+    assert not stored['uploads'] and not stored['writes']
+
+    entry = crud_annotation.set_mask_rle(None, dataset, 7, 3, RLE)
+    assert entry == {'rle': RLE, 'file_name': '3.png'}
+    assert stored['writes'][0]._filter == {'dataset': dataset['_id'], 'track': 7, 'frame': 3}
+    (png,) = stored['uploads']
+    assert masks.encode_mask_png(png) == RLE
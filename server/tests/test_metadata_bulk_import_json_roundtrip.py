@@ -6,6 +6,7 @@ Integration-style tests: bulk CSV / JSON import shapes must serialize with
 
 from __future__ import annotations
 
+import csv
 import io
 import json
 
@@ -14,8 +15,12 @@ import pytest
 
 pytest.importorskip('girder')
 
+from dive_server import views_metadata  # noqa: E402
 from dive_server.views_metadata import (  # noqa: E402
     _loads_metadata_import_json,
+    _metadata_fieldnames_for_export,
+    _stream_metadata_csv,
+    _stream_metadata_json,
     normalize_metadata_row_for_storage,
 )
 from dive_utils.metadata.numeric import (  # noqa: E402
@@ -105,3 +110,50 @@ def test_filter_page_results_like_filter_folder_round_trip():
         'filtered': 1,
     }
     _assert_strict_json(structured)
+
+
+EXPORT_ROWS = [
+    {
+        'DIVEDataset': f'ds{index}',
+        'filename': f'video_{index}.mp4',
+        'root': 'rootid',
+        'metadata': {'Score': float('nan') if index % 2 else index, 'filename': 'dup'},
+    }
+    for index in range(5)
+]
+
+
+@pytest.mark.integration
+def test_streamed_metadata_csv_export(monkeypatch):
+    """Rows are written in chunks under headers taken from the schema keys."""
+    monkeypatch.setattr(views_metadata, 'METADATA_EXPORT_CHUNK_ROWS', 2)
+    headers = _metadata_fieldnames_for_export({'Score': {}, 'Label': {}, 'Filename': {}})
+    assert headers == ['Label', 'Score']
+    chunks = list(_stream_metadata_csv(iter(EXPORT_ROWS), headers, 'http://dive/#/viewer/'))
+    assert len(chunks) == 3
+    rows = list(csv.DictReader(io.StringIO(''.join(chunks))))
+    assert len(rows) == 5
+    assert rows[0] == {
+        'DIVEDataset': 'ds0',
+        'Filename': 'video_0.mp4',
+        'DIVE_URL': 'http://dive/#/viewer/ds0?diveMetadataRootId=rootid',
+        'Label': '',
+        'Score': '0',
+    }
+    assert rows[1]['Score'] == ''
+
+
+@pytest.mark.integration
+def test_streamed_metadata_json_export():
+    exported = json.loads(
+        ''.join(_stream_metadata_json(iter(EXPORT_ROWS), 'http://dive/#/viewer/'))
+    )
+    _assert_strict_json(exported)
+    assert [item['DIVEDataset'] for item in exported] == [f'ds{index}' for index in range(5)]
+    assert exported[1] == {
+        'Score': '',
+        'DIVEDataset': 'ds1',
+        'Filename': 'video_1.mp4',
+        'DIVE_URL': 'http://dive/#/viewer/ds1?diveMetadataRootId=rootid',
+    }
+    assert json.loads(''.join(_stream_metadata_json(iter([]), ''))) == []
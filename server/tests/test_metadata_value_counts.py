@@ -0,0 +1,248 @@
+"""Unit tests for incremental key stats and search tokens in dive_utils.metadata.models."""
+
+from __future__ import annotations
+
+from collections import Counter
+
+import pytest
+
+pytest.importorskip('girder')
+
+from dive_utils.metadata import models  # noqa: E402
+
+ROOT = 'root'
+
+
+class FakeValueCounts:
+    counters: dict = {}
+    rebuilt: list = []
+
+    def applyDelta(self, root, key, delta):
+        counter = self.counters.setdefault((root, key), Counter())
+        counter.update(delta)
+        for value in [value for value, count in counter.items() if count <= 0]:
+            del counter[value]
+
+    def uniqueCount(self, root, key):
+        return len(self.counters.get((root, key), {}))
+
+    def values(self, root, key):
+        return list(self.counters.get((root, key), {}))
+
+    def rebuildKey(self, root, key, array_key):
+        self.rebuilt.append(key)
+        self.counters[(root, key)] = Counter({'seed': 2})
+        return 2
+
+
+class FakeMetadata:
+    stats: dict = {}
+
+    def numericKeyStats(self, root, key):
+        return self.stats.get(key)
+
+
+@pytest.fixture
+def keys_model(monkeypatch):
+    FakeValueCounts.counters = {}
+    FakeValueCounts.rebuilt = []
+    FakeMetadata.stats = {}
+    monkeypatch.setattr(models, 'DIVE_MetadataValueCounts', FakeValueCounts)
+    monkeypatch.setattr(models, 'DIVE_Metadata', FakeMetadata)
+    # The change tracking does not touch the DIVE_MetadataKeys collection itself
+    return object.__new__(models.DIVE_MetadataKeys)
+
+
+def _keys_doc(**buckets):
+    return {'root': ROOT, 'metadataKeys': buckets}
+
+
+def test_counted_metadata_values():
+    assert models.counted_metadata_values(False, 'Y') == ['Y']
+    assert models.counted_metadata_values(False, 3) == [3]
+    assert models.counted_metadata_values(False, '  ') == []
+    assert models.counted_metadata_values(False, float('nan')) == []
+    assert models.counted_metadata_values(False, ['a']) == []
+    assert models.counted_metadata_values(True, ['a', ' ', 1, 'b']) == ['a', 'b']
+    assert models.counted_metadata_values(True, 'a') == []
+
+
+def test_unseeded_key_is_rebuilt_from_stored_rows(keys_model):
+    doc = _keys_doc(flag={'category': 'categorical', 'type': 'string', 'set': ['x'], 'count': 9})
+    assert keys_model.applyValueChanges(doc, {'flag': (None, 'Y')}, 50)
+    assert FakeValueCounts.rebuilt == ['flag']
+    bucket = doc['metadataKeys']['flag']
+    assert bucket['counted'] is True
+    assert bucket['count'] == 2
+    assert bucket['set'] == ['seed']
+    assert bucket['unique'] == 1
+
+
+def test_categorical_limit_transitions_both_ways(keys_model):
+    doc = _keys_doc(
+        flag={'category': 'categorical', 'type': 'string', 'set': [], 'count': 0, 'counted': True}
+    )
+    for value in ['a', 'b']:
+        keys_model.applyValueChanges(doc, {'flag': (None, value)}, 3)
+    bucket = doc['metadataKeys']['flag']
+    assert bucket['category'] == 'categorical'
+    assert sorted(bucket['set']) == ['a', 'b']
+    assert bucket['count'] == 2
+
+    keys_model.applyValueChanges(doc, {'flag': (None, 'c')}, 3)
+    assert bucket['category'] == 'search'
+    assert 'set' not in bucket
+    assert bucket['unique'] == 3
+
+    # Replacing the only 'c' drops back under the limit
+    keys_model.applyValueChanges(doc, {'flag': ('c', 'a')}, 3)
+    assert bucket['category'] == 'categorical'
+    assert sorted(bucket['set']) == ['a', 'b']
+    assert bucket['count'] == 3
+
+    keys_model.applyValueChanges(doc, {'flag': ('a', None)}, 3)
+    assert sorted(bucket['set']) == ['a', 'b']
+    assert bucket['count'] == 2
+    assert FakeValueCounts.counters[(ROOT, 'flag')] == {'a': 1, 'b': 1}
+
+
+def test_array_key_counts_rows_and_elements(keys_model):
+    doc = _keys_doc(
+        tags={'category': 'categorical', 'type': 'array', 'set': [], 'count': 0, 'counted': True}
+    )
+    keys_model.applyValueChanges(doc, {'tags': (None, ['a', 'b', ' '])}, 50)
+    keys_model.applyValueChanges(doc, {'tags': (None, ['a'])}, 50)
+    keys_model.applyValueChanges(doc, {'tags': (['a', 'b', ' '], [' '])}, 50)
+    bucket = doc['metadataKeys']['tags']
+    assert bucket['count'] == 1
+    assert bucket['set'] == ['a']
+
+
+def test_numerical_range_is_flagged_and_rebuilt_lazily(keys_model):
+    doc = _keys_doc(
+        size={
+            'category': 'numerical',
+            'range': {'min': 1.0, 'max': 9.0},
+            'count': 3,
+            'counted': True,
+        }
+    )
+    keys_model.applyValueChanges(doc, {'size': (5, 6)}, 50)
+    bucket = doc['metadataKeys']['size']
+    assert bucket['count'] == 3
+    assert 'rangeStale' not in bucket
+
+    keys_model.applyValueChanges(doc, {'size': (9, None)}, 50)
+    assert bucket['count'] == 2
+    assert bucket['rangeStale'] is True
+    assert bucket['range'] == {'min': 1.0, 'max': 9.0}
+
+    FakeMetadata.stats['size'] = {'count': 2, 'min': 1.0, 'max': 6.0}
+    assert keys_model.rebuildStaleRanges(doc)
+    assert bucket['range'] == {'min': 1.0, 'max': 6.0}
+    assert 'rangeStale' not in bucket
+    assert not keys_model.rebuildStaleRanges(doc)
+
+
+def test_unchanged_and_other_keys_are_ignored(keys_model):
+    doc = _keys_doc(
+        flag={'category': 'categorical', 'set': ['Y'], 'count': 1, 'counted': True},
+        done={'category': 'boolean'},
+    )
+    assert not keys_model.applyValueChanges(
+        doc, {'flag': ('Y', 'Y'), 'done': (None, True), 'missing': (None, 1)}, 50
+    )
+    assert FakeValueCounts.counters == {}
+
+
+def test_metadata_search_tokens():
+    tokens = models.metadata_search_tokens(
+        'Fish_2024.mp4',
+        {'note': 'Big reef', 'tags': ['Day', 3], 'size': 4, 'site': 'North'},
+        ['note', 'tags', 'size', 'missing'],
+    )
+    assert 'f:f' in tokens and 'f:fish_2024' in tokens and 'f:mp4' in tokens
+    assert {'m:note:b', 'm:note:big', 'm:note:reef', 'm:tags:day'} <= set(tokens)
+    assert not any(token.startswith('m:size:') for token in tokens)
+    # Only search keys are tokenized
+    assert not any(token.startswith('m:site:') for token in tokens)
+    long_word = 'x' * (models.SEARCH_TOKEN_PREFIX_LENGTH + 5)
+    longest = max(models.metadata_search_tokens(long_word, {}), key=len)
+    assert longest == 'f:' + long_word[: models.SEARCH_TOKEN_PREFIX_LENGTH]
+
+
+def test_search_query_tokens_are_a_subset_of_matching_row_tokens():
+    row_tokens = set(models.metadata_search_tokens('a', {'note': 'Big Reef-Survey'}, ['note']))
+    assert models.search_query_tokens('note', 'reef sur') == ['m:note:reef', 'm:note:sur']
+    assert set(models.search_query_tokens('note', 'reef sur')) <= row_tokens
+    assert not set(models.search_query_tokens('note', 'eef')) <= row_tokens
+    assert models.search_query_tokens(None, '--') == []
+
+
+def test_unique_row_index_falls_back_while_duplicates_remain():
+    from pymongo.errors import OperationFailure
+
+    created = []
+
+    class FakeCollection:
+        def create_index(self, keys, **options):
+            if options.get('unique') or options.get('name') == 'conflict':
+                raise OperationFailure('E11000 duplicate key error', code=11000)
+            created.append((keys, options))
+
+        def drop_index(self, keys):
+            raise OperationFailure('index not found', code=27)
+
+    model = object.__new__(models.DIVE_Metadata)
+    model.collection = FakeCollection()
+    keys = [('root', 1), ('DIVEDataset', 1)]
+    model._createIndex((keys, {'unique': True}))
+    assert created == [(keys, {})]
+
+    # Failures building other indexes are not hidden
+    with pytest.raises(OperationFailure):
+        model._createIndex(([('root', 1)], {'unique': False, 'name': 'conflict'}))
+
+
+def test_cached_counts_keep_only_recent_queries(mongo_database, monkeypatch):
+    rows = mongo_database['DIVE_Metadata']
+    rows.insert_many([{'root': ROOT, 'DIVEDataset': str(index)} for index in range(5)])
+
+    class FakeDIVEMetadata:
+        collection = rows
+
+    monkeypatch.setattr(models, 'DIVE_Metadata', FakeDIVEMetadata)
+    monkeypatch.setattr(models, 'METADATA_COUNTS_MAX_QUERIES', 3)
+    counts = object.__new__(models.DIVE_MetadataCounts)
+    counts.collection = mongo_database['DIVE_MetadataCounts']
+
+    queries = [{'root': ROOT, 'DIVEDataset': {'$gte': str(index)}} for index in range(5)]
+    assert [counts.count(ROOT, query) for query in queries] == [5, 4, 3, 2, 1]
+    assert len(counts.collection.find_one({'root': ROOT})['counts']) == 3
+
+    # Cached counts are served until a write invalidates them
+    rows.insert_one({'root': ROOT, 'DIVEDataset': '9'})
+    assert counts.count(ROOT, queries[4]) == 1
+    counts.invalidate(ROOT)
+    assert counts.count(ROOT, queries[4]) == 2
+
+
+def test_search_keys_change_retokenizes_rows(monkeypatch):
+    retokenized = []
+    stored = {'_id': 'keys', 'root': 'root', 'metadataKeys': {'note': {'category': 'search'}}}
+
+    class FakeMetadata:
+        def updateSearchTokens(self, root, search_keys):
+            retokenized.append((root, search_keys))
+
+    keys_model = object.__new__(models.DIVE_MetadataKeys)
+    monkeypatch.setattr(models, 'DIVE_Metadata', FakeMetadata)
+    monkeypatch.setattr(models.Model, 'save', lambda self, doc, *args, **kwargs: doc)
+    monkeypatch.setattr(keys_model, 'findOne', lambda query, fields=None: stored, raising=False)
+
+    doc = {**stored, 'metadataKeys': {'note': {'category': 'search', 'count': 2}}}
+    keys_model.save(doc)
+    assert retokenized == []
+    doc['metadataKeys']['site'] = {'category': 'search'}
+    keys_model.save(doc)
+    assert retokenized == [('root', {'note', 'site'})]
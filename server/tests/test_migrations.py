@@ -0,0 +1,129 @@
+"""Unit tests for recording completed migration steps."""
+
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('girder')
+
+from scripts import migrations  # noqa: E402
+
+
+class FakeMigrations:
+    def __init__(self, completed):
+        self.completed = set(completed)
+
+    def find(self, query, projection):
+        return [{'_id': name} for name in self.completed]
+
+    def update_one(self, query, update, upsert=False):
+        self.completed.add(query['_id'])
+
+
+@pytest.fixture
+def steps(monkeypatch):
+    ran = []
+    recorded = FakeMigrations(['indices'])
+    database = {migrations.MIGRATIONS_COLLECTION: recorded}
+    monkeypatch.setattr(
+        migrations, 'getDbConnection', lambda: SimpleNamespace(get_database=lambda: database)
+    )
+    monkeypatch.setattr(
+        migrations,
+        'MIGRATION_STEPS',
+        [
+            (name, lambda dry_run, limit, name=name: ran.append(name), on_start)
+            for name, on_start in [('indices', True), ('dedupe', False), ('backfill', True)]
+        ],
+    )
+    return ran, recorded
+
+
+def test_server_start_skips_completed_and_destructive_steps(steps):
+    ran, recorded = steps
+    migrations.run_migrations(on_start=True)
+    assert ran == ['backfill']
+    migrations.run_migrations(on_start=True)
+    assert ran == ['backfill']
+    assert recorded.completed == {'indices', 'backfill'}
+
+
+def test_explicit_migrate_runs_every_step(steps):
+    ran, recorded = steps
+    migrations.run_migrations(limit=5)
+    assert ran == ['indices', 'dedupe', 'backfill']
+    # Partial runs are not recorded as complete
+    assert recorded.completed == {'indices'}
+    migrations.run_migrations()
+    assert recorded.completed == {'indices', 'dedupe', 'backfill'}
+
+
+class FakeCollection:
+    def __init__(self, rows=()):
+        self.name = 'DIVE_Metadata'
+        self.rows = list(rows)
+        self.updates = []
+
+    def find(self, query, projection):
+        return [row for row in self.rows if row.items() >= query.items()]
+
+    def find_one(self, query):
+        return next(iter(self.find(query, None)), None)
+
+    def distinct(self, key):
+        return sorted({row[key] for row in self.rows})
+
+    def bulk_write(self, writes, ordered=True):
+        self.updates.extend(writes)
+
+    def update_many(self, query, update):
+        self.updates.append((query, update))
+
+
+def test_sanitize_invalidates_counts_of_rewritten_roots(monkeypatch):
+    metadata = FakeCollection(
+        [
+            {'_id': 1, 'root': 'a', 'metadata': {'x': float('nan')}},
+            {'_id': 2, 'root': 'b', 'metadata': {'x': 1}},
+        ]
+    )
+    counts = FakeCollection()
+    database = {'DIVE_Metadata': metadata, 'DIVE_MetadataCounts': counts}
+    monkeypatch.setattr(
+        migrations, 'getDbConnection', lambda: SimpleNamespace(get_database=lambda: database)
+    )
+    monkeypatch.setattr(migrations, 'build_index', lambda *args: None)
+    migrations.sanitize_dive_metadata(dry_run=False)
+    assert len(metadata.updates) == 1
+    assert counts.updates == [
+        ({'root': {'$in': ['a']}}, {'$inc': {'generation': 1}, '$unset': {'counts': ''}})
+    ]
+
+
+def test_search_tokens_only_cover_search_keys(monkeypatch):
+    metadata = FakeCollection(
+        [
+            {'_id': 1, 'root': 'a', 'filename': 'cam', 'metadata': {'note': 'reef', 'site': 'n'}},
+            {'_id': 2, 'root': 'b', 'filename': 'cam', 'metadata': {'note': 'reef', 'site': 'n'}},
+        ]
+    )
+    keys = FakeCollection([{'root': 'a', 'metadataKeys': {'note': {'category': 'search'}}}])
+    database = {
+        'DIVE_Metadata': metadata,
+        'DIVE_MetadataKeys': keys,
+        'DIVE_MetadataCounts': FakeCollection(),
+    }
+    monkeypatch.setattr(
+        migrations, 'getDbConnection', lambda: SimpleNamespace(get_database=lambda: database)
+    )
+    monkeypatch.setattr(migrations, 'build_index', lambda *args: None)
+    migrations.tokenize_dive_metadata(dry_run=False, limit=0)
+    tokens = {
+        write._filter['_id']: write._doc['$set']['searchTokens'] for write in metadata.updates
+    }
+    assert 'm:note:reef' in tokens[1]
+    assert not any(token.startswith('m:site:') for token in tokens[1])
+    # Roots without metadata keys only have filename tokens
+    assert all(token.startswith('f:') for token in tokens[2])
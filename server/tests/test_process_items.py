@@ -0,0 +1,31 @@
+"""Unit tests for parsing annotation files in process_items worker processes."""
+
+from __future__ import annotations
+
+import pytest
+
+pytest.importorskip('girder')
+
+from dive_server import crud_rpc  # noqa: E402
+
+SORTED_CSV = (
+    '1,a.png,0,0,0,1,1,1,-1,fish,1\n1,b.png,1,0,0,1,1,1,-1,fish,1\n2,a.png,0,0,0,1,1,1,-1\n'
+)
+UNSORTED_CSV = '1,a.png,0,0,0,1,1,1,-1\n2,a.png,0,0,0,1,1,1,-1\n1,b.png,1,0,0,1,1,1,-1\n'
+
+
+def test_workers_hand_back_track_sorted_csv(tmp_path):
+    sorted_path = tmp_path / 'sorted.csv'
+    sorted_path.write_text(SORTED_CSV)
+    assert crud_rpc._parse_file_source(['csv'], str(sorted_path), stream_tracks=True) is None
+    # Additive imports renumber tracks, so every track is held in memory anyway
+    parsed = crud_rpc._parse_file_source(['csv'], str(sorted_path), stream_tracks=False)
+    assert sorted(parsed['annotations']['tracks']) == ['1', '2']
+
+
+def test_parse_file_source_reads_unsorted_csv_in_full(tmp_path):
+    path = tmp_path / 'unsorted.csv'
+    path.write_text(UNSORTED_CSV)
+    parsed = crud_rpc._parse_file_source(['csv'], str(path), stream_tracks=True)
+    assert sorted(parsed['annotations']['tracks']) == ['1', '2']
+    assert parsed['trackStream'] is None
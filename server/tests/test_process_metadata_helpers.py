@@ -10,23 +10,57 @@ import pytest
 
 pytest.importorskip('girder')
 
+from bson.objectid import ObjectId  # noqa: E402
+from girder.exceptions import RestException  # noqa: E402
+
 from dive_server.views_metadata import (  # noqa: E402
     _PROCESS_METADATA_DISPLAY_DEFAULT,
     _PROCESS_METADATA_FFPROBE_DEFAULT,
+    DIVEMetadata,
     _accumulate_flat_metadata_key_stats,
+    _aggregate_metadata_key_stats,
     _categorical_limit_from_metadata_folder,
+    _decode_filter_cursor,
+    _decode_metadata_facets,
     _display_config_from_metadata_folder,
+    _encode_filter_cursor,
+    _filter_cursor_query,
     _finalize_metadata_keys_categories,
     _get_recursive_dive_metadata_folders,
     _is_blank_metadata_value_for_stats,
     _is_dive_metadata_folder,
-    _metadata_folder_name_for_dataset_folder,
     _merge_recomputed_metadata_key_stats_into_existing,
     _metadata_dict_for_schema_stats_refresh,
+    _metadata_facet_keys,
+    _metadata_facets_pipeline,
+    _metadata_folder_name_for_dataset_folder,
+    _metadata_row_keys_pipeline,
     _normalize_metadata_config,
+    _search_filter_query,
+    process_metadata_task,
     remove_before_folder,
 )
 from dive_utils.constants import DIVEMetadataFilter  # noqa: E402
+from dive_utils.metadata.models import metadata_search_tokens  # noqa: E402
+
+BLANK_STRING_ROWS = (
+    {'k': ''},
+    {'k': '  '},
+    {'k': 'Y'},
+    {'k': None},
+    {'k': 'Y'},
+)
+CATEGORICAL_ROWS = (
+    {'stricture_flag': 'Y'},
+    {'stricture_flag': 'N'},
+    {'stricture_flag': 'Y'},
+)
+MIXED_ROWS = (
+    {'size': 3, 'tags': ['a', ' ', 'b'], 'DIVE_Name': 'x', 'note': 'free text 1', 'ok': True},
+    {'size': 2.5, 'tags': ['', '  '], 'ffprobe_width': 1920, 'note': 'free text 2'},
+    {'size': float('nan'), 'tags': ['b', 1], 'note': 7, 'shape': {'w': 1}, 'empty': {}},
+    {'size': '11', 'tags': [], 'note': 'free text 1', 'LastModifiedBy': 'me'},
+)
 
 
 @pytest.mark.parametrize(
@@ -137,13 +171,7 @@ def test_is_blank_metadata_value_for_stats():
 
 def test_accumulate_metadata_key_stats_skips_blank_strings_for_count():
     accum = {}
-    for meta in (
-        {'k': ''},
-        {'k': '  '},
-        {'k': 'Y'},
-        {'k': None},
-        {'k': 'Y'},
-    ):
+    for meta in BLANK_STRING_ROWS:
         _accumulate_flat_metadata_key_stats(accum, meta)
     _finalize_metadata_keys_categories(accum, categorical_limit=50)
     assert accum['k']['count'] == 2
@@ -153,11 +181,7 @@ def test_accumulate_metadata_key_stats_skips_blank_strings_for_count():
 def test_merge_recomputed_metadata_key_stats_matches_process_metadata_shape():
     """After bulk refresh, categorical keys should carry count / type / unique like process_metadata."""
     accum = {}
-    for meta in (
-        {'stricture_flag': 'Y'},
-        {'stricture_flag': 'N'},
-        {'stricture_flag': 'Y'},
-    ):
+    for meta in CATEGORICAL_ROWS:
         _accumulate_flat_metadata_key_stats(accum, meta)
     _finalize_metadata_keys_categories(accum, categorical_limit=50)
     existing = {
@@ -181,6 +205,216 @@ def test_merge_recomputed_metadata_key_stats_matches_process_metadata_shape():
     assert merged['note']['description'] == 'kept'
 
 
+@pytest.fixture
+def metadata_collection(mongo_database, monkeypatch):
+    """A scratch DIVE_Metadata collection on the MongoDB at DIVE_TEST_MONGO_URI."""
+    collection = mongo_database['DIVE_Metadata']
+    collection.create_index([('root', 1), ('DIVEDataset', 1)])
+
+    class FakeDIVEMetadata:
+        def __init__(self):
+            self.collection = collection
+
+    monkeypatch.setattr('dive_server.views_metadata.DIVE_Metadata', FakeDIVEMetadata)
+    return collection
+
+
+@pytest.mark.parametrize('rows', [BLANK_STRING_ROWS, CATEGORICAL_ROWS, MIXED_ROWS])
+@pytest.mark.parametrize('categorical_limit', [2, 50])
+def test_aggregate_metadata_key_stats_matches_python(metadata_collection, rows, categorical_limit):
+    """The aggregation refresh must produce the same schema stats as the per-row accumulator."""
+    metadata_collection.insert_many(
+        [
+            {'root': 'root', 'DIVEDataset': f'{index:04d}', 'metadata': dict(meta)}
+            for index, meta in enumerate(rows)
+        ]
+        + [{'root': 'other', 'DIVEDataset': '0000', 'metadata': {'k': 'other root'}}]
+    )
+    expected = {}
+    for meta in rows:
+        _accumulate_flat_metadata_key_stats(expected, _metadata_dict_for_schema_stats_refresh(meta))
+    _finalize_metadata_keys_categories(expected, categorical_limit)
+
+    actual = _aggregate_metadata_key_stats('root', categorical_limit)
+    _finalize_metadata_keys_categories(actual, categorical_limit)
+
+    assert actual.keys() == expected.keys()
+    for key, bucket in expected.items():
+        if 'set' in bucket:
+            assert sorted(map(str, actual[key].pop('set'))) == sorted(map(str, bucket.pop('set')))
+        assert actual[key] == bucket
+
+
+FACET_SCHEMA = {
+    'DIVE_Path': {'category': 'search'},
+    'flag': {'category': 'categorical', 'set': ['Y', 'N']},
+    'tags': {'category': 'categorical', 'set': ['a', 'b']},
+    'done': {'category': 'boolean'},
+    'size': {'category': 'numerical', 'range': {'min': 0.0, 'max': 10.0}},
+    'constant': {'category': 'numerical', 'range': {'min': 4.0, 'max': 4.0}},
+    'note': {'category': 'search'},
+}
+FACET_ROWS = (
+    {'flag': 'Y', 'tags': ['a', 'b'], 'done': True, 'size': 0, 'constant': 4},
+    {'flag': 'Y', 'tags': ['a'], 'done': False, 'size': 10.0, 'constant': 4},
+    {'flag': 'N', 'size': 4.99, 'note': 'x'},
+    {'flag': None, 'size': 'text'},
+)
+
+
+def test_metadata_facet_keys_selects_filterable_keys():
+    assert list(_metadata_facet_keys(FACET_SCHEMA)) == ['flag', 'tags', 'done', 'size', 'constant']
+    assert list(_metadata_facet_keys(FACET_SCHEMA, ['size', 'note', 'missing'])) == ['size']
+
+
+def test_decode_metadata_facets_fills_empty_bins():
+    facet_keys = _metadata_facet_keys(FACET_SCHEMA, ['flag', 'size', 'constant'])
+    facet, names = _metadata_facets_pipeline(facet_keys, bins=4, value_limit=5)
+    assert set(facet['$facet']) == {'total', *names.values()}
+    result = {
+        'total': [{'count': 3}],
+        names['flag']: [{'_id': 'Y', 'count': 2}],
+        names['size']: [{'_id': 0, 'count': 1}, {'_id': 3, 'count': 2}],
+        names['constant']: [{'_id': 0, 'count': 2}],
+    }
+    decoded = _decode_metadata_facets(result, facet_keys, names, bins=4)
+    assert decoded['count'] == 3
+    assert decoded['facets']['flag'] == {
+        'category': 'categorical',
+        'values': [{'value': 'Y', 'count': 2}],
+    }
+    assert decoded['facets']['size']['histogram'] == [
+        {'min': 0.0, 'max': 2.5, 'count': 1},
+        {'min': 2.5, 'max': 5.0, 'count': 0},
+        {'min': 5.0, 'max': 7.5, 'count': 0},
+        {'min': 7.5, 'max': 10.0, 'count': 2},
+    ]
+    assert decoded['facets']['constant']['histogram'] == [{'min': 4.0, 'max': 4.0, 'count': 2}]
+
+
+def test_metadata_facets_pipeline_counts_rows(metadata_collection):
+    metadata_collection.insert_many(
+        [
+            {'root': 'root', 'DIVEDataset': str(index), 'metadata': meta}
+            for index, meta in enumerate(FACET_ROWS)
+        ]
+    )
+    facet_keys = _metadata_facet_keys(FACET_SCHEMA)
+    facet, names = _metadata_facets_pipeline(facet_keys, bins=2, value_limit=1)
+    (result,) = metadata_collection.aggregate([{'$match': {'root': 'root'}}, facet])
+    decoded = _decode_metadata_facets(result, facet_keys, names, bins=2)
+    assert decoded['count'] == 4
+    facets = decoded['facets']
+    assert facets['flag']['values'] == [{'value': 'Y', 'count': 2}]
+    assert facets['tags']['values'] == [{'value': 'a', 'count': 2}]
+    assert [bin['count'] for bin in facets['size']['histogram']] == [2, 1]
+    assert [bin['count'] for bin in facets['constant']['histogram']] == [2]
+
+
+def test_filter_cursor_round_trip():
+    row = {'_id': ObjectId(), 'metadata': {'size': 3.5}}
+    token = _encode_filter_cursor(row, 'metadata.size', -1)
+    assert _decode_filter_cursor(token, 'metadata.size', -1) == (3.5, row['_id'])
+    with pytest.raises(RestException):
+        _decode_filter_cursor(token, 'filename', -1)
+    with pytest.raises(RestException):
+        _decode_filter_cursor('not a cursor', 'metadata.size', -1)
+    # Missing sort values resume like nulls
+    token = _encode_filter_cursor({'_id': row['_id'], 'metadata': {}}, 'metadata.size', 1)
+    assert _decode_filter_cursor(token, 'metadata.size', 1) == (None, row['_id'])
+
+
+@pytest.mark.parametrize('direction', [1, -1])
+def test_filter_cursor_pages_cover_every_row_once(metadata_collection, direction):
+    rows = [
+        {'_id': ObjectId(), 'root': 'root', 'DIVEDataset': str(index), 'filename': name}
+        for index, name in enumerate(['b', 'a', None, 'b', 'c', None, 'a', 'b'])
+    ]
+    for row in rows:
+        if row['filename'] is None:
+            del row['filename']
+    metadata_collection.insert_many(rows)
+    sort = [('filename', direction), ('_id', direction)]
+    expected = [row['_id'] for row in metadata_collection.find({'root': 'root'}, sort=sort)]
+
+    seen = []
+    query = {'root': 'root'}
+    while True:
+        page = list(metadata_collection.find(query, sort=sort, limit=3))
+        seen += [row['_id'] for row in page]
+        if len(page) < 3:
+            break
+        token = _encode_filter_cursor(page[-1], 'filename', direction)
+        value, last_id = _decode_filter_cursor(token, 'filename', direction)
+        query = {
+            '$and': [{'root': 'root'}, _filter_cursor_query('filename', direction, value, last_id)]
+        }
+    assert seen == expected
+
+
+def test_search_filter_query_falls_back_to_regex_without_words():
+    assert _search_filter_query('filename', None, '.*') == {'filename': {'$regex': r'\.\*'}}
+    query = _search_filter_query('metadata.note', 'note', 'reef sur')
+    indexed, substring = query['$and']
+    assert indexed['$or'][0] == {'searchTokens': {'$all': ['m:note:reef', 'm:note:sur']}}
+    assert substring == {'metadata.note': {'$regex': 'reef\\ sur'}}
+
+
+def test_filter_query_searches_substrings_unless_prefix_is_requested(monkeypatch):
+    class FakeMetadataKeys:
+        def searchKeys(self, root):
+            return {'note'}
+
+    monkeypatch.setattr('dive_server.views_metadata.DIVE_MetadataKeys', FakeMetadataKeys)
+
+    def search_clauses(filters):
+        return DIVEMetadata.get_filter_query(None, {'_id': 'root'}, None, filters)['$and'][1:]
+
+    filters = {
+        'search': 'cam1_2024',
+        'metadataFilters': {'note': {'category': 'search', 'value': '2024'}},
+    }
+    assert search_clauses(filters) == [
+        {'filename': {'$regex': 'cam1_2024'}},
+        {'metadata.note': {'$regex': '2024'}},
+    ]
+    filters['searchPrefix'] = True
+    filters['metadataFilters']['note']['prefix'] = True
+    assert search_clauses(filters) == [
+        _search_filter_query('filename', None, 'cam1_2024'),
+        _search_filter_query('metadata.note', 'note', '2024'),
+    ]
+    # Rows have no search tokens for keys outside the search category
+    filters['metadataFilters'] = {'site': {'category': 'search', 'value': 'n', 'prefix': True}}
+    assert search_clauses(filters)[1] == {'metadata.site': {'$regex': 'n'}}
+
+
+def test_search_filter_query_matches_prefixes(metadata_collection):
+    notes = ['big reef survey', 'reef', 'coral reefs', 'big reef-survey']
+    rows = [
+        {
+            'root': 'root',
+            'DIVEDataset': str(index),
+            'filename': f'video{index}',
+            'metadata': {'note': note},
+            'searchTokens': metadata_search_tokens(f'video{index}', {'note': note}, ['note']),
+        }
+        for index, note in enumerate(notes)
+    ]
+    # Rows written before search tokens still match through the regex
+    rows.append({'root': 'root', 'DIVEDataset': 'legacy', 'metadata': {'note': 'old reef survey'}})
+    metadata_collection.insert_many(rows)
+
+    def matches(text):
+        query = {'$and': [{'root': 'root'}, _search_filter_query('metadata.note', 'note', text)]}
+        return sorted(row['DIVEDataset'] for row in metadata_collection.find(query))
+
+    assert matches('reef') == ['0', '1', '2', '3', 'legacy']
+    assert matches('reef sur') == ['0', 'legacy']
+    # Substrings inside a word are not prefix matches, except on rows without tokens
+    assert matches('eef') == ['legacy']
+
+
 def test_get_recursive_dive_metadata_folders_finds_nested_and_skips_target(monkeypatch):
     """Walk a small folder tree and collect DIVEMetadata folders, skipping the destination."""
     root = {'_id': 'root', 'meta': {}}
@@ -219,3 +453,60 @@ def test_get_recursive_dive_metadata_folders_includes_root_when_marked(monkeypat
     found = []
     _get_recursive_dive_metadata_folders(root, user=None, results=found)
     assert [f['_id'] for f in found] == ['meta-root']
+
+
+def test_metadata_row_keys_pipeline_lists_keys_of_matching_rows(metadata_collection):
+    metadata_collection.insert_many(
+        [
+            {'root': 'root', 'DIVEDataset': '1', 'metadata': {'DIVE_Path': 'a', 'Score': 1}},
+            {'root': 'root', 'DIVEDataset': '2', 'metadata': {'DIVE_Name': 'b', 'Score': 2}},
+            {'root': 'root', 'DIVEDataset': '3'},
+            {'root': 'other', 'DIVEDataset': '4', 'metadata': {'Hidden': 1}},
+        ]
+    )
+    rows = metadata_collection.aggregate(_metadata_row_keys_pipeline({'root': 'root'}))
+    assert sorted(row['_id'] for row in rows) == ['DIVE_Name', 'DIVE_Path', 'Score']
+
+
+@pytest.mark.parametrize(
+    'result,status',
+    [
+        ({'dataFileName': 'a.ndjson', 'results': 'added 2 folders', 'errors': []}, 'SUCCESS'),
+        (None, 'ERROR'),
+        (RuntimeError('boom'), 'ERROR'),
+    ],
+)
+def test_process_metadata_task_reports_job_status(monkeypatch, result, status):
+    from girder_jobs.constants import JobStatus
+
+    updates = []
+
+    class FakeJob:
+        def updateJob(self, job, **kwargs):
+            updates.append(kwargs)
+            return job
+
+    def fake_ingest(folder, user, progress, **params):
+        assert params['fileType'] == 'ndjson'
+        progress(1, 2)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr('dive_server.views_metadata.Job', FakeJob)
+    monkeypatch.setattr('dive_server.views_metadata.User', lambda: _Loader())
+    monkeypatch.setattr('dive_server.views_metadata.Folder', lambda: _Loader())
+    monkeypatch.setattr('dive_server.views_metadata.ingest_metadata', fake_ingest)
+
+    job = {'kwargs': {'params': {'folderId': 'f', 'userId': 'u', 'fileType': 'ndjson'}}}
+    process_metadata_task(job)
+    assert updates[0]['status'] == JobStatus.RUNNING
+    assert updates[1] == {'progressCurrent': 1, 'progressTotal': 2}
+    assert updates[-1]['status'] == getattr(JobStatus, status)
+    # The job keeps its parameters in case it is rescheduled
+    assert 'userId' in job['kwargs']['params']
+
+
+class _Loader:
+    def load(self, id, force=False):
+        return {'_id': id, 'name': id}
@@ -0,0 +1,43 @@
+import json
+from typing import List, Tuple
+
+import pytest
+
+from dive_utils.serializers import dive
+
+test_tuple: List[Tuple[list, list]] = [
+    ([], []),
+    (
+        [
+            {
+                "id": 1,
+                "begin": 0,
+                "end": 1,
+                "confidencePairs": [["fish", 0.9]],
+                "attributes": {},
+                "features": [
+                    {"frame": 0, "bounds": [0, 0, 10, 10]},
+                    {"frame": 1, "bounds": [1, 1, 11, 11], "attributes": {"color": "red"}},
+                ],
+            },
+            {"id": 3, "begin": 4, "end": 4, "features": [{"frame": 4, "bounds": [1, 2, 3, 4]}]},
+        ],
+        [
+            {"id": 0, "members": {"1": {"ranges": [[0, 1]]}}, "confidencePairs": [["pair", 1]]},
+        ],
+    ),
+]
+
+
+@pytest.mark.parametrize("tracks,groups", test_tuple)
+def test_export_annotations_json(tracks: list, groups: list):
+    expected = json.dumps(
+        dive.migrate(
+            {
+                'tracks': {str(t['id']): t for t in tracks},
+                'groups': {str(g['id']): g for g in groups},
+                'version': 2,
+            }
+        )
+    )
+    assert ''.join(dive.export_annotations_json(tracks, groups)) == expected
@@ -3,6 +3,7 @@ from typing import Dict, List, Tuple
 
 import pytest
 
+from dive_utils.models import Feature, Track, interpolate
 from dive_utils.serializers import viame
 
 # Test cases can use this by staying under frame 100
@@ -349,12 +350,26 @@ image_filename_tests = [
 
 @pytest.mark.parametrize("input,expected,typeFilter", test_tuple)
 def test_write_viame_csv(input: Dict[str, dict], expected: List[str], typeFilter: List[str]):
-    for i, line in enumerate(
+    text = ''.join(
         viame.export_tracks_as_csv(
             input.values(), filenames=filenames, header=False, typeFilter=set(typeFilter)
         )
-    ):
-        assert line.strip(' ').rstrip() == expected[i]
+    )
+    assert [line.strip(' ') for line in text.split('\r\n')] == expected
+
+
+@pytest.mark.parametrize("input,expected,typeFilter", test_tuple)
+def test_write_viame_csv_trusted(
+    input: Dict[str, dict], expected: List[str], typeFilter: List[str]
+):
+    # Trusted reads are only used for tracks that were validated when stored
+    stored = [Track(**track).dict(exclude_none=True) for track in input.values()]
+    text = ''.join(
+        viame.export_tracks_as_csv(
+            stored, filenames=filenames, header=False, typeFilter=set(typeFilter), trusted=True
+        )
+    )
+    assert [line.strip(' ') for line in text.split('\r\n')] == expected
 
 
 def test_empty_header():
@@ -374,3 +389,35 @@ def test_image_filenames():
         else:
             with pytest.raises(ValueError, match=re.escape(test['error'])):
                 viame.load_csv_as_tracks_and_attributes(test['csv'], image_map)
+
+
+def test_write_viame_csv_chunks():
+    track = {
+        "id": 5,
+        "begin": 0,
+        "end": 500,
+        "confidencePairs": [["fish", 0.5]],
+        "attributes": {"kind": "long"},
+        "features": [
+            {"frame": 0, "bounds": [0, 0, 10, 10], "interpolate": True},
+            {"frame": 250, "bounds": [125, 251, 375, 999], "interpolate": True},
+            {"frame": 500, "bounds": [7, 7, 7, 7]},
+        ],
+    }
+    chunks = list(viame.export_tracks_as_csv([track], header=False, chunkSize=1024))
+    assert len(chunks) > 2
+    rows = ''.join(chunks).splitlines()
+    assert rows == ''.join(viame.export_tracks_as_csv([track], header=False)).splitlines()
+    assert len(rows) == 501
+
+    keyframes = [Feature(**f) for f in track['features']]
+    expected = [
+        *interpolate(keyframes[0], keyframes[1]),
+        *interpolate(keyframes[1], keyframes[2]),
+        keyframes[2],
+    ]
+    for row, feature in zip(rows, expected):
+        columns = row.split(',')
+        assert int(columns[2]) == feature.frame
+        assert [int(c) for c in columns[3:7]] == feature.bounds
+        assert columns[-1] == '(trk-atr) kind long'
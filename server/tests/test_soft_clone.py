@@ -0,0 +1,188 @@
+"""
+Unit tests for the batched ``createSoftClones`` used by the clone filter job.
+"""
+
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('girder')
+
+from bson.objectid import ObjectId  # noqa: E402
+from girder.exceptions import RestException, ValidationException  # noqa: E402
+
+from dive_server import crud_dataset  # noqa: E402
+from dive_utils import constants  # noqa: E402
+
+OWNER = {'_id': ObjectId(), 'login': 'owner'}
+
+
+def _get(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _matches(doc, query):
+    for key, condition in query.items():
+        value = _get(doc, key)
+        if isinstance(condition, dict):
+            if value not in condition['$in']:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    parent = {'_id': ObjectId(), 'baseParentId': ObjectId(), 'baseParentType': 'user'}
+    folders = [{'_id': ObjectId(), 'parentId': parent['_id'], 'name': 'a'}]
+    calls = {'annotations': [], 'masks': [], 'rollback': [], 'inserts': 0}
+
+    class FakeCollection:
+        def insert_many(self, docs):
+            calls['inserts'] += 1
+            for doc in docs:
+                doc['_id'] = ObjectId()
+                folders.append(doc)
+
+    class FakeFolder:
+        collection = FakeCollection()
+
+        def find(self, query, fields=None):
+            return [doc for doc in folders if _matches(doc, query)]
+
+        def validate(self, doc, allowRename=False):
+            if not doc['name']:
+                raise ValidationException('Folder name must not be empty.', 'name')
+            return doc
+
+        def hasAccess(self, doc, user=None, level=None):
+            return not doc.get('private')
+
+        def copyAccessPolicies(self, src, dest, save=False):
+            pass
+
+        def setUserAccess(self, doc, user=None, level=None, save=False):
+            pass
+
+        def update(self, query, update):
+            for doc in self.find(query):
+                for key in update['$unset']:
+                    doc.pop(key, None)
+
+        def remove(self, doc):
+            folders.remove(doc)
+
+    class FakeItem:
+        def find(self, query, fields=None):
+            return [{'name': 'a (1)'}]
+
+    fake_annotation = SimpleNamespace(
+        clone_head_annotations=lambda dataset_map, user: calls['annotations'].append(dataset_map),
+        clone_masks=lambda source, clone, user: calls['masks'].append(source['name']),
+        rollback=lambda clone, revision: calls['rollback'].append(clone['name']),
+        get_mask_folder=lambda clone: None,
+    )
+    monkeypatch.setattr(crud_dataset, 'Folder', FakeFolder)
+    monkeypatch.setattr(crud_dataset, 'Item', FakeItem)
+    monkeypatch.setattr(crud_dataset, 'crud_annotation', fake_annotation)
+    monkeypatch.setattr(
+        crud_dataset, 'crud', SimpleNamespace(getCloneRoot=lambda owner, source: source)
+    )
+
+    def add_source(name, **extra):
+        source = {'_id': ObjectId(), 'parentId': ObjectId(), 'name': name, 'meta': {}, **extra}
+        folders.append(source)
+        return source
+
+    return parent, folders, calls, add_source
+
+
+def _clones(folders, parent):
+    return [doc for doc in folders if constants.SoftCloneSourceMarker in doc]
+
+
+def test_create_soft_clones_batches_writes(fakes):
+    parent, folders, calls, add_source = fakes
+    first = add_source('a', meta={'fps': 5})
+    second = add_source('b', meta={constants.PublishedMarker: True})
+    hidden = add_source('c', private=True)
+    folders.append({'_id': ObjectId(), 'parentId': second['_id'], 'meta': {'mask': True}})
+
+    counts = crud_dataset.createSoftClones(
+        OWNER, [str(first['_id']), str(second['_id']), str(hidden['_id'])], parent
+    )
+
+    assert counts == {'cloned': 2, 'skipped': 0, 'missing': 1, 'invalid': 0}
+    clones = {doc['name']: doc for doc in _clones(folders, parent)}
+    # Names taken by both folders and items in the destination are skipped
+    assert set(clones) == {'a (2)', 'b'}
+    assert clones['a (2)']['meta'] == {
+        'fps': 5,
+        constants.PublishedMarker: False,
+        constants.ConfidenceFiltersMarker: {'default': 0.1},
+    }
+    assert clones['b'][constants.ForeignMediaIdMarker] == str(second['_id'])
+    assert not any(constants.SoftClonePendingMarker in doc for doc in clones.values())
+    auxiliary = [doc for doc in folders if doc.get('name') == constants.AuxiliaryFolderName]
+    assert {doc['parentId'] for doc in auxiliary} == {doc['_id'] for doc in clones.values()}
+    # One insert for the clones and one for their auxiliary folders
+    assert calls['inserts'] == 2
+    assert calls['annotations'] == [
+        {first['_id']: clones['a (2)']['_id'], second['_id']: clones['b']['_id']}
+    ]
+    assert calls['masks'] == ['b']
+
+
+def test_create_soft_clones_resumes(fakes, monkeypatch):
+    parent, folders, calls, add_source = fakes
+    monkeypatch.setattr(crud_dataset, 'SOFT_CLONE_BATCH_SIZE', 1)
+    sources = [add_source(name) for name in ['x', 'y', 'z']]
+    source_ids = [str(source['_id']) for source in sources]
+    handled = []
+
+    def stop_after_first(count):
+        handled.append(count)
+        return False
+
+    counts = crud_dataset.createSoftClones(OWNER, source_ids, parent, stop_after_first)
+    assert counts['cloned'] == 1
+    assert handled == [1]
+
+    # Simulate a run interrupted after creating the clone of y
+    crud_dataset.createSoftClones(OWNER, source_ids[1:2], parent)
+    (partial,) = [doc for doc in _clones(folders, parent) if doc['name'] == 'y']
+    partial[constants.SoftClonePendingMarker] = True
+
+    counts = crud_dataset.createSoftClones(
+        OWNER, source_ids, parent, lambda count: handled.append(count) or True
+    )
+    assert counts == {'cloned': 2, 'skipped': 1, 'missing': 0, 'invalid': 0}
+    assert calls['rollback'] == ['y']
+    assert handled == [1, 1, 2, 3]
+    assert sorted(doc['name'] for doc in _clones(folders, parent)) == ['x', 'y', 'z']
+
+
+def test_create_soft_clones_leaves_out_invalid_sources(fakes, monkeypatch):
+    parent, folders, calls, add_source = fakes
+    good = add_source('good')
+    orphan = add_source('orphan')
+    blank = add_source('  ')
+
+    def get_clone_root(owner, source):
+        if source is orphan:
+            raise RestException('Referenced media source missing.', code=404)
+        return source
+
+    monkeypatch.setattr(crud_dataset, 'crud', SimpleNamespace(getCloneRoot=get_clone_root))
+    counts = crud_dataset.createSoftClones(
+        OWNER, [str(good['_id']), str(orphan['_id']), str(blank['_id'])], parent
+    )
+    assert counts == {'cloned': 1, 'skipped': 0, 'missing': 0, 'invalid': 2}
+    assert [doc['name'] for doc in _clones(folders, parent)] == ['good']
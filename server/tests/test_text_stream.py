@@ -0,0 +1,21 @@
+import csv
+
+import pytest
+
+from dive_utils import text_stream
+
+text = 'track,name\r\n1,poisson épée\n2,鱼\r3,last'
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 4096])
+def test_text_stream_lines(chunk_size: int):
+    data = text.encode('utf-8')
+    chunks = (data[i : i + chunk_size] for i in range(0, len(data), chunk_size))
+    lines = list(text_stream(chunks))
+    assert [line.rstrip('\n') for line in lines] == text.splitlines()
+    assert list(csv.reader(text_stream([data]))) == list(csv.reader(text.splitlines()))
+
+
+def test_text_stream_empty():
+    assert list(text_stream([])) == []
+    assert text_stream([b'', b'a', b'', b'b']).read() == 'ab'